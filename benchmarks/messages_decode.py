@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+#
+# Measures the decoding throughput of SignalFlow stream messages, per message
+# type, from their JSON payloads into messages.StreamMessage objects.
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from signalfx.signalflow import messages  # noqa
+
+
+PAYLOADS = [
+    ('control-message', {'event': 'STREAM_START', 'timestampMs': 1}),
+    ('control-message', {'event': 'JOB_START', 'timestampMs': 1,
+                         'handle': 'DyaXwSVAwAA'}),
+    ('control-message', {'event': 'JOB_PROGRESS', 'timestampMs': 1,
+                         'progress': 42}),
+    ('control-message', {'event': 'END_OF_CHANNEL', 'timestampMs': 1}),
+    ('message', {'logicalTimestampMs': 1,
+                 'message': {'messageCode': 'JOB_RUNNING_RESOLUTION',
+                             'contents': {'resolutionMs': 1000}}}),
+    ('event', {'tsId': 'AAAAAAAAAAo', 'timestampMs': 1, 'metadata': {},
+               'properties': {'is': 'ok', 'was': 'anomalous'}}),
+    ('metadata', {'tsId': 'AAAAAAAAAAo',
+                  'properties': {'sf_metric': 'cpu.utilization',
+                                 'host': 'server1'}}),
+    ('expired-tsid', {'tsId': 'AAAAAAAAAAo'}),
+    ('data', {'logicalTimestampMs': 1,
+              'data': [{'tsId': 'AAAAAAAAAAo', 'value': 42}]}),
+    ('data', {'logicalTimestampMs': 1,
+              'data': [{'tsId': 'AAAAAAAAAA{0}'.format(i), 'value': i}
+                       for i in range(100)]}),
+    ('error', {'errors': [{'code': 'ANALYTICS_PROGRAM_NAME_ERROR'}]}),
+]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='SignalFlow stream message decoding benchmark')
+    parser.add_argument('-n', '--number', type=int, default=200000)
+    options = parser.parse_args()
+
+    for mtype, payload in PAYLOADS:
+        name = payload.get('event', mtype)
+        if mtype == 'data':
+            name = '{0} ({1} points)'.format(name, len(payload['data']))
+        elapsed = min(timeit.repeat(
+            lambda: messages.StreamMessage.decode(mtype, payload),
+            number=options.number, repeat=3))
+        print('{0:<24} {1:>12,.0f} msg/s'.format(
+            name, options.number / elapsed))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+#
+# Compares the throughput of the SignalFlow WebSocket transport's backends,
+# streaming the output of a computation made of large binary data batches
+# from a local fake SignalFlow server.
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from signalfx import signalflow  # noqa
+from signalfx.signalflow import backends, messages  # noqa
+
+_WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class FakeSignalFlowServer(object):
+    """Minimal WebSocket server speaking just enough of the SignalFlow
+    protocol: it authenticates anyone, and answers each execute request with
+    the given number of binary data batches, followed by an end of channel
+    message."""
+
+    def __init__(self, batches, points, compress):
+        datapoints = b''.join(struct.pack('!Bqd', 2, i, float(i))
+                              for i in range(points))
+        self._flags = 1 if compress else 0
+        self._bodies = []
+        for i in range(batches):
+            body = struct.pack('!qqi', i * 1000, 1000, points) + datapoints
+            if compress:
+                c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+                body = c.compress(body) + c.flush()
+            self._bodies.append(body)
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(8)
+        t = threading.Thread(target=self._serve)
+        t.daemon = True
+        t.start()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{0}'.format(self._sock.getsockname()[1])
+
+    def _serve(self):
+        while True:
+            conn, _ = self._sock.accept()
+            t = threading.Thread(target=self._handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _handle(self, conn):
+        f = conn.makefile('rb')
+        key = None
+        while True:
+            line = f.readline().strip()
+            if not line:
+                break
+            if line.lower().startswith(b'sec-websocket-key:'):
+                key = line.split(b':', 1)[1].strip()
+        accept = base64.b64encode(hashlib.sha1(key + _WS_GUID).digest())
+        conn.sendall(b'HTTP/1.1 101 Switching Protocols\r\n'
+                     b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        try:
+            while True:
+                opcode, payload = self._read_frame(f)
+                if opcode == 8:
+                    self._send(conn, 8, payload[:2])
+                    return
+                if opcode == 1:
+                    self._handle_request(conn, json.loads(
+                        payload.decode('utf-8')))
+        except (IOError, struct.error):
+            pass
+        finally:
+            f.close()
+            conn.close()
+
+    def _handle_request(self, conn, request):
+        if request['type'] == 'authenticate':
+            self._send_json(conn, {'type': 'authenticated', 'orgId': 'org',
+                                   'userId': 'user'})
+        elif request['type'] == 'execute':
+            channel = request['channel'].encode('utf-8')
+            for body in self._bodies:
+                self._send(conn, 2, struct.pack(
+                    '!BBBx16s', 3, 5, self._flags, channel) + body)
+            self._send_json(conn, {'type': 'control-message',
+                                   'channel': request['channel'],
+                                   'event': 'END_OF_CHANNEL',
+                                   'timestampMs': 0})
+
+    def _send_json(self, conn, message):
+        self._send(conn, 1, json.dumps(message).encode('utf-8'))
+
+    @staticmethod
+    def _send(conn, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        conn.sendall(header + payload)
+
+    @staticmethod
+    def _read_frame(f):
+        b1, b2 = struct.unpack('!BB', f.read(2))
+        length = b2 & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', f.read(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', f.read(8))
+        mask = f.read(4) if b2 & 0x80 else None
+        payload = bytearray(f.read(length))
+        if mask:
+            for i in range(length):
+                payload[i] ^= mask[i % 4]
+        return b1 & 0x0f, bytes(payload)
+
+
+def run(endpoint, backend, repeat):
+    client = signalflow.SignalFlowClient('token', endpoint, backend=backend)
+    timings = []
+    try:
+        for _ in range(repeat):
+            start = time.time()
+            batches = sum(1 for m in client.execute('data("foo").publish()')
+                          .stream() if isinstance(m, messages.DataMessage))
+            timings.append(time.time() - start)
+    finally:
+        client.close()
+    return batches, min(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='SignalFlow WebSocket backends benchmark')
+    parser.add_argument('--batches', type=int, default=200)
+    parser.add_argument('--points', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-compress', action='store_true')
+    parser.add_argument('--backends', nargs='+',
+                        default=backends.available_backends())
+    options = parser.parse_args()
+
+    server = FakeSignalFlowServer(options.batches, options.points,
+                                  not options.no_compress)
+    for backend in options.backends:
+        batches, elapsed = run(server.endpoint, backend, options.repeat)
+        print('{0}: {1} batches of {2} datapoints in {3:.3f}s '
+              '({4:.0f} batches/s)'.format(backend, batches, options.points,
+                                           elapsed, batches / elapsed))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+#
+# Measures how long the WebSocket transport's reading thread is kept busy by
+# each received frame (the "frame read latency" of the next frame), with
+# messages decoded inline on the reading thread or handed over to decode
+# workers, under a load of large compressed data batches.
+
+import argparse
+import os
+import struct
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from signalfx.signalflow import ws  # noqa
+from ws4py.messaging import BinaryMessage  # noqa
+
+
+def make_frame(channel, timestamp, points, compress):
+    body = struct.pack('!qqi', timestamp, 1000, points)
+    body += b''.join(struct.pack('!Bqd', 2, i, float(i))
+                     for i in range(points))
+    flags = 0
+    if compress:
+        c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        body = c.compress(body) + c.flush()
+        flags = 1
+    header = struct.pack('!BBBx16s', 3, 5, flags, channel.encode('utf-8'))
+    return header + body
+
+
+def run(workers, channels, frames, points, compress):
+    transport = ws.WebSocketTransport('token', decode_workers=workers)
+    chans = []
+    for _ in range(channels):
+        channel = transport._new_channel()
+        transport._channels[channel.name] = channel
+        chans.append(channel)
+
+    messages = [BinaryMessage(make_frame(chans[i % channels].name,
+                                         1000 * (i // channels), points,
+                                         compress))
+                for i in range(frames)]
+
+    read_times = []
+    start = time.time()
+    for message in messages:
+        t = time.time()
+        transport.received_message(message)
+        read_times.append(time.time() - t)
+    read_done = time.time() - start
+
+    received = 0
+    while received < frames:
+        for channel in chans:
+            while channel.poll():
+                received += 1
+    total = time.time() - start
+
+    read_times.sort()
+    return {
+        'p50_ms': 1000 * read_times[len(read_times) // 2],
+        'p99_ms': 1000 * read_times[int(len(read_times) * 0.99)],
+        'read_s': read_done,
+        'total_s': total,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='SignalFlow WebSocket frame decoding benchmark')
+    parser.add_argument('--channels', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=400)
+    parser.add_argument('--points', type=int, default=5000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--no-compress', action='store_true')
+    options = parser.parse_args()
+
+    for workers in options.workers:
+        result = run(workers, options.channels, options.frames,
+                     options.points, not options.no_compress)
+        print('decode_workers={0}: frame read p50={p50_ms:.3f}ms '
+              'p99={p99_ms:.3f}ms, all frames read in {read_s:.2f}s, '
+              'all decoded in {total_s:.2f}s'.format(workers, **result))
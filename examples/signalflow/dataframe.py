@@ -8,14 +8,13 @@
 
 import argparse
 import os
-import pandas
 import sys
 import time
 
 sys.path.insert(0, os.path.join(
     os.path.dirname(os.path.abspath(__file__)), '..', '..'))
 import signalfx  # noqa
-from signalfx.signalflow import messages  # noqa
+from signalfx.signalflow import accumulator  # noqa
 
 
 def get_data_frame(client, program, start, stop, resolution=None):
@@ -24,23 +23,10 @@ def get_data_frame(client, program, start, stop, resolution=None):
     containing the results, indexed by output timestamp.
 
     If the program contains multiple publish() calls, their outputs are merged
-    into the returned DataFrame."""
-    data = {}
-    metadata = {}
-
+    into the returned DataFrame. The timeseries metadata is available in the
+    DataFrame's attrs['metadata']."""
     c = client.execute(program, start=start, stop=stop, resolution=resolution)
-    for msg in c.stream():
-        if isinstance(msg, messages.DataMessage):
-            if msg.logical_timestamp_ms in data:
-                data[msg.logical_timestamp_ms].update(msg.data)
-            else:
-                data[msg.logical_timestamp_ms] = msg.data
-        elif isinstance(msg, messages.MetadataMessage):
-            metadata[msg.tsid] = msg.properties
-
-    df = pandas.DataFrame.from_dict(data, orient='index')
-    df.metadata = metadata
-    return df
+    return accumulator.TimeSeriesAccumulator(c).accumulate().to_data_frame()
 
 
 if __name__ == '__main__':
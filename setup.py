@@ -28,6 +28,9 @@ setup(
     packages=find_packages(),
     install_requires=requirements,
     tests_require=test_requirements,
+    extras_require={
+        'pandas': ['pandas>=1.0'],
+    },
     classifiers=[
         'Operating System :: OS Independent',
         'Programming Language :: Python',
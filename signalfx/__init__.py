@@ -90,13 +90,15 @@ class SignalFx(object):
         r.raise_for_status()
         return r.json()['accessToken']
 
-    def rest(self, token, endpoint=None, timeout=None):
-        """Obtain a metadata REST API client."""
+    def rest(self, token, endpoint=None, timeout=None, cache=None):
+        """Obtain a metadata REST API client, optionally caching metadata
+        lookups in the given cache.MetadataCache."""
         from . import rest
         return rest.SignalFxRestClient(
             token=token,
             endpoint=endpoint or self._api_endpoint,
-            timeout=timeout or self._timeout)
+            timeout=timeout or self._timeout,
+            cache=cache)
 
     def ingest(self, token, endpoint=None, timeout=None, compress=None):
         """Obtain a datapoint and event ingest client."""
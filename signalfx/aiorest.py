@@ -0,0 +1,436 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+# Asyncio REST API client, based on aiohttp. Python 3.6+ only, which is why it
+# lives in its own module, outside of the signalfx package's imports.
+
+import asyncio
+import collections
+import json
+import logging
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import constants, version
+from .rest import SignalFxRestClient
+
+_logger = logging.getLogger(__name__)
+
+_sync = SignalFxRestClient
+
+
+class AsyncSignalFxRestClient(object):
+    """Asyncio SignalFx REST API client.
+
+    Mirrors the methods of rest.SignalFxRestClient as coroutines, with the
+    paginated listings also available as asynchronous iterators (iter_*)
+    that fetch pages concurrently ahead of their consumption.
+
+    Requests go through a single aiohttp session, pooling up to
+    max_connections connections, with at most max_concurrency requests in
+    flight at any time. The client should be closed when no longer needed,
+    or used as an asynchronous context manager.
+
+    Errors are raised as aiohttp.ClientResponseError.
+    """
+
+    def __init__(self, token, endpoint=constants.DEFAULT_API_ENDPOINT,
+                 timeout=constants.DEFAULT_TIMEOUT, max_connections=100,
+                 max_concurrency=10):
+        if not aiohttp:
+            raise RuntimeError('aiohttp is not installed!')
+        self._token = token
+        self._endpoint = endpoint
+        self._timeout = timeout
+        self._max_connections = max_connections
+        self._max_concurrency = max_concurrency
+        # Created on first use, from within the event loop.
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _u(self, *args):
+        return '{0}/{1}'.format(self._endpoint, '/'.join(args))
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._max_connections),
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+                headers={
+                    'Content-Type': 'application/json',
+                    'X-SF-Token': self._token,
+                    'User-Agent': '{0}/{1} aiohttp/{2}'.format(
+                        version.name, version.version, aiohttp.__version__),
+                })
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._session
+
+    async def _request(self, method, url, params=None, data=None,
+                       timeout=None, ignore_not_found=False):
+        """Make a request and return its decoded JSON response, if any."""
+        session = self._get_session()
+        kwargs = {}
+        if timeout:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        if data is not None or method in ('PUT', 'POST'):
+            kwargs['json'] = data
+        _logger.debug('%s %s (params: %s)', method, url, params)
+        async with self._semaphore:
+            async with session.request(method, url,
+                                       params=_params(params),
+                                       **kwargs) as resp:
+                _logger.debug('%s to SignalFx %s (%d)', method,
+                              'succeeded' if resp.status < 400 else 'failed',
+                              resp.status)
+                if resp.status == 404 and ignore_not_found:
+                    return None
+                resp.raise_for_status()
+                body = await resp.read()
+        # Successful deletes and some updates have no response body.
+        return json.loads(body.decode('utf-8')) if body else None
+
+    async def _get(self, url, params=None, timeout=None):
+        return await self._request('GET', url, params, timeout=timeout)
+
+    async def _iter_pages(self, url, params=None, batch_size=100,
+                          concurrency=4, offset=0, limit=None, timeout=None):
+        """Asynchronous iterator over the results of a paginated list
+        endpoint, fetching up to `concurrency` pages at once (see
+        rest.SignalFxRestClient._iter_pages)."""
+        end = offset + limit if limit is not None else None
+
+        def page_size(offset):
+            if end is None:
+                return batch_size
+            return min(batch_size, end - offset)
+
+        async def fetch(offset):
+            data = await self._get(url, dict(params or {}, offset=offset,
+                                             limit=page_size(offset)),
+                                   timeout)
+            if isinstance(data, list):
+                return None, data
+            return data['count'], data['results']
+
+        if end is not None and end <= offset:
+            return
+        count, results = await fetch(offset)
+        for result in results:
+            yield result
+
+        if count is None:
+            while results and len(results) == page_size(offset):
+                offset += len(results)
+                if end is not None and offset >= end:
+                    return
+                _, results = await fetch(offset)
+                for result in results:
+                    yield result
+            return
+
+        end = count if end is None else min(end, count)
+        position = offset + len(results)
+        if not results or position >= end:
+            return
+
+        # Number of results the server returns per page.
+        step = len(results)
+        window = collections.deque()
+
+        def plan(start):
+            next_offset = start
+            while next_offset < end:
+                yield next_offset
+                next_offset += step
+
+        async def cancel():
+            for task in window:
+                task.cancel()
+            await asyncio.gather(*window, return_exceptions=True)
+            window.clear()
+
+        try:
+            planned = plan(position)
+            while position < end:
+                while len(window) < max(1, concurrency):
+                    next_offset = next(planned, None)
+                    if next_offset is None:
+                        break
+                    window.append(asyncio.ensure_future(fetch(next_offset)))
+                _, results = await window.popleft()
+                if not results:
+                    return
+                for result in results:
+                    yield result
+                expected = min(step, end - position)
+                position += len(results)
+                if len(results) != expected:
+                    # The planned offsets no longer line up with the pages
+                    # the server returns.
+                    await cancel()
+                    step = len(results)
+                    planned = plan(position)
+        finally:
+            await cancel()
+
+    async def _search_metrics_and_metadata(self, metadata_endpoint, query,
+                                           order_by=None, offset=None,
+                                           limit=None, timeout=None):
+        params = {'query': query, 'orderBy': order_by, 'offset': offset,
+                  'limit': limit}
+        return await self._get(self._u(metadata_endpoint), params, timeout)
+
+    def _iter_search_metrics_and_metadata(self, metadata_endpoint, query,
+                                          order_by=None, **kwargs):
+        return self._iter_pages(self._u(metadata_endpoint),
+                                {'query': query, 'orderBy': order_by},
+                                **kwargs)
+
+    async def _get_object_by_name(self, object_endpoint, object_name,
+                                  timeout=None):
+        return await self._get(self._u(object_endpoint, object_name),
+                               timeout=timeout)
+
+    # functionality related to metrics
+    async def search_metrics(self, *args, **kwargs):
+        return await self._search_metrics_and_metadata(
+            _sync._METRIC_ENDPOINT_SUFFIX, *args, **kwargs)
+
+    def iter_metrics(self, query, order_by=None, **kwargs):
+        return self._iter_search_metrics_and_metadata(
+            _sync._METRIC_ENDPOINT_SUFFIX, query, order_by, **kwargs)
+
+    async def get_metric_by_name(self, metric_name, **kwargs):
+        return await self._get_object_by_name(
+            _sync._METRIC_ENDPOINT_SUFFIX, metric_name, **kwargs)
+
+    async def update_metric_by_name(self, metric_name, metric_type,
+                                    description=None, custom_properties=None,
+                                    tags=None, **kwargs):
+        data = {'type': metric_type.upper(),
+                'description': description or '',
+                'customProperties': custom_properties or {},
+                'tags': tags or []}
+        return await self._request(
+            'PUT', self._u(_sync._METRIC_ENDPOINT_SUFFIX, str(metric_name)),
+            data=data, **kwargs)
+
+    # functionality related to dimensions
+    async def search_dimensions(self, *args, **kwargs):
+        return await self._search_metrics_and_metadata(
+            _sync._DIMENSION_ENDPOINT_SUFFIX, *args, **kwargs)
+
+    def iter_dimensions(self, query, order_by=None, **kwargs):
+        return self._iter_search_metrics_and_metadata(
+            _sync._DIMENSION_ENDPOINT_SUFFIX, query, order_by, **kwargs)
+
+    async def get_dimension(self, key, value, **kwargs):
+        return await self._get_object_by_name(
+            _sync._DIMENSION_ENDPOINT_SUFFIX, '{0}/{1}'.format(key, value),
+            **kwargs)
+
+    async def update_dimension(self, key, value, description=None,
+                               custom_properties=None, tags=None, **kwargs):
+        data = {'description': description or '',
+                'customProperties': custom_properties or {},
+                'tags': tags or [],
+                'key': key,
+                'value': value}
+        return await self._request(
+            'PUT', self._u(_sync._DIMENSION_ENDPOINT_SUFFIX, key, value),
+            data=data, **kwargs)
+
+    # functionality related to metrictimeseries
+    async def search_metric_time_series(self, *args, **kwargs):
+        return await self._search_metrics_and_metadata(
+            _sync._MTS_ENDPOINT_SUFFIX, *args, **kwargs)
+
+    def iter_metric_time_series(self, query, order_by=None, **kwargs):
+        return self._iter_search_metrics_and_metadata(
+            _sync._MTS_ENDPOINT_SUFFIX, query, order_by, **kwargs)
+
+    async def get_metric_time_series(self, mts_id, **kwargs):
+        return await self._get_object_by_name(
+            _sync._MTS_ENDPOINT_SUFFIX, mts_id, **kwargs)
+
+    # functionality related to tags
+    async def search_tags(self, *args, **kwargs):
+        return await self._search_metrics_and_metadata(
+            _sync._TAG_ENDPOINT_SUFFIX, *args, **kwargs)
+
+    def iter_tags(self, query, order_by=None, **kwargs):
+        return self._iter_search_metrics_and_metadata(
+            _sync._TAG_ENDPOINT_SUFFIX, query, order_by, **kwargs)
+
+    async def get_tag(self, tag_name, **kwargs):
+        return await self._get_object_by_name(
+            _sync._TAG_ENDPOINT_SUFFIX, tag_name, **kwargs)
+
+    async def update_tag(self, tag_name, description=None,
+                         custom_properties=None, **kwargs):
+        data = {'description': description or '',
+                'customProperties': custom_properties or {}}
+        return await self._request(
+            'PUT', self._u(_sync._TAG_ENDPOINT_SUFFIX, tag_name),
+            data=data, **kwargs)
+
+    async def delete_tag(self, tag_name, **kwargs):
+        await self._request(
+            'DELETE', self._u(_sync._TAG_ENDPOINT_SUFFIX, tag_name), **kwargs)
+
+    # functionality related to organizations
+    async def get_organization(self, **kwargs):
+        return await self._get(
+            self._u(_sync._ORGANIZATION_ENDPOINT_SUFFIX), **kwargs)
+
+    # functionality related to charts, dashboards and dashboard groups
+    async def get_chart(self, id, **kwargs):
+        return await self._get_object_by_name(
+            _sync._CHART_ENDPOINT_SUFFIX, id, **kwargs)
+
+    async def get_dashboard_group(self, id, **kwargs):
+        return await self._get_object_by_name(
+            _sync._DASHBOARD_GROUP_ENDPOINT_SUFFIX, id, **kwargs)
+
+    async def get_dashboard_groups(self, name=None, batch_size=100,
+                                   **kwargs):
+        return [g async for g in self.iter_dashboard_groups(
+            name, batch_size, **kwargs)]
+
+    def iter_dashboard_groups(self, name=None, batch_size=100,
+                              concurrency=4, **kwargs):
+        return self._iter_pages(
+            self._u(_sync._DASHBOARD_GROUP_ENDPOINT_SUFFIX),
+            {'name': name}, batch_size, concurrency, **kwargs)
+
+    async def get_dashboard(self, id, **kwargs):
+        return await self._get_object_by_name(
+            _sync._DASHBOARD_ENDPOINT_SUFFIX, id, **kwargs)
+
+    async def get_dashboards(self, name=None, batch_size=100, **kwargs):
+        return [d async for d in self.iter_dashboards(
+            name, batch_size, **kwargs)]
+
+    def iter_dashboards(self, name=None, batch_size=100, concurrency=4,
+                        **kwargs):
+        return self._iter_pages(
+            self._u(_sync._DASHBOARD_ENDPOINT_SUFFIX),
+            {'name': name}, batch_size, concurrency, **kwargs)
+
+    # functionality related to detectors
+    async def get_detector(self, id, **kwargs):
+        return await self._get_object_by_name(
+            _sync._DETECTOR_ENDPOINT_SUFFIX, id, **kwargs)
+
+    async def get_detectors(self, name=None, tags=None, batch_size=100,
+                            **kwargs):
+        return [d async for d in self.iter_detectors(
+            name, tags, batch_size, **kwargs)]
+
+    def iter_detectors(self, name=None, tags=None, batch_size=100,
+                       concurrency=4, **kwargs):
+        return self._iter_pages(
+            self._u(_sync._DETECTOR_ENDPOINT_SUFFIX),
+            {'name': name, 'tags': tags or []}, batch_size, concurrency,
+            **kwargs)
+
+    async def validate_detector(self, detector):
+        await self._request(
+            'POST', self._u(_sync._DETECTOR_ENDPOINT_SUFFIX, 'validate'),
+            data=detector)
+
+    async def create_detector(self, detector):
+        return await self._request(
+            'POST', self._u(_sync._DETECTOR_ENDPOINT_SUFFIX), data=detector)
+
+    async def update_detector(self, detector_id, detector):
+        return await self._request(
+            'PUT', self._u(_sync._DETECTOR_ENDPOINT_SUFFIX, detector_id),
+            data=detector)
+
+    async def delete_detector(self, detector_id, **kwargs):
+        await self._request(
+            'DELETE', self._u(_sync._DETECTOR_ENDPOINT_SUFFIX, detector_id),
+            **kwargs)
+
+    async def get_detector_events(self, detector_id, **kwargs):
+        return await self._get(
+            self._u(_sync._DETECTOR_ENDPOINT_SUFFIX, detector_id, 'events'),
+            **kwargs)
+
+    async def get_detector_incidents(self, detector_id, **kwargs):
+        return await self._get(
+            self._u(_sync._DETECTOR_ENDPOINT_SUFFIX, detector_id,
+                    'incidents'),
+            **kwargs)
+
+    # functionality related to incidents
+    async def get_incident(self, incident_id, **kwargs):
+        return await self._get_object_by_name(
+            _sync._INCIDENT_ENDPOINT_SUFFIX, incident_id, **kwargs)
+
+    async def get_incidents(self, offset=0, limit=None,
+                            include_resolved=False, **kwargs):
+        return await self._get(
+            self._u(_sync._INCIDENT_ENDPOINT_SUFFIX),
+            {'offset': offset, 'limit': limit,
+             'include_resolved': include_resolved},
+            **kwargs)
+
+    def iter_incidents(self, include_resolved=False, batch_size=100,
+                       concurrency=4, **kwargs):
+        return self._iter_pages(
+            self._u(_sync._INCIDENT_ENDPOINT_SUFFIX),
+            {'include_resolved': include_resolved}, batch_size, concurrency,
+            **kwargs)
+
+    async def clear_incident(self, incident_id, **kwargs):
+        await self._request(
+            'PUT',
+            self._u(_sync._INCIDENT_ENDPOINT_SUFFIX, incident_id, 'clear'),
+            **kwargs)
+
+    # functionality related to datalinks
+    async def get_datalinks(self, context=None, propertyName=None,
+                            propertyValue=None, orderBy=None, offset=0,
+                            limit=None, **kwargs):
+        return await self._get(
+            self._u(_sync._DATALINK_ENDPOINT_SUFFIX),
+            {'context': context, 'propertyName': propertyName,
+             'propertyValue': propertyValue, 'orderBy': orderBy,
+             'offset': offset, 'limit': limit},
+            **kwargs)
+
+    async def get_datalink(self, id, **kwargs):
+        return await self._get_object_by_name(
+            _sync._DATALINK_ENDPOINT_SUFFIX, '{0}'.format(id), **kwargs)
+
+
+def _params(params):
+    """Convert request parameters to the (name, string value) pairs aiohttp
+    expects, leaving out unset parameters and repeating list ones."""
+    if not params:
+        return None
+    pairs = []
+    for name, value in params.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for value in values:
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = str(value).lower()
+            pairs.append((name, str(value)))
+    return pairs
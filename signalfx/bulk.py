@@ -0,0 +1,244 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import collections
+import logging
+import random
+import requests
+import threading
+import time
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+_logger = logging.getLogger(__name__)
+
+
+class BulkResult(object):
+    """Outcome of a bulk update: the number of objects updated, the number
+    left alone because they were already up to date, and the list of
+    (item, exception) pairs of the updates that failed."""
+
+    def __init__(self):
+        self.updated = 0
+        self.unchanged = 0
+        self.failed = []
+
+    @property
+    def processed(self):
+        return self.updated + self.unchanged + len(self.failed)
+
+    def __str__(self):
+        return '{0} updated, {1} unchanged, {2} failed'.format(
+            self.updated, self.unchanged, len(self.failed))
+
+
+class BulkUpdater(object):
+    """Applies large numbers of dimension, metric or tag metadata updates
+    through a SignalFxRestClient.
+
+    Updates are made by a bounded pool of workers, over a pooled session
+    shared between them. Each object's current state is fetched first, and
+    the update is skipped if it wouldn't change anything. Rate-limited
+    (429) and unavailable (503) responses are retried after the delay the
+    API asks for in its Retry-After header, or with exponential backoff,
+    pausing all the workers in the meantime; other failures are recorded and
+    don't stop the rest of the updates.
+
+    The progress function, if given, is called with the BulkResult after
+    each update; progress is also logged every progress_every updates,
+    unless progress_every is 0 or None.
+    """
+
+    _RETRY_STATUSES = frozenset([429, 503])
+
+    def __init__(self, client, workers=8, max_retries=5, backoff=1.0,
+                 max_backoff=60, progress=None, progress_every=1000):
+        self._client = client
+        self._workers = workers
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._progress = progress
+        self._progress_every = progress_every
+
+        self._session = requests.Session()
+        self._session.headers.update(client._session.headers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._paused_until = 0
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def update_dimensions(self, updates):
+        """Update dimensions from an iterable of (key, value, description,
+        custom_properties, tags) tuples."""
+        client = self._client
+
+        def update(key, value, description=None, custom_properties=None,
+                   tags=None):
+            url = client._u(client._DIMENSION_ENDPOINT_SUFFIX, key, value)
+            desired = _desired(description, custom_properties)
+            desired['tags'] = tags or []
+            return url, desired, lambda: client.update_dimension(
+                key, value, description, custom_properties, tags,
+                session=self._session)
+        return self._run(updates, update)
+
+    def update_metrics(self, updates):
+        """Update metrics from an iterable of (metric_name, metric_type,
+        description, custom_properties, tags) tuples."""
+        client = self._client
+
+        def update(metric_name, metric_type, description=None,
+                   custom_properties=None, tags=None):
+            url = client._u(client._METRIC_ENDPOINT_SUFFIX, str(metric_name))
+            desired = _desired(description, custom_properties)
+            desired['tags'] = tags or []
+            desired['type'] = metric_type.upper()
+            return url, desired, lambda: client.update_metric_by_name(
+                metric_name, metric_type, description, custom_properties,
+                tags, session=self._session)
+        return self._run(updates, update)
+
+    def update_tags(self, updates):
+        """Update tags from an iterable of (tag_name, description,
+        custom_properties) tuples."""
+        client = self._client
+
+        def update(tag_name, description=None, custom_properties=None):
+            url = client._u(client._TAG_ENDPOINT_SUFFIX, tag_name)
+            desired = _desired(description, custom_properties)
+            return url, desired, lambda: client.update_tag(
+                tag_name, description, custom_properties,
+                session=self._session)
+        return self._run(updates, update)
+
+    def _run(self, updates, update):
+        result = BulkResult()
+
+        def record(item, outcome):
+            if isinstance(outcome, Exception):
+                _logger.warning('Update of %s failed: %s', item, outcome)
+                result.failed.append((item, outcome))
+            elif outcome:
+                result.updated += 1
+            else:
+                result.unchanged += 1
+            if self._progress:
+                self._progress(result)
+            if self._progress_every and \
+                    result.processed % self._progress_every == 0:
+                _logger.info('Bulk update progress: %s', result)
+
+        def apply(item):
+            try:
+                return self._apply(*update(*item))
+            except Exception as e:
+                return e
+
+        if not futures or self._workers <= 1:
+            for item in updates:
+                record(item, apply(item))
+        else:
+            pending = collections.deque()
+            items = iter(updates)
+            with futures.ThreadPoolExecutor(self._workers) as pool:
+                # Keep the workers busy without queuing all the updates.
+                for item in items:
+                    pending.append((item, pool.submit(apply, item)))
+                    while len(pending) >= 2 * self._workers:
+                        done, future = pending.popleft()
+                        record(done, future.result())
+                while pending:
+                    done, future = pending.popleft()
+                    record(done, future.result())
+
+        _logger.info('Bulk update done: %s', result)
+        return result
+
+    def _apply(self, url, desired, put):
+        """Apply an update unless the object is already in the desired
+        state; return whether it was updated."""
+        current = self._retry(lambda: self._client._get(
+            url, session=self._session))
+        if current.status_code != requests.codes.not_found:
+            current.raise_for_status()
+            if _matches(current.json(), desired):
+                return False
+        self._retry(put)
+        return True
+
+    def _retry(self, request):
+        """Make the given request, retrying it while it is rate limited."""
+        attempt = 0
+        while True:
+            self._wait_if_paused()
+            try:
+                response = request()
+            except requests.exceptions.HTTPError as e:
+                response = e.response
+                if response is None or \
+                        response.status_code not in self._RETRY_STATUSES or \
+                        attempt >= self._max_retries:
+                    raise
+            else:
+                # Update methods return the updated object, not a response.
+                if not isinstance(response, requests.Response) or \
+                        response.status_code not in self._RETRY_STATUSES or \
+                        attempt >= self._max_retries:
+                    return response
+            self._pause(self._retry_delay(response, attempt))
+            attempt += 1
+
+    def _retry_delay(self, response, attempt):
+        try:
+            return float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            delay = min(self._max_backoff, self._backoff * 2 ** attempt)
+            return delay * (0.5 + random.random() / 2)
+
+    def _pause(self, delay):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + delay)
+
+    def _wait_if_paused(self):
+        delay = self._paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _desired(description, custom_properties):
+    return {'description': description or '',
+            'customProperties': custom_properties or {}}
+
+
+def _matches(current, desired):
+    """Tell whether the current state of an object already matches the
+    desired metadata."""
+    for field, value in desired.items():
+        actual = current.get(field)
+        if field == 'tags':
+            if sorted(actual or []) != sorted(value):
+                return False
+        elif field == 'description':
+            if (actual or '') != value:
+                return False
+        elif field == 'customProperties':
+            if (actual or {}) != value:
+                return False
+        elif actual != value:
+            return False
+    return True
@@ -0,0 +1,182 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import six
+import tempfile
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Atomically replaces the destination, where supported (Python 3).
+_replace = getattr(os, 'replace', os.rename)
+
+
+class MetadataCache(object):
+    """In-memory LRU cache of metadata objects with a TTL, for the REST
+    client's lookups of metrics, dimensions, tags and metric time series.
+
+    Entries are fresh for ttl seconds after they were stored, during which
+    lookups are served from memory without an API call. Expired entries are
+    kept (until evicted) along with the ETag and Last-Modified validators of
+    the response they came from, so the client can revalidate them with a
+    conditional request instead of fetching them again in full.
+
+    When max_size is set, the least recently used entries are evicted first.
+    An optional backend, like a DiskCacheBackend, is written through and
+    consulted on misses, so that the cache can be shared between processes.
+
+    The REST client namespaces its keys by API token, so that a cache and
+    its backend can be shared between clients of different organizations.
+
+    Cached objects are shared between lookups and must not be modified.
+    """
+
+    def __init__(self, ttl=300, max_size=10000, backend=None):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._backend = backend
+        self._lock = threading.Lock()
+        # key -> [value, etag, last_modified, expiry time]
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    def get(self, key):
+        """Return the fresh cached value for the given key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] > time.time():
+                self._touch(key, entry)
+                return entry[0]
+        entry = self._load(key)
+        if entry is not None and entry[3] > time.time():
+            return entry[0]
+        return None
+
+    def lookup(self, key):
+        """Return the (value, etag, last_modified) of the cached entry for
+        the given key, even if it has expired, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            entry = self._load(key)
+        if entry is None:
+            return None
+        return entry[0], entry[1], entry[2]
+
+    def put(self, key, value, etag=None, last_modified=None):
+        """Store a fresh value for the given key, with the validators of the
+        response it came from, if any."""
+        entry = [value, etag, last_modified, time.time() + self._ttl]
+        self._store(key, entry)
+        if self._backend is not None:
+            self._backend.set(key, entry)
+
+    def refresh(self, key):
+        """Mark the entry for the given key as fresh again, after it was
+        revalidated."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            entry = self._load(key)
+        if entry is not None:
+            self.put(key, entry[0], entry[1], entry[2])
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self._backend is not None:
+            self._backend.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            if self._max_size:
+                while len(self._entries) >= self._max_size:
+                    self._entries.popitem(last=False)
+            self._entries[key] = entry
+
+    def _load(self, key):
+        """Load the entry for the given key from the backend into memory."""
+        if self._backend is None:
+            return None
+        entry = self._backend.get(key)
+        if entry is not None:
+            self._store(key, entry)
+        return entry
+
+    def _touch(self, key, entry):
+        if six.PY2:
+            del self._entries[key]
+            self._entries[key] = entry
+        else:
+            self._entries.move_to_end(key)
+
+
+class DiskCacheBackend(object):
+    """On-disk backend for a MetadataCache, shareable between processes.
+
+    Each entry is stored as a small JSON file named after the hash of its
+    key, and replaced atomically when updated.
+    """
+
+    _SUFFIX = '.json'
+
+    def __init__(self, directory):
+        self._directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, name + self._SUFFIX)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('key') != key:
+            return None
+        return [entry['value'], entry['etag'], entry['last_modified'],
+                entry['expires']]
+
+    def set(self, key, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'value': entry[0], 'etag': entry[1],
+                           'last_modified': entry[2], 'expires': entry[3]},
+                          f)
+            _replace(tmp_path, self._path(key))
+        except (IOError, OSError, TypeError, ValueError):
+            _logger.exception('Error writing metadata cache entry!')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
@@ -0,0 +1,387 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+"""Local, searchable index of SignalFx metadata.
+
+Metrics, dimensions and metric time series are downloaded incrementally from
+the REST API into a SQLite database, where a subset of the search query
+syntax can then be answered locally:
+
+  - field:value, with * and ? wildcards in the value;
+  - field:* or _exists_:field, for objects that have the field;
+  - * alone, for all objects;
+  - AND, OR and NOT (terms next to each other are ANDed), and parentheses.
+
+Fields are the object's own properties (like name, key, value or metric),
+its dimensions, custom properties and tags.
+
+The index can be used from code, or from the command line:
+
+    python -m signalfx.index --db metadata.db sync --kind dimensions
+    python -m signalfx.index --db metadata.db search dimensions 'host:web*'
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import six
+import sqlite3
+import sys
+
+from . import constants
+from .rest import SignalFxRestClient
+
+_logger = logging.getLogger(__name__)
+
+METRICS, DIMENSIONS, METRIC_TIME_SERIES = 'metrics', 'dimensions', 'mts'
+
+# Kind of object -> REST client iterator over its search results.
+_ITERATORS = {
+    METRICS: 'iter_metrics',
+    DIMENSIONS: 'iter_dimensions',
+    METRIC_TIME_SERIES: 'iter_metric_time_series',
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    last_updated INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+CREATE TABLE IF NOT EXISTS properties (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS properties_by_value
+    ON properties (kind, name, value);
+CREATE INDEX IF NOT EXISTS properties_by_object
+    ON properties (kind, id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    kind TEXT NOT NULL,
+    query TEXT NOT NULL,
+    last_updated INTEGER,
+    PRIMARY KEY (kind, query)
+);
+"""
+
+
+class MetadataIndex(object):
+    """SQLite index of metrics, dimensions and metric time series metadata.
+
+    Each object is stored as the JSON returned by the API, along with one
+    indexed row per searchable (field, value) pair. sync() only downloads
+    the objects updated since the last sync of the same kind and query;
+    objects deleted in SignalFx are only removed by a full sync.
+    """
+
+    # The search API doesn't page past this many results for a query.
+    _MAX_RESULTS = 10000
+
+    def __init__(self, path=':memory:'):
+        self._path = path
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+
+    def sync(self, client, kind, query='*', full=False, batch_size=1000):
+        """Download the objects of the given kind matching the given query
+        that were updated since the last sync, and return their number.
+
+        A full sync downloads all the matching objects again, replacing all
+        the objects of that kind in the index."""
+        _check_kind(kind)
+        if full:
+            with self._db:
+                for table in ('objects', 'properties', 'sync_state'):
+                    self._db.execute(
+                        'DELETE FROM {0} WHERE kind = ?'.format(table),
+                        (kind,))
+
+        since = self._watermark(kind, query)
+        synced = 0
+        while True:
+            search = query
+            if since is not None:
+                search = '({0}) AND lastUpdated:>={1}'.format(query, since)
+            results = getattr(client, _ITERATORS[kind])(
+                search, order_by='lastUpdated', batch_size=batch_size,
+                limit=self._MAX_RESULTS)
+            count, latest = self.add(kind, results)
+            synced += count
+            if latest is not None:
+                self._set_watermark(kind, query, latest)
+            if count < self._MAX_RESULTS:
+                break
+            if latest == since:
+                _logger.warning('More than %d %s updated at %d; not all of '
+                                'them could be synced.', self._MAX_RESULTS,
+                                kind, since)
+                break
+            # Continue from the most recent update seen.
+            since = latest
+        _logger.info('Synced %d %s matching %s.', synced, kind, query)
+        return synced
+
+    def add(self, kind, objects):
+        """Add or replace the given objects of the given kind in the index,
+        and return their number and most recent lastUpdated."""
+        _check_kind(kind)
+        count, latest = 0, None
+        with self._db:
+            for obj in objects:
+                oid, name = _identify(kind, obj)
+                last_updated = obj.get('lastUpdated')
+                self._db.execute(
+                    'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                    (kind, oid, name, last_updated, json.dumps(obj)))
+                self._db.execute(
+                    'DELETE FROM properties WHERE kind = ? AND id = ?',
+                    (kind, oid))
+                self._db.executemany(
+                    'INSERT INTO properties VALUES (?, ?, ?, ?)',
+                    [(kind, oid, field, value)
+                     for field, value in _properties(kind, obj)])
+                count += 1
+                if last_updated is not None:
+                    latest = max(latest or last_updated, last_updated)
+        return count, latest
+
+    def search(self, kind, query, limit=None):
+        """Return the objects of the given kind matching the given query,
+        ordered by name."""
+        _check_kind(kind)
+        where, params = _QueryParser(kind, query).parse()
+        sql = ('SELECT data FROM objects WHERE kind = ? AND ({0}) '
+               'ORDER BY name'.format(where))
+        params = [kind] + params
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [json.loads(row[0]) for row in self._db.execute(sql, params)]
+
+    def search_metrics(self, query, limit=None):
+        return self.search(METRICS, query, limit)
+
+    def search_dimensions(self, query, limit=None):
+        return self.search(DIMENSIONS, query, limit)
+
+    def search_metric_time_series(self, query, limit=None):
+        return self.search(METRIC_TIME_SERIES, query, limit)
+
+    def _watermark(self, kind, query):
+        row = self._db.execute(
+            'SELECT last_updated FROM sync_state WHERE kind = ? AND query = ?',
+            (kind, query)).fetchone()
+        return row[0] if row else None
+
+    def _set_watermark(self, kind, query, last_updated):
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                (kind, query, last_updated))
+
+
+def _check_kind(kind):
+    if kind not in _ITERATORS:
+        raise ValueError('Unknown kind of metadata {0}!'.format(kind))
+
+
+def _identify(kind, obj):
+    """Return the ID and name of the given object."""
+    if kind == METRICS:
+        return obj['name'], obj['name']
+    if kind == DIMENSIONS:
+        return '{0}/{1}'.format(obj['key'], obj['value']), obj['value']
+    return obj['id'], obj.get('metric')
+
+
+def _properties(kind, obj):
+    """Return the searchable (field, value) pairs of the given object."""
+    if kind == METRICS:
+        fields = ['name', 'type', 'description']
+    elif kind == DIMENSIONS:
+        fields = ['key', 'value', 'description']
+        yield obj['key'], _text(obj['value'])
+    else:
+        fields = ['id', 'metric', 'type']
+        if obj.get('metric') is not None:
+            yield 'sf_metric', _text(obj['metric'])
+        for dimension, value in (obj.get('dimensions') or {}).items():
+            yield dimension, _text(value)
+    for field in fields:
+        if obj.get(field) is not None:
+            yield field, _text(obj[field])
+    for tag in obj.get('tags') or []:
+        yield 'tags', _text(tag)
+    for name, value in (obj.get('customProperties') or {}).items():
+        if value is not None:
+            yield name, _text(value)
+
+
+def _text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, six.string_types):
+        return value
+    return six.text_type(value)
+
+
+class _QueryParser(object):
+    """Translates a search query into a SQL condition on the objects of a
+    given kind, with its parameters."""
+
+    _TOKENS = re.compile(r'\s*(\(|\)|(?:[^\s():"]+:)?"(?:[^"\\]|\\.)*"|'
+                         r'[^\s()]+)')
+
+    def __init__(self, kind, query):
+        self._kind = kind
+        self._query = query
+        self._tokens = self._tokenize(query)
+        self._params = []
+
+    def _tokenize(self, query):
+        tokens, pos = [], 0
+        query = query.strip()
+        while pos < len(query):
+            match = self._TOKENS.match(query, pos)
+            if not match:
+                raise ValueError('Invalid query {0}!'.format(query))
+            tokens.append(match.group(1))
+            pos = match.end()
+        return tokens
+
+    def parse(self):
+        where = self._or()
+        if self._tokens:
+            raise ValueError('Unexpected {0} in query {1}!'.format(
+                self._tokens[0], self._query))
+        return where, self._params
+
+    def _peek(self):
+        return self._tokens[0] if self._tokens else None
+
+    def _or(self):
+        parts = [self._and()]
+        while self._peek() in ('OR', '||'):
+            self._tokens.pop(0)
+            parts.append(self._and())
+        return ' OR '.join(parts) if len(parts) > 1 else parts[0]
+
+    def _and(self):
+        parts = [self._not()]
+        while self._peek() not in (None, ')', 'OR', '||'):
+            if self._peek() in ('AND', '&&'):
+                self._tokens.pop(0)
+            parts.append(self._not())
+        return ' AND '.join(parts) if len(parts) > 1 else parts[0]
+
+    def _not(self):
+        if self._peek() in ('NOT', '!'):
+            self._tokens.pop(0)
+            return 'NOT ' + self._not()
+        return self._primary()
+
+    def _primary(self):
+        token = self._peek()
+        if token is None or token == ')':
+            raise ValueError('Incomplete query {0}!'.format(self._query))
+        self._tokens.pop(0)
+        if token == '(':
+            where = self._or()
+            if self._peek() != ')':
+                raise ValueError('Unbalanced parentheses in query {0}!'
+                                 .format(self._query))
+            self._tokens.pop(0)
+            return '({0})'.format(where)
+        return self._term(token)
+
+    def _term(self, token):
+        if token == '*':
+            return '1'
+        field, sep, value = token.partition(':')
+        if not sep or not field or not value:
+            raise ValueError('Unsupported term {0} in query {1}!'.format(
+                token, self._query))
+        condition = 'id IN (SELECT id FROM properties WHERE kind = ? ' \
+                    'AND name = ?{0})'
+        if field == '_exists_':
+            self._params.extend([self._kind, value])
+            return condition.format('')
+        self._params.extend([self._kind, field])
+        if value == '*':
+            return condition.format('')
+        if value.startswith('"') and value.endswith('"') and len(value) > 1:
+            self._params.append(re.sub(r'\\(.)', r'\1', value[1:-1]))
+            return condition.format(' AND value = ?')
+        value = re.sub(r'\\(.)', lambda m: '[' + m.group(1) + ']'
+                       if m.group(1) in '*?' else m.group(1),
+                       value.replace('[', '[[]'))
+        if '*' in value or '?' in value:
+            self._params.append(value)
+            return condition.format(' AND value GLOB ?')
+        self._params.append(value.replace('[[]', '['))
+        return condition.format(' AND value = ?')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m signalfx.index',
+        description='Local searchable index of SignalFx metadata')
+    parser.add_argument('--db', default='signalfx-metadata.db',
+                        help='path of the SQLite index')
+    commands = parser.add_subparsers(dest='command')
+
+    sync = commands.add_parser('sync', help='download metadata')
+    sync.add_argument('--token', default=os.environ.get('SIGNALFX_API_TOKEN'),
+                      help='API token (default: $SIGNALFX_API_TOKEN)')
+    sync.add_argument('--api-endpoint', default=constants.DEFAULT_API_ENDPOINT)
+    sync.add_argument('--kind', nargs='+', choices=sorted(_ITERATORS),
+                      default=sorted(_ITERATORS))
+    sync.add_argument('--query', default='*')
+    sync.add_argument('--full', action='store_true',
+                      help='download everything again')
+
+    search = commands.add_parser('search', help='search the local index')
+    search.add_argument('kind', choices=sorted(_ITERATORS))
+    search.add_argument('query')
+    search.add_argument('--limit', type=int)
+
+    options = parser.parse_args(argv)
+    if options.command is None:
+        parser.error('a command is required')
+
+    with MetadataIndex(options.db) as index:
+        if options.command == 'sync':
+            if not options.token:
+                parser.error('an API token is required')
+            logging.basicConfig(level=logging.INFO)
+            with SignalFxRestClient(options.token,
+                                    options.api_endpoint) as client:
+                for kind in options.kind:
+                    index.sync(client, kind, options.query, options.full)
+        else:
+            for obj in index.search(options.kind, options.query,
+                                    options.limit):
+                print(json.dumps(obj, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
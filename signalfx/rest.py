@@ -1,9 +1,17 @@
 # Copyright (C) 2016-2019 SignalFx, Inc. All rights reserved.
 # Copyright (C) 2020 Splunk, Inc. All rights reserved.
 
+import collections
+import hashlib
 import logging
 import pprint
 import requests
+import threading
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 from . import constants, version
 
@@ -14,8 +22,45 @@ from . import constants, version
 _logger = logging.getLogger(__name__)
 
 
+def _freeze(d):
+    """Return a hashable equivalent of the given dictionary of request
+    parameters or headers."""
+    if not d:
+        return None
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                        for k, v in d.items()))
+
+
+class _InflightRequest(object):
+    """A GET request in flight, whose outcome is shared with the callers
+    that made the same request in the meantime."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
 class SignalFxRestClient(object):
-    """SignalFx REST API client."""
+    """SignalFx REST API client.
+
+    With a cache.MetadataCache, lookups of metrics, dimensions, tags and
+    metric time series by name or ID are served from the cache while its
+    entries are fresh, and revalidated with conditional requests once they
+    have expired. Updates made through this client write through to the
+    cache.
+
+    Concurrent identical GET requests (same URL, parameters and headers) are
+    coalesced: while one is in flight, the other callers wait for it and
+    share its response instead of making their own, unless coalesce is
+    False.
+    """
 
     _CHART_ENDPOINT_SUFFIX = 'v2/chart'
     _DASHBOARD_ENDPOINT_SUFFIX = 'v2/dashboard'
@@ -29,11 +74,25 @@ class SignalFxRestClient(object):
     _TAG_ENDPOINT_SUFFIX = 'v2/tag'
     _ORGANIZATION_ENDPOINT_SUFFIX = 'v2/organization'
 
+    # Endpoints whose objects are looked up through the metadata cache.
+    _CACHED_ENDPOINT_SUFFIXES = frozenset([
+        _METRIC_ENDPOINT_SUFFIX, _DIMENSION_ENDPOINT_SUFFIX,
+        _MTS_ENDPOINT_SUFFIX, _TAG_ENDPOINT_SUFFIX])
+
     def __init__(self, token, endpoint=constants.DEFAULT_API_ENDPOINT,
-                 timeout=constants.DEFAULT_TIMEOUT):
+                 timeout=constants.DEFAULT_TIMEOUT, cache=None,
+                 coalesce=True):
         self._token = token
         self._endpoint = endpoint
         self._timeout = timeout
+        self._cache = cache
+        # Cache keys are namespaced by token, so that a cache (or its disk
+        # backend) shared between organizations never mixes their metadata.
+        self._cache_namespace = hashlib.sha256(
+            token.encode('utf-8')).hexdigest()[:16] if token else ''
+        self._coalesce = coalesce
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
         self._session = requests.Session()
         self._session.headers.update({
@@ -51,11 +110,58 @@ class SignalFxRestClient(object):
     def _u(self, *args):
         return '{0}/{1}'.format(self._endpoint, '/'.join(args))
 
-    def _get(self, url, params=None, session=None, timeout=None):
+    def _get(self, url, params=None, session=None, timeout=None,
+             headers=None):
+        key = self._inflight_key(url, params, session, timeout, headers)
+        if key is None:
+            return self._do_get(url, params, session, timeout, headers)
+        return self._single_flight(key, lambda: self._do_get(
+            url, params, session, timeout, headers))
+
+    def _single_flight(self, key, call_fn):
+        """Call the given function, unless a call with the same key is
+        already in flight, in which case wait for it and share its outcome.
+        """
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _InflightRequest()
+        if not leader:
+            _logger.debug('%s already in flight', key)
+            return call.wait()
+
+        try:
+            call.response = call_fn()
+            return call.response
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            call.done.set()
+
+    def _inflight_key(self, url, params, session, timeout, headers):
+        """Return the key identifying identical GET requests, or None if the
+        request can't be coalesced."""
+        if not self._coalesce:
+            return None
+        try:
+            key = (url, _freeze(params), id(session), timeout,
+                   _freeze(headers))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _do_get(self, url, params=None, session=None, timeout=None,
+                headers=None):
         session = session or self._session
         timeout = timeout or self._timeout
         _logger.debug('GET %s (params: %s)', url, params)
-        response = session.get(url, timeout=timeout, params=params)
+        response = session.get(url, timeout=timeout, params=params,
+                               headers=headers)
         _logger.debug('Getting from SignalFx %s (%d): %s',
                       'succeeded' if response.ok else 'failed',
                       response.status_code, response.text)
@@ -140,10 +246,190 @@ class SignalFxRestClient(object):
             dictionary of response
         """
         timeout = timeout or self._timeout
-        resp = self._get(self._u(object_endpoint, object_name),
-                         session=self._session, timeout=timeout)
+        url = self._u(object_endpoint, object_name)
+        if self._cache is None or \
+                object_endpoint not in self._CACHED_ENDPOINT_SUFFIXES:
+            resp = self._get(url, session=self._session, timeout=timeout)
+            resp.raise_for_status()
+            return resp.json()
+
+        value = self._cache.get(self._cache_key(url))
+        if value is not None:
+            return value
+        if not self._coalesce:
+            return self._lookup(url, timeout)
+        # The lookup fills the cache before other callers are released, so
+        # that no duplicate request is made in between.
+        return self._single_flight(('lookup', url, timeout),
+                                   lambda: self._lookup(url, timeout))
+
+    def _lookup(self, url, timeout):
+        """Look up an object through the cache, revalidating or replacing
+        its expired entry, if there is one."""
+        key = self._cache_key(url)
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+
+        headers = {}
+        entry = self._cache.lookup(key)
+        if entry:
+            _, etag, last_modified = entry
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        resp = self._do_get(url, session=self._session, timeout=timeout,
+                            headers=headers)
+        if resp.status_code == requests.codes.not_modified and entry:
+            self._cache.refresh(key)
+            return entry[0]
         resp.raise_for_status()
-        return resp.json()
+        value = resp.json()
+        self._cache.put(key, value, resp.headers.get('ETag'),
+                        resp.headers.get('Last-Modified'))
+        return value
+
+    def _cache_key(self, url):
+        return '{0} {1}'.format(self._cache_namespace, url)
+
+    def _cache_update(self, url, resp):
+        """Write the object returned by an update through to the cache."""
+        if self._cache is not None:
+            self._cache.put(self._cache_key(url), resp.json())
+
+    def _iter_pages(self, url, params=None, batch_size=100, concurrency=4,
+                    offset=0, limit=None, **kwargs):
+        """
+        generic generator over the results of a paginated list endpoint.
+
+        The first page is fetched on its own; the total count it reports is
+        then used to plan the offsets of the following pages, which are
+        fetched by up to `concurrency` concurrent requests while the results
+        are being consumed. Offsets advance by the number of results actually
+        received, so pages are planned again if the server returns fewer
+        results per page than `batch_size`, and iteration ends once the count
+        is reached. Endpoints that don't report a count are paged through one
+        request at a time, until a page comes back short. Results are yielded
+        in order, and no request is left running once the generator is
+        exhausted or closed.
+
+        Args:
+            url (string): URL of the endpoint
+            params (optional[dict]): query parameters, besides offset and
+                limit
+            batch_size (optional[int]): number of results per page
+            concurrency (optional[int]): maximum number of pages fetched at
+                once
+            offset (optional[int]): number of results to skip
+            limit (optional[int]): maximum number of results to return
+        """
+        end = offset + limit if limit is not None else None
+
+        def page_size(offset):
+            if end is None:
+                return batch_size
+            return min(batch_size, end - offset)
+
+        def fetch(offset):
+            page_params = dict(params or {}, offset=offset,
+                               limit=page_size(offset))
+            resp = self._get(url, params=page_params, **kwargs)
+            resp.raise_for_status()
+            data = resp.json()
+            if isinstance(data, list):
+                return None, data
+            return data['count'], data['results']
+
+        if end is not None and end <= offset:
+            return
+        count, results = fetch(offset)
+        for result in results:
+            yield result
+
+        if count is None:
+            while results and len(results) == page_size(offset):
+                offset += len(results)
+                if end is not None and offset >= end:
+                    return
+                _, results = fetch(offset)
+                for result in results:
+                    yield result
+            return
+
+        end = count if end is None else min(end, count)
+        position = offset + len(results)
+        if not results or position >= end:
+            return
+
+        if not futures or concurrency <= 1:
+            while position < end:
+                _, results = fetch(position)
+                if not results:
+                    return
+                for result in results:
+                    yield result
+                position += len(results)
+            return
+
+        # Number of results the server returns per page.
+        step = len(results)
+        window = collections.deque()
+        pool = futures.ThreadPoolExecutor(max_workers=concurrency)
+
+        def plan(start):
+            next_offset = start
+            while next_offset < end:
+                yield next_offset
+                next_offset += step
+
+        def cancel():
+            for _, future in window:
+                future.cancel()
+            futures.wait([future for _, future in window])
+            window.clear()
+
+        try:
+            planned = plan(position)
+            while position < end:
+                while len(window) < concurrency:
+                    next_offset = next(planned, None)
+                    if next_offset is None:
+                        break
+                    window.append((next_offset,
+                                   pool.submit(fetch, next_offset)))
+                _, future = window.popleft()
+                _, results = future.result()
+                if not results:
+                    return
+                for result in results:
+                    yield result
+                expected = min(step, end - position)
+                position += len(results)
+                if len(results) != expected:
+                    # The planned offsets no longer line up with the pages
+                    # the server returns.
+                    cancel()
+                    step = len(results)
+                    planned = plan(position)
+        finally:
+            cancel()
+            pool.shutdown(wait=True)
+
+    def _iter_search_metrics_and_metadata(self, metadata_endpoint, query,
+                                          order_by=None, **kwargs):
+        """
+        generator over all the results of an elasticsearch query on metrics,
+            dimensions, metrictimeseries or tags (see _iter_pages)
+        Args:
+            metadata_endpoint (string): API endpoint suffix (e.g. 'v2/metric')
+            query (string): elasticsearch string query
+            order_by (optional[string]): property by which to order results
+        """
+        params = {'query': query}
+        if order_by is not None:
+            params['orderBy'] = order_by
+        return self._iter_pages(self._u(metadata_endpoint), params, **kwargs)
 
     # functionality related to metrics
     def search_metrics(self, *args, **kwargs):
@@ -162,6 +448,26 @@ class SignalFxRestClient(object):
         return self._search_metrics_and_metadata(
             self._METRIC_ENDPOINT_SUFFIX, *args, **kwargs)
 
+    def iter_metrics(self, query, order_by=None, **kwargs):
+        """
+        Generator over all the metrics matching the given query, fetching
+        pages concurrently ahead of their consumption.
+
+        Args:
+            query (string): elasticsearch string query
+            order_by (optional[string]): property by which to order results
+            batch_size (optional[int]): number of results per page
+                (default=100)
+            concurrency (optional[int]): maximum number of pages fetched at
+                once (default=4)
+            offset (optional[int]): number of results to skip (default=0)
+            limit (optional[int]): maximum number of results to return
+            timeout (optional[int]): how long to wait for each response (in
+                seconds)
+        """
+        return self._iter_search_metrics_and_metadata(
+            self._METRIC_ENDPOINT_SUFFIX, query, order_by, **kwargs)
+
     def get_metric_by_name(self, metric_name, **kwargs):
         """
         get a metric by name
@@ -194,10 +500,10 @@ class SignalFxRestClient(object):
                 'description': description or '',
                 'customProperties': custom_properties or {},
                 'tags': tags or []}
-        resp = self._put(self._u(self._METRIC_ENDPOINT_SUFFIX,
-                                 str(metric_name)),
-                         data=data, **kwargs)
+        url = self._u(self._METRIC_ENDPOINT_SUFFIX, str(metric_name))
+        resp = self._put(url, data=data, **kwargs)
         resp.raise_for_status()
+        self._cache_update(url, resp)
         return resp.json()
 
     # functionality related to dimensions
@@ -217,6 +523,26 @@ class SignalFxRestClient(object):
         return self._search_metrics_and_metadata(
             self._DIMENSION_ENDPOINT_SUFFIX, *args, **kwargs)
 
+    def iter_dimensions(self, query, order_by=None, **kwargs):
+        """
+        Generator over all the dimensions matching the given query, fetching
+        pages concurrently ahead of their consumption.
+
+        Args:
+            query (string): elasticsearch string query
+            order_by (optional[string]): property by which to order results
+            batch_size (optional[int]): number of results per page
+                (default=100)
+            concurrency (optional[int]): maximum number of pages fetched at
+                once (default=4)
+            offset (optional[int]): number of results to skip (default=0)
+            limit (optional[int]): maximum number of results to return
+            timeout (optional[int]): how long to wait for each response (in
+                seconds)
+        """
+        return self._iter_search_metrics_and_metadata(
+            self._DIMENSION_ENDPOINT_SUFFIX, query, order_by, **kwargs)
+
     def get_dimension(self, key, value, **kwargs):
         """
         get a dimension by key and value
@@ -249,9 +575,10 @@ class SignalFxRestClient(object):
                 'tags': tags or [],
                 'key': key,
                 'value': value}
-        resp = self._put(self._u(self._DIMENSION_ENDPOINT_SUFFIX, key, value),
-                         data=data, **kwargs)
+        url = self._u(self._DIMENSION_ENDPOINT_SUFFIX, key, value)
+        resp = self._put(url, data=data, **kwargs)
         resp.raise_for_status()
+        self._cache_update(url, resp)
         return resp.json()
 
     # functionality related to metrictimeseries
@@ -272,6 +599,26 @@ class SignalFxRestClient(object):
         return self._search_metrics_and_metadata(self._MTS_ENDPOINT_SUFFIX,
                                                  *args, **kwargs)
 
+    def iter_metric_time_series(self, query, order_by=None, **kwargs):
+        """
+        Generator over all the metric time series matching the given query,
+        fetching pages concurrently ahead of their consumption.
+
+        Args:
+            query (string): elasticsearch string query
+            order_by (optional[string]): property by which to order results
+            batch_size (optional[int]): number of results per page
+                (default=100)
+            concurrency (optional[int]): maximum number of pages fetched at
+                once (default=4)
+            offset (optional[int]): number of results to skip (default=0)
+            limit (optional[int]): maximum number of results to return
+            timeout (optional[int]): how long to wait for each response (in
+                seconds)
+        """
+        return self._iter_search_metrics_and_metadata(
+            self._MTS_ENDPOINT_SUFFIX, query, order_by, **kwargs)
+
     def get_metric_time_series(self, mts_id, **kwargs):
         """get a metric time series by id"""
         return self._get_object_by_name(self._MTS_ENDPOINT_SUFFIX,
@@ -296,6 +643,26 @@ class SignalFxRestClient(object):
         return self._search_metrics_and_metadata(self._TAG_ENDPOINT_SUFFIX,
                                                  *args, **kwargs)
 
+    def iter_tags(self, query, order_by=None, **kwargs):
+        """
+        Generator over all the tags matching the given query, fetching
+        pages concurrently ahead of their consumption.
+
+        Args:
+            query (string): elasticsearch string query
+            order_by (optional[string]): property by which to order results
+            batch_size (optional[int]): number of results per page
+                (default=100)
+            concurrency (optional[int]): maximum number of pages fetched at
+                once (default=4)
+            offset (optional[int]): number of results to skip (default=0)
+            limit (optional[int]): maximum number of results to return
+            timeout (optional[int]): how long to wait for each response (in
+                seconds)
+        """
+        return self._iter_search_metrics_and_metadata(
+            self._TAG_ENDPOINT_SUFFIX, query, order_by, **kwargs)
+
     def get_tag(self, tag_name, **kwargs):
         """get a tag by name
 
@@ -321,9 +688,10 @@ class SignalFxRestClient(object):
         """
         data = {'description': description or '',
                 'customProperties': custom_properties or {}}
-        resp = self._put(self._u(self._TAG_ENDPOINT_SUFFIX, tag_name),
-                         data=data, **kwargs)
+        url = self._u(self._TAG_ENDPOINT_SUFFIX, tag_name)
+        resp = self._put(url, data=data, **kwargs)
         resp.raise_for_status()
+        self._cache_update(url, resp)
         return resp.json()
 
     def delete_tag(self, tag_name, **kwargs):
@@ -332,9 +700,11 @@ class SignalFxRestClient(object):
         Args:
             tag_name (string): name of tag to delete
         """
-        resp = self._delete(self._u(self._TAG_ENDPOINT_SUFFIX, tag_name),
-                            **kwargs)
+        url = self._u(self._TAG_ENDPOINT_SUFFIX, tag_name)
+        resp = self._delete(url, **kwargs)
         resp.raise_for_status()
+        if self._cache is not None:
+            self._cache.invalidate(self._cache_key(url))
         # successful delete returns 204, which has no associated json
         return resp
 
@@ -371,26 +741,22 @@ class SignalFxRestClient(object):
         all (v2) dashboard groups otherwise.
 
         Note that this method will loop through the paging of the results and
-        accumulate all dashboard groups that match the query.
-        """
-        dashgroups = []
-        offset = 0
-        while True:
-            resp = self._get(
-                self._u(self._DASHBOARD_GROUP_ENDPOINT_SUFFIX),
-                params={
-                    'offset': offset,
-                    'limit': batch_size,
-                    'name': name,
-                },
-                **kwargs)
-            resp.raise_for_status()
-            data = resp.json()
-            dashgroups += data['results']
-            if len(dashgroups) == data['count']:
-                break
-            offset = len(dashgroups)
-        return dashgroups
+        accumulate all dashboard groups that match the query. See
+        iter_dashboard_groups() to process them as they are received instead.
+        """
+        return list(self.iter_dashboard_groups(name, batch_size, **kwargs))
+
+    def iter_dashboard_groups(self, name=None, batch_size=100, concurrency=4,
+                              **kwargs):
+        """Iterate over all (v2) dashboard groups matching the given name; all
+        (v2) dashboard groups otherwise.
+
+        Pages of results are fetched by up to `concurrency` concurrent
+        requests, ahead of their consumption.
+        """
+        return self._iter_pages(
+            self._u(self._DASHBOARD_GROUP_ENDPOINT_SUFFIX),
+            {'name': name}, batch_size, concurrency, **kwargs)
 
     # functionality related to dashboards
     def get_dashboard(self, id, **kwargs):
@@ -405,26 +771,22 @@ class SignalFxRestClient(object):
         dashboards otherwise.
 
         Note that this method will loop through the paging of the results and
-        accumulate all dashboards that match the query. This may be expensive.
-        """
-        dashboards = []
-        offset = 0
-        while True:
-            resp = self._get(
-                self._u(self._DASHBOARD_ENDPOINT_SUFFIX),
-                params={
-                    'offset': offset,
-                    'limit': batch_size,
-                    'name': name,
-                },
-                **kwargs)
-            resp.raise_for_status()
-            data = resp.json()
-            dashboards += data['results']
-            if len(dashboards) == data['count']:
-                break
-            offset = len(dashboards)
-        return dashboards
+        accumulate all dashboards that match the query. This may be expensive;
+        see iter_dashboards() to process them as they are received instead.
+        """
+        return list(self.iter_dashboards(name, batch_size, **kwargs))
+
+    def iter_dashboards(self, name=None, batch_size=100, concurrency=4,
+                        **kwargs):
+        """Iterate over all (v2) dashboards matching the given name; all (v2)
+        dashboards otherwise.
+
+        Pages of results are fetched by up to `concurrency` concurrent
+        requests, ahead of their consumption.
+        """
+        return self._iter_pages(
+            self._u(self._DASHBOARD_ENDPOINT_SUFFIX),
+            {'name': name}, batch_size, concurrency, **kwargs)
 
     # functionality related to detectors
     def get_detector(self, id, **kwargs):
@@ -439,27 +801,23 @@ class SignalFxRestClient(object):
         detectors otherwise.
 
         Note that this method will loop through the paging of the results and
-        accumulate all detectors that match the query. This may be expensive.
-        """
-        detectors = []
-        offset = 0
-        while True:
-            resp = self._get(
-                self._u(self._DETECTOR_ENDPOINT_SUFFIX),
-                params={
-                    'offset': offset,
-                    'limit': batch_size,
-                    'name': name,
-                    'tags': tags or [],
-                },
-                **kwargs)
-            resp.raise_for_status()
-            data = resp.json()
-            detectors += data['results']
-            if len(detectors) == data['count']:
-                break
-            offset = len(detectors)
-        return detectors
+        accumulate all detectors that match the query. This may be expensive;
+        see iter_detectors() to process them as they are received instead.
+        """
+        return list(self.iter_detectors(name, tags, batch_size, **kwargs))
+
+    def iter_detectors(self, name=None, tags=None, batch_size=100,
+                       concurrency=4, **kwargs):
+        """Iterate over all (v2) detectors matching the given name; all (v2)
+        detectors otherwise.
+
+        Pages of results are fetched by up to `concurrency` concurrent
+        requests, ahead of their consumption.
+        """
+        return self._iter_pages(
+            self._u(self._DETECTOR_ENDPOINT_SUFFIX),
+            {'name': name, 'tags': tags or []}, batch_size, concurrency,
+            **kwargs)
 
     def validate_detector(self, detector):
         """Validate a detector.
@@ -571,6 +929,19 @@ class SignalFxRestClient(object):
         resp.raise_for_status()
         return resp.json()
 
+    def iter_incidents(self, include_resolved=False, batch_size=100,
+                       concurrency=4, **kwargs):
+        """Iterate over all (v2) incidents.
+
+        As the total number of incidents isn't known upfront, pages of results
+        are fetched one at a time, until one comes back short; `concurrency`
+        is accepted for consistency with the other iterators.
+        """
+        return self._iter_pages(
+            self._u(self._INCIDENT_ENDPOINT_SUFFIX),
+            {'include_resolved': str(include_resolved).lower()},
+            batch_size, concurrency, **kwargs)
+
     def clear_incident(self, incident_id, **kwargs):
         """Clears an incident.
 
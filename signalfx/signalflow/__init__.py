@@ -1,7 +1,7 @@
 # Copyright (C) 2016-2019 SignalFx, Inc. All rights reserved.
 # Copyright (C) 2020 Splunk, Inc. All rights reserved.
 
-from . import computation, ws
+from . import backfill, computation, keepalive, ws
 from .. import constants
 
 
@@ -12,15 +12,33 @@ class SignalFlowClient(object):
     execution of ad-hoc computations, returning its output in real-time as it
     is produced; to start new background computations; attach, keep alive or
     stop existing computations.
+
+    The metadata kept by each computation can be capped to metadata_size
+    timeseries, evicting the least recently used ones first. With a
+    release_timeout (in seconds), computations release the data received for
+    a logical timestamp without waiting any longer for its missing batches
+    (see computation.Computation).
+
+    When given a ResultCache, executions of programs over time ranges that
+    are entirely in the past are served from the cache when possible, and
+    recorded into it otherwise.
+
+    Extra keyword arguments are passed through to the transport, for example
+    the channel_capacity and overflow_policy of the WebSocket transport.
     """
 
     def __init__(self, token, endpoint=constants.DEFAULT_STREAM_ENDPOINT,
                  timeout=constants.DEFAULT_TIMEOUT,
                  transport=ws.WebSocketTransport,
-                 compress=True, proxy_url=None):
+                 compress=True, proxy_url=None, metadata_size=None,
+                 cache=None, release_timeout=None, **kwargs):
         self._transport = transport(token, endpoint, timeout, compress,
-                                    proxy_url)
+                                    proxy_url, **kwargs)
+        self._metadata_size = metadata_size
+        self._release_timeout = release_timeout
+        self._cache = cache
         self._computations = set([])
+        self._keepalives = None
 
     def __enter__(self):
         return self
@@ -31,6 +49,12 @@ class SignalFlowClient(object):
     def _get_params(self, **kwargs):
         return dict((k, v) for k, v in kwargs.items() if v is not None)
 
+    def _new_computation(self, exec_fn):
+        c = computation.Computation(exec_fn, self._metadata_size,
+                                    self._release_timeout)
+        self._computations.add(c)
+        return c
+
     def execute(self, program, start=None, stop=None, resolution=None,
                 max_delay=None, persistent=False, immediate=False,
                 disable_all_metric_publishes=None, withDerivedMetadata=None,
@@ -47,11 +71,29 @@ class SignalFlowClient(object):
         def exec_fn(since=None):
             if since:
                 params['start'] = since
+            if self._cache and self._cache.is_cacheable(params):
+                key = self._cache.key(program, params)
+                return self._cache.get(key) or self._cache.record(
+                    key, self._transport.execute(program, params))
             return self._transport.execute(program, params)
 
-        c = computation.Computation(exec_fn)
-        self._computations.add(c)
-        return c
+        return self._new_computation(exec_fn)
+
+    def execute_many(self, programs, **kwargs):
+        """Execute the given SignalFlow programs, with the same parameters
+        as execute(), and return a ComputationSelector that streams all their
+        outputs as (computation, message) pairs as they are produced."""
+        return computation.ComputationSelector(
+            [self.execute(program, **kwargs) for program in programs])
+
+    def backfill(self, program, start, stop, resolution, shard_size=None,
+                 parallelism=4, **kwargs):
+        """Execute the given SignalFlow program over the [start, stop) time
+        range as concurrent, time-sharded computations, and return a Backfill
+        that streams their combined output back in logical timestamp order.
+        Other parameters are as for execute()."""
+        return backfill.Backfill(self, program, start, stop, resolution,
+                                 shard_size, parallelism, **kwargs)
 
     def preflight(self, program, start, stop, resolution=None,
                   max_delay=None):
@@ -66,9 +108,7 @@ class SignalFlowClient(object):
                 params['start'] = since
             return self._transport.preflight(program, params)
 
-        c = computation.Computation(exec_fn)
-        self._computations.add(c)
-        return c
+        return self._new_computation(exec_fn)
 
     def start(self, program, start=None, stop=None, resolution=None,
               max_delay=None):
@@ -82,20 +122,30 @@ class SignalFlowClient(object):
     def attach(self, handle, filters=None, resolution=None):
         """Attach to an existing SignalFlow computation."""
         params = self._get_params(filters=filters, resolution=resolution)
-        c = computation.Computation(
+        return self._new_computation(
             lambda since: self._transport.attach(handle, params))
-        self._computations.add(c)
-        return c
 
     def keepalive(self, handle):
         """Keepalive a SignalFlow computation."""
         self._transport.keepalive(handle)
 
+    @property
+    def keepalives(self):
+        """The KeepaliveScheduler of this client, to keep background
+        computations alive without having to call keepalive() manually."""
+        if not self._keepalives:
+            self._keepalives = keepalive.KeepaliveScheduler(self._transport)
+        return self._keepalives
+
     def stop(self, handle, reason=None):
         """Stop a SignalFlow computation."""
+        if self._keepalives:
+            self._keepalives.remove(handle)
         params = self._get_params(reason=reason)
         self._transport.stop(handle, params)
 
     def close(self):
         """Close this SignalFlow client."""
+        if self._keepalives:
+            self._keepalives.close()
         self._transport.close()
@@ -0,0 +1,17 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+# JSON decoding shared by the WebSocket and Server-Sent Events transports.
+
+import json
+import six
+
+# Parse JSON directly from bytes where supported (Python 2, 3.6+), saving an
+# extra copy of the payload.
+try:
+    json.loads(b'{}')
+    loads = json.loads
+except TypeError:
+    def loads(data):
+        if not isinstance(data, six.text_type):
+            data = data.decode('utf-8')
+        return json.loads(data)
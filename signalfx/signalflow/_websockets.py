@@ -0,0 +1,105 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+# WebSocket backend based on the asyncio websockets library. Python 3.7+ only,
+# which is why it lives in its own module (see backends).
+
+import asyncio
+import threading
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+
+class WebSocketsBackend(object):
+    """WebSocket backend based on the asyncio websockets library, with the
+    connection running in an event loop on its own thread.
+
+    Sends and closes are queued to a writer task in the event loop, without
+    waiting for them: the loop may be blocked in a callback (for instance a
+    channel applying backpressure), and the threads sending requests, like a
+    consumer detaching from such a channel, must not wait on it.
+    """
+
+    name = 'websockets'
+
+    def __init__(self, url, handler):
+        if not websockets:
+            raise RuntimeError('websockets is not installed!')
+        self._url = url
+        self._handler = handler
+        self._loop = asyncio.new_event_loop()
+        self._ws = None
+        self._thread = None
+        self._outgoing = None
+
+    @staticmethod
+    def available():
+        return websockets is not None
+
+    @property
+    def version(self):
+        return websockets.__version__
+
+    def connect(self):
+        self._thread = threading.Thread(target=self._loop.run_until_complete,
+                                        args=(self._run(),),
+                                        name='SignalFlowWebSockets')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _queue(self, item):
+        """Queue the given data, or (code, reason) close, to be sent by the
+        writer task, in order."""
+        self._loop.call_soon_threadsafe(self._outgoing.put_nowait, item)
+
+    def send(self, data):
+        self._queue(data)
+
+    def close(self, code=1000, reason=None):
+        if self._ws:
+            self._queue((code, reason or ''))
+
+    async def _write(self):
+        while True:
+            item = await self._outgoing.get()
+            if item is None:
+                return
+            try:
+                if isinstance(item, tuple):
+                    await self._ws.close(*item)
+                else:
+                    await self._ws.send(item)
+            except websockets.ConnectionClosed:
+                pass
+            except Exception as e:
+                self._handler.unhandled_error(e)
+
+    async def _run(self):
+        try:
+            self._ws = await websockets.connect(self._url, max_size=None,
+                                                compression=None)
+        except Exception as e:
+            self._handler.unhandled_error(e)
+            self._handler.closed(1006, str(e))
+            return
+
+        self._outgoing = asyncio.Queue()
+        writer = self._loop.create_task(self._write())
+        self._handler.opened()
+        try:
+            async for message in self._ws:
+                self._handler.received_data(message,
+                                            isinstance(message, bytes))
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            self._handler.unhandled_error(e)
+            await self._ws.close(1011)
+        self._handler.closed(self._ws.close_code or 1006,
+                             self._ws.close_reason)
+
+        # Let queued sends and closes complete before the loop stops.
+        self._outgoing.put_nowait(None)
+        await writer
@@ -0,0 +1,196 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import collections
+
+from . import messages
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TimeSeriesAccumulator(object):
+    """Accumulates the data output of a SignalFlow computation.
+
+    Each output timeseries gets its own ring buffer of (logical timestamp,
+    value) samples. When a window is given, only the last `window` logical
+    timestamps of output are retained, keeping memory usage constant for
+    long-running computations; appends are O(1) in all cases. Data received
+    for an already accumulated logical timestamp, like corrections, is
+    merged in timestamp order instead, as long as that timestamp is still
+    retained.
+
+    The accumulated data can be exported, optionally incrementally from a
+    given timestamp, to a Pandas DataFrame or an Arrow table, with the
+    timeseries metadata known to the computation attached to it.
+    """
+
+    def __init__(self, computation, window=None):
+        self._computation = computation
+        self._window = window
+        self._timestamps = collections.deque(maxlen=window)
+        self._series = {}
+
+    @property
+    def computation(self):
+        return self._computation
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def timestamps(self):
+        """The list of retained logical timestamps, in order."""
+        return list(self._timestamps)
+
+    @property
+    def last_timestamp(self):
+        """The most recent logical timestamp accumulated, if any."""
+        return self._timestamps[-1] if self._timestamps else None
+
+    def get_known_tsids(self):
+        return sorted(self._series.keys())
+
+    def get_series(self, tsid, since=None):
+        """Return the retained (timestamp, value) samples of the given
+        timeseries, optionally only those strictly after `since`."""
+        buf = self._series.get(tsid)
+        if not buf:
+            return []
+        oldest = self._timestamps[0]
+        samples = []
+        for ts, value in reversed(buf):
+            if ts < oldest or (since is not None and ts <= since):
+                break
+            samples.append((ts, value))
+        samples.reverse()
+        return samples
+
+    def add(self, message):
+        """Accumulate the given stream message. Only data and expired
+        timeseries messages are relevant; all others are ignored."""
+        if isinstance(message, messages.DataMessage):
+            ts = message.logical_timestamp_ms
+            if not _insert(self._timestamps, ts):
+                return
+            for tsid, value in message.data.items():
+                buf = self._series.get(tsid)
+                if buf is None:
+                    buf = collections.deque(maxlen=self._window)
+                    self._series[tsid] = buf
+                _insert(buf, (ts, value), _timestamp)
+        elif isinstance(message, messages.ExpiredTsIdMessage):
+            self._series.pop(message.tsid, None)
+
+    def consume(self):
+        """Consume the computation's output stream, accumulating its data
+        while yielding every message back to the caller."""
+        for message in self._computation.stream():
+            self.add(message)
+            yield message
+
+    def accumulate(self):
+        """Consume the computation's output stream until it completes."""
+        for _ in self.consume():
+            pass
+        return self
+
+    def get_metadata(self, tsids=None):
+        """Return the metadata of the given (or all known) timeseries, as a
+        dictionary keyed by timeseries ID."""
+        if tsids is None:
+            tsids = self._series.keys()
+        return dict((tsid, self._computation.get_metadata(tsid))
+                    for tsid in tsids)
+
+    def to_data_frame(self, since=None):
+        """Export the accumulated data to a Pandas DataFrame indexed by
+        logical timestamp, with one column per timeseries.
+
+        If `since` is given, only data strictly after that timestamp is
+        exported. The timeseries metadata is available in the DataFrame's
+        `attrs['metadata']`, which requires pandas 1.0 or later."""
+        if not pandas:
+            raise RuntimeError('pandas is required for DataFrame export!')
+        columns = self._get_columns(since)
+        df = pandas.DataFrame(dict(
+            (tsid, pandas.Series(dict(samples)))
+            for tsid, samples in columns.items()))
+        df.attrs['metadata'] = self.get_metadata(columns.keys())
+        return df
+
+    def to_arrow(self, since=None):
+        """Export the accumulated data to an Arrow table with a 'timestamp'
+        column and one column per timeseries.
+
+        If `since` is given, only data strictly after that timestamp is
+        exported. Each timeseries column carries its metadata properties as
+        Arrow field metadata."""
+        if not pyarrow:
+            raise RuntimeError('pyarrow is required for Arrow export!')
+        columns = self._get_columns(since)
+        timestamps = [ts for ts in self._timestamps
+                      if since is None or ts > since]
+        fields = [pyarrow.field('timestamp', pyarrow.int64())]
+        arrays = [pyarrow.array(timestamps, type=pyarrow.int64())]
+        metadata = self.get_metadata(columns.keys())
+        for tsid in sorted(columns.keys()):
+            values = dict(columns[tsid])
+            arrays.append(pyarrow.array([values.get(ts)
+                                         for ts in timestamps]))
+            properties = metadata.get(tsid) or {}
+            fields.append(pyarrow.field(
+                tsid, arrays[-1].type,
+                metadata=dict((k, str(v)) for k, v in properties.items())))
+        return pyarrow.Table.from_arrays(arrays,
+                                         schema=pyarrow.schema(fields))
+
+    def _get_columns(self, since):
+        columns = {}
+        if not self._timestamps:
+            return columns
+        for tsid in self._series.keys():
+            samples = self.get_series(tsid, since)
+            if samples:
+                columns[tsid] = samples
+        return columns
+
+
+def _timestamp(sample):
+    return sample[0]
+
+
+def _insert(buf, item, key=None):
+    """Add the given item to a buffer ordered by logical timestamp (the
+    item itself, or its key), replacing any item for the same timestamp.
+    Items for a new latest timestamp are appended; others are inserted in
+    place, searching from the end of the buffer. Returns False if the item
+    was dropped for being older than anything the full buffer retains."""
+    key = key or (lambda x: x)
+    ts = key(item)
+    if not buf or key(buf[-1]) < ts:
+        buf.append(item)
+        return True
+    i = len(buf)
+    while i and key(buf[i - 1]) > ts:
+        i -= 1
+    if i and key(buf[i - 1]) == ts:
+        buf[i - 1] = item
+        return True
+    if len(buf) == buf.maxlen:
+        if not i:
+            return False
+        buf.popleft()
+        i -= 1
+    # Like deque.insert(), which Python 2 lacks.
+    buf.rotate(-i)
+    buf.appendleft(item)
+    buf.rotate(i)
+    return True
@@ -0,0 +1,138 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+"""WebSocket backends for the SignalFlow WebSocket transport.
+
+A backend takes care of the WebSocket framing and I/O of the connection;
+everything else (authentication, channel routing, message decoding,
+reconnection) is handled by the transport, which the backend calls back on
+its connection's events:
+
+  - opened(), when the connection is opened;
+  - received_data(data, is_binary), for each message received;
+  - closed(code, reason), when the connection is closed or could not be
+    opened;
+  - unhandled_error(error), on errors that will cause it to be closed.
+
+Backends are constructed with the WebSocket URL and the transport to call
+back, and must provide connect(), which opens the connection without waiting
+for it to be opened, send(data) and close(code, reason). Callbacks are made
+from the backend's own I/O thread, and block its reading of the connection.
+"""
+
+import logging
+import threading
+import ws4py
+from ws4py.client.threadedclient import WebSocketClient
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+try:
+    from ._websockets import WebSocketsBackend
+except (ImportError, SyntaxError):
+    WebSocketsBackend = None
+
+_logger = logging.getLogger(__name__)
+
+
+class Ws4pyBackend(WebSocketClient):
+    """WebSocket backend based on ws4py's threaded client."""
+
+    name = 'ws4py'
+    version = ws4py.__version__
+
+    def __init__(self, url, handler):
+        WebSocketClient.__init__(self, url, heartbeat_freq=None)
+        self._handler = handler
+
+    def opened(self):
+        self._handler.opened()
+
+    def received_message(self, message):
+        self._handler.received_data(message.data, message.is_binary)
+
+    def closed(self, code, reason=None):
+        self._handler.closed(code, reason)
+
+    def unhandled_error(self, error):
+        self._handler.unhandled_error(error)
+
+
+class WebSocketClientBackend(object):
+    """WebSocket backend based on the websocket-client library, with the
+    connection running on its own thread."""
+
+    name = 'websocket-client'
+
+    def __init__(self, url, handler):
+        if not websocket:
+            raise RuntimeError('websocket-client is not installed!')
+        self._handler = handler
+        self._app = websocket.WebSocketApp(url,
+                                           on_open=self._on_open,
+                                           on_data=self._on_data,
+                                           on_error=self._on_error,
+                                           on_close=self._on_close)
+
+    @property
+    def version(self):
+        return websocket.__version__
+
+    def connect(self):
+        t = threading.Thread(target=self._app.run_forever,
+                             kwargs={'skip_utf8_validation': True},
+                             name='SignalFlowWebSocketClient')
+        t.daemon = True
+        t.start()
+
+    def send(self, data):
+        self._app.send(data)
+
+    def close(self, code=1000, reason=None):
+        self._app.close(status=code,
+                        reason=(reason or '').encode('utf-8'))
+
+    def _on_open(self, app):
+        self._handler.opened()
+
+    def _on_data(self, app, data, opcode, fin):
+        self._handler.received_data(
+            data, opcode == websocket.ABNF.OPCODE_BINARY)
+
+    def _on_error(self, app, error):
+        self._handler.unhandled_error(error)
+
+    def _on_close(self, app, code=None, reason=None):
+        self._handler.closed(code or 1006, reason)
+
+
+BACKENDS = {
+    Ws4pyBackend.name: Ws4pyBackend,
+    WebSocketClientBackend.name: WebSocketClientBackend,
+}
+if WebSocketsBackend:
+    BACKENDS[WebSocketsBackend.name] = WebSocketsBackend
+
+
+def get_backend(backend):
+    """Return the backend class of the given name, or the given backend class
+    itself."""
+    if backend is None:
+        return Ws4pyBackend
+    if isinstance(backend, type):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError('Unknown WebSocket backend {0}!'.format(backend))
+    return BACKENDS[backend]
+
+
+def available_backends():
+    """Return the names of the backends whose library is installed."""
+    available = [Ws4pyBackend.name]
+    if websocket:
+        available.append(WebSocketClientBackend.name)
+    if WebSocketsBackend and WebSocketsBackend.available():
+        available.append(WebSocketsBackend.name)
+    return available
@@ -0,0 +1,109 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import collections
+import logging
+
+from . import computation, messages
+
+_logger = logging.getLogger(__name__)
+
+
+class Backfill(object):
+    """Parallel, time-sharded execution of a historical SignalFlow
+    computation.
+
+    The [start, stop) time range is split into shards aligned on the
+    resolution, which are executed concurrently, up to parallelism at a time,
+    over the client's transport. Iterating over the backfill yields the
+    metadata, data and event messages of all the shards as if they came from
+    a single computation: data in logical timestamp order, and metadata only
+    once per timeseries.
+
+    The output of the earliest running shard is yielded as it arrives; the
+    output of later shards is buffered until all the shards before them have
+    completed. Corrections (see Computation) are yielded as they come, still
+    flagged as such, even though they are for logical timestamps that were
+    already yielded.
+
+    Shards are multiplexed with a ComputationSelector, so the client's
+    transport must support channel listeners: the WebSocket transport does,
+    the SSE transport doesn't. Shards still running when the iteration stops,
+    whether it completed, failed or was abandoned, are closed.
+    """
+
+    def __init__(self, client, program, start, stop, resolution,
+                 shard_size=None, parallelism=4, **kwargs):
+        if not resolution:
+            raise ValueError('A resolution is required to align shards!')
+        if not shard_size:
+            shard_size = (stop - start) // parallelism
+        shard_size = max(resolution,
+                         -(-shard_size // resolution) * resolution)
+
+        self._client = client
+        self._program = program
+        self._resolution = resolution
+        self._parallelism = parallelism
+        self._kwargs = kwargs
+        self._shards = [(s, min(s + shard_size, stop))
+                        for s in range(start, stop, shard_size)]
+
+    @property
+    def shards(self):
+        """The (start, stop) time ranges of the shards."""
+        return list(self._shards)
+
+    def __iter__(self):
+        selector = computation.ComputationSelector()
+        pending = collections.deque(enumerate(self._shards))
+        running = {}
+        buffers = collections.defaultdict(list)
+        completed = set()
+        current = 0
+        seen_tsids = set()
+        last_ts = None
+
+        try:
+            while current < len(self._shards):
+                while pending and len(running) < self._parallelism:
+                    index, (start, stop) = pending.popleft()
+                    c = self._client.execute(self._program, start=start,
+                                             stop=stop,
+                                             resolution=self._resolution,
+                                             **self._kwargs)
+                    running[c] = index
+                    selector.add(c)
+
+                if current not in completed:
+                    for c, message in selector.select():
+                        buffers[running[c]].append(message)
+                    live = set(selector.computations)
+                    for c in [c for c in running if c not in live]:
+                        completed.add(running.pop(c))
+
+                start, stop = self._shards[current]
+                for message in buffers.pop(current, []):
+                    if isinstance(message, messages.MetadataMessage):
+                        if message.tsid in seen_tsids:
+                            continue
+                        seen_tsids.add(message.tsid)
+                    elif isinstance(message, messages.DataMessage):
+                        ts = message.logical_timestamp_ms
+                        if ts < start or ts >= stop:
+                            continue
+                        if not message.correction:
+                            if last_ts is not None and ts <= last_ts:
+                                continue
+                            last_ts = ts
+                    elif not isinstance(message, messages.EventMessage):
+                        continue
+                    yield message
+
+                if current in completed:
+                    current += 1
+        finally:
+            for c in running:
+                try:
+                    c.close()
+                except Exception:
+                    _logger.exception('Error closing backfill shard!')
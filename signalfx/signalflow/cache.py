@@ -0,0 +1,345 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import six
+import struct
+import tempfile
+import textwrap
+import threading
+import time
+import weakref
+
+from . import channel, messages
+
+_logger = logging.getLogger(__name__)
+
+_RECORD_HEADER = struct.Struct('!cI')
+_DATA_HEADER = struct.Struct('!qI')
+_DOUBLE = struct.Struct('!d')
+_LONG = struct.Struct('!q')
+
+_JSON_RECORD = b'J'
+_DATA_RECORD = b'D'
+
+_VALUE_NONE, _VALUE_LONG, _VALUE_DOUBLE = 0, 1, 2
+
+# Weak references to the recording channels still writing a temporary file,
+# whose callbacks remove it if the channel is dropped without being closed.
+_recordings = set()
+
+
+class ResultCache(object):
+    """On-disk cache of the output of historical SignalFlow computations.
+
+    Only executions of a program over an absolute time range that is entirely
+    in the past (by at least settle_time milliseconds, to let late data come
+    in) are cached, keyed on the normalized program text and the execution
+    parameters. Results are stored as compressed files of length-prefixed
+    records, with data batches in a compact binary encoding; a computation's
+    output is only committed to the cache once it has completed normally.
+
+    When max_size (in bytes) is set, the least recently used results are
+    evicted to keep the total size of the cache under it.
+    """
+
+    _SUFFIX = '.sfc'
+
+    def __init__(self, directory, max_size=None, settle_time=15 * 60 * 1000):
+        self._directory = directory
+        self._max_size = max_size
+        self._settle_time = settle_time
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def is_cacheable(self, params):
+        """Tell whether an execution with the given parameters covers a time
+        range entirely in the past."""
+        start, stop = params.get('start'), params.get('stop')
+        if not isinstance(start, six.integer_types) or \
+                not isinstance(stop, six.integer_types):
+            return False
+        if start < 0 or stop < start:
+            return False
+        return stop <= time.time() * 1000 - self._settle_time
+
+    def key(self, program, params):
+        """Return the cache key of the given program and parameters."""
+        program = '\n'.join(line.rstrip() for line in
+                            textwrap.dedent(program).splitlines()
+                            if line.strip())
+        h = hashlib.sha1(program.encode('utf-8'))
+        h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + self._SUFFIX)
+
+    def get(self, key):
+        """Return a channel replaying the cached output for the given key, or
+        None on a cache miss."""
+        path = self._path(key)
+        try:
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except OSError:
+            return None
+        _logger.debug('SignalFlow result cache hit for %s', key)
+        return CachedComputationChannel(path)
+
+    def record(self, key, source):
+        """Wrap the given computation channel to record its output into the
+        cache under the given key as it is consumed."""
+        return RecordingComputationChannel(self, key, source)
+
+    def _commit(self, key, tmp_path):
+        os.rename(tmp_path, self._path(key))
+        if self._max_size:
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self._directory):
+                if not name.endswith(self._SUFFIX):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self._directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in entries:
+                if total <= self._max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self._directory, name))
+                    total -= size
+                except OSError:
+                    pass
+
+
+def _encode(message):
+    """Encode the given stream message into a cache record, or return None if
+    the message cannot be cached."""
+    if isinstance(message, messages.DataMessage):
+        parts = [_DATA_HEADER.pack(message.logical_timestamp_ms,
+                                   len(message.data))]
+        for tsid, value in message.data.items():
+            tsid = tsid.encode('utf-8')
+            if value is None:
+                vtype, value = _VALUE_NONE, b''
+            elif isinstance(value, float):
+                vtype, value = _VALUE_DOUBLE, _DOUBLE.pack(value)
+            else:
+                vtype, value = _VALUE_LONG, _LONG.pack(value)
+            parts.append(struct.pack('!BB', len(tsid), vtype) + tsid + value)
+        return _DATA_RECORD, b''.join(parts)
+
+    if isinstance(message, messages.MetadataMessage):
+        payload = ('metadata', {'tsId': message.tsid,
+                                'properties': message.properties})
+    elif isinstance(message, messages.ExpiredTsIdMessage):
+        payload = ('expired-tsid', {'tsId': message.tsid})
+    elif isinstance(message, messages.EventMessage):
+        payload = ('event', {'tsId': message.tsid,
+                             'timestampMs': message.timestamp_ms,
+                             'metadata': message.metadata,
+                             'properties': message.properties})
+    elif isinstance(message, messages.InfoMessage):
+        payload = ('message', {
+            'logicalTimestampMs': message.logical_timestamp_ms,
+            'message': message.message})
+    elif isinstance(message, messages.ControlMessage):
+        events = {
+            messages.StreamStartMessage: 'STREAM_START',
+            messages.JobStartMessage: 'JOB_START',
+            messages.JobProgressMessage: 'JOB_PROGRESS',
+            messages.EndOfChannelMessage: 'END_OF_CHANNEL',
+        }
+        event = events.get(type(message))
+        if not event:
+            return None
+        payload = {'event': event, 'timestampMs': message.timestamp_ms}
+        if event == 'JOB_START':
+            payload['handle'] = message.handle
+        elif event == 'JOB_PROGRESS':
+            payload['progress'] = message.progress
+        payload = ('control-message', payload)
+    else:
+        return None
+    return _JSON_RECORD, json.dumps(payload).encode('utf-8')
+
+
+def _decode(kind, payload):
+    if kind == _JSON_RECORD:
+        mtype, payload = json.loads(payload.decode('utf-8'))
+        return messages.StreamMessage.decode(mtype, payload)
+
+    ts, count = _DATA_HEADER.unpack_from(payload)
+    offset = _DATA_HEADER.size
+    data = []
+    for _ in range(count):
+        length, vtype = struct.unpack_from('!BB', payload, offset)
+        offset += 2
+        tsid = payload[offset:offset + length].decode('utf-8')
+        offset += length
+        value = None
+        if vtype == _VALUE_DOUBLE:
+            value, = _DOUBLE.unpack_from(payload, offset)
+            offset += 8
+        elif vtype == _VALUE_LONG:
+            value, = _LONG.unpack_from(payload, offset)
+            offset += 8
+        data.append({'tsId': tsid, 'value': value})
+    return messages.DataMessage(ts, data)
+
+
+class CachedComputationChannel(channel._Channel):
+    """Computation channel replaying a computation's output from the
+    cache."""
+
+    def __init__(self, path):
+        super(CachedComputationChannel, self).__init__()
+        self._file = gzip.open(path, 'rb')
+        self._ended = False
+        self._listener = None
+
+    def _read(self):
+        if self._ended:
+            raise StopIteration()
+        header = self._file.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size:
+            self._ended = True
+            self.close()
+            raise StopIteration()
+        kind, length = _RECORD_HEADER.unpack(header)
+        return _decode(kind, self._file.read(length))
+
+    def _next(self):
+        return self._read()
+
+    def poll(self, timeout=0):
+        message = self._read()
+        if self._listener:
+            # The next record, or the end of the output, is ready as well.
+            self._listener(self)
+        return message
+
+    def set_listener(self, listener):
+        self._listener = listener
+        listener(self)
+
+    def close(self):
+        self._file.close()
+
+
+class RecordingComputationChannel(channel._Channel):
+    """Computation channel recording the output of another channel into the
+    cache as it is consumed. The recording is only committed to the cache if
+    the computation's output ends normally."""
+
+    def __init__(self, cache, key, source):
+        super(RecordingComputationChannel, self).__init__()
+        self._cache = cache
+        self._key = key
+        self._source = source
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache.directory,
+                                              suffix='.tmp')
+        self._file = gzip.GzipFile(fileobj=os.fdopen(fd, 'wb'), mode='wb')
+        self._raw = self._file.fileobj
+        self._pending = [self._file, self._raw, self._tmp_path]
+        _recordings.add(weakref.ref(
+            self, lambda ref, pending=self._pending: _abandon(ref, pending)))
+
+    @property
+    def dropped(self):
+        return self._source.dropped
+
+    @property
+    def backlog(self):
+        return self._source.backlog
+
+    def _record(self, message):
+        if self._file is None:
+            return message
+        record = _encode(message)
+        if record is None:
+            self._discard()
+            return message
+        kind, payload = record
+        self._file.write(_RECORD_HEADER.pack(kind, len(payload)))
+        self._file.write(payload)
+        if isinstance(message, messages.EndOfChannelMessage):
+            self._file.close()
+            self._raw.close()
+            self._file = None
+            del self._pending[:]
+            self._cache._commit(self._key, self._tmp_path)
+        return message
+
+    def _discard(self):
+        if self._file is None:
+            return
+        self._file = None
+        _discard(self._pending)
+
+    def _next(self):
+        try:
+            message = next(self._source)
+        except StopIteration:
+            self._discard()
+            raise
+        return self._record(message)
+
+    def poll(self, timeout=0):
+        try:
+            message = self._source.poll(timeout)
+        except StopIteration:
+            self._discard()
+            raise
+        if message is None:
+            return None
+        return self._record(message)
+
+    def set_listener(self, listener):
+        self._source.set_listener(lambda source: listener(self))
+
+    def close(self):
+        self._discard()
+        self._source.close()
+
+
+def _discard(pending):
+    """Close and remove the temporary file of a recording, given as a
+    [gzip file, raw file, path] list, unless it was already done."""
+    if not pending:
+        return
+    gzip_file, raw, path = pending
+    del pending[:]
+    try:
+        gzip_file.close()
+        raw.close()
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _abandon(ref, pending):
+    _recordings.discard(ref)
+    if pending:
+        _logger.debug('Removing abandoned SignalFlow result recording %s',
+                      pending[2])
+    _discard(pending)
@@ -30,12 +30,35 @@ class _Channel(object):
     def name(self):
         return self._name
 
+    @property
+    def dropped(self):
+        """Number of data batches dropped by this channel because they were
+        not consumed fast enough."""
+        return 0
+
+    @property
+    def backlog(self):
+        """Number of received messages waiting to be consumed."""
+        return 0
+
     def __iter__(self):
         return self
 
     def __str__(self):
         return 'channel<{0}>'.format(self._name)
 
+    def poll(self, timeout=0):
+        """Return the next message if one is available within timeout
+        seconds, None otherwise. Raises StopIteration once the channel has
+        ended."""
+        raise NotImplementedError('Channel does not support polling!')
+
+    def set_listener(self, listener):
+        """Register a function to be called with this channel each time a
+        message becomes available from it. The listener is immediately called
+        once for each message already available."""
+        raise NotImplementedError('Channel does not support listeners!')
+
     def next(self):
         return self._next()
 
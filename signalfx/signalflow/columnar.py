@@ -0,0 +1,154 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import base64
+import struct
+import sys
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+_SIZES = struct.Struct('=QQQ')
+
+_VALUE_NONE, _VALUE_DOUBLE = 0, 2
+
+
+class DataColumns(object):
+    """Columnar representation of the datapoints of a data batch.
+
+    Instead of one {'tsId', 'value'} dictionary per datapoint, the batch is
+    kept as three packed columns: the timeseries IDs, as one ASCII string of
+    12 characters per ID (the 11 characters of the ID and one of padding);
+    the value types, one byte per datapoint (0 for no value, 2 for a double,
+    a long otherwise); and the values themselves, as 8-byte words in native
+    byte order, to be read as doubles or longs depending on their type.
+
+    Building the columns from a binary data message only involves slicing
+    and base64-encoding whole buffers, without a per-datapoint loop, which
+    makes them cheap to build (in a worker process) and to move around (for
+    example, through shared memory).
+    """
+
+    __slots__ = ('_tsids', '_types', '_words')
+
+    def __init__(self, tsids, types, words):
+        self._tsids = tsids
+        self._types = types
+        self._words = words
+
+    def __len__(self):
+        return len(self._types)
+
+    @staticmethod
+    def from_datapoints(data, offset, count):
+        """Build the columns of the given number of 17-byte datapoints (type,
+        8-byte ID, 8-byte big-endian value) starting at the given offset."""
+        chunk = bytes(data[offset:offset + 17 * count])
+        types = chunk[0::17]
+
+        # Padding each 8-byte ID to 9 bytes makes each of them encode to its
+        # own 12 base64 characters, in a single call for all of them.
+        ids = bytearray(9 * count)
+        for k in range(8):
+            ids[k::9] = chunk[1 + k::17]
+        tsids = base64.urlsafe_b64encode(bytes(ids))
+
+        words = bytearray(8 * count)
+        little = sys.byteorder == 'little'
+        for k in range(8):
+            words[(7 - k if little else k)::8] = chunk[9 + k::17]
+        return DataColumns(tsids, types, bytes(words))
+
+    @property
+    def types(self):
+        return self._types
+
+    def tsids(self):
+        """Return the list of timeseries IDs."""
+        s = self._tsids.decode('ascii')
+        return [s[i:i + 11] for i in range(0, len(s), 12)]
+
+    def doubles(self):
+        """Return the values as a memoryview of doubles, valid for the
+        datapoints of type 2."""
+        return memoryview(self._words).cast('d')
+
+    def longs(self):
+        """Return the values as a memoryview of longs, valid for the
+        datapoints of types other than 0 and 2."""
+        return memoryview(self._words).cast('q')
+
+    def values(self):
+        """Return the list of values, with None for datapoints without
+        one."""
+        doubles, longs = self.doubles(), self.longs()
+        return [None if t == _VALUE_NONE else
+                doubles[i] if t == _VALUE_DOUBLE else longs[i]
+                for i, t in enumerate(bytearray(self._types))]
+
+    def concat(self, other):
+        """Return the columns of these datapoints followed by those of the
+        given columns."""
+        return DataColumns(self._tsids + other._tsids,
+                           self._types + other._types,
+                           self._words + other._words)
+
+    def to_dict(self):
+        return dict(zip(self.tsids(), self.values()))
+
+    def to_list(self):
+        return [{'tsId': tsid, 'value': value}
+                for tsid, value in zip(self.tsids(), self.values())]
+
+    def to_shared_memory(self):
+        """Copy the columns into a new shared memory block, and return its
+        name. The block is to be released by from_shared_memory()."""
+        size = (_SIZES.size + len(self._tsids) + len(self._types) +
+                len(self._words))
+        shm = _create_shared_memory(size)
+        buf = shm.buf
+        try:
+            _SIZES.pack_into(buf, 0, len(self._tsids), len(self._types),
+                             len(self._words))
+            offset = _SIZES.size
+            for column in (self._tsids, self._types, self._words):
+                buf[offset:offset + len(column)] = column
+                offset += len(column)
+            return shm.name
+        finally:
+            del buf
+            shm.close()
+
+    @staticmethod
+    def from_shared_memory(name):
+        """Read columns from the shared memory block of the given name, and
+        release the block."""
+        shm = shared_memory.SharedMemory(name)
+        buf = shm.buf
+        try:
+            sizes = _SIZES.unpack_from(buf, 0)
+            offset = _SIZES.size
+            columns = []
+            for size in sizes:
+                columns.append(bytes(buf[offset:offset + size]))
+                offset += size
+            return DataColumns(*columns)
+        finally:
+            del buf
+            shm.close()
+            shm.unlink()
+
+
+def _create_shared_memory(size):
+    """Create a shared memory block that is not tracked by this process, as
+    it is released by the process that reads it."""
+    try:
+        return shared_memory.SharedMemory(create=True, size=size,
+                                          track=False)
+    except TypeError:
+        # Before Python 3.13, blocks are always tracked.
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
@@ -1,10 +1,48 @@
 # Copyright (C) 2016 SignalFx, Inc. All rights reserved.
 
-from . import errors, messages
+from six.moves import queue
+import time
+
+from . import errors, messages, metadata, stats
 
 
 class Computation(object):
-    """A live handle to a running SignalFlow computation."""
+    """A live handle to a running SignalFlow computation.
+
+    The metadata of the computation's output timeseries is kept in a compact
+    metadata.MetadataStore, optionally capped to metadata_size timeseries.
+
+    The lag of the computation's output, as received by the client, is
+    tracked in a stats.StreamStats available from the stats property.
+
+    Data batches are held in a reorder buffer until all the batches for the
+    same logical timestamp have been received, and released in logical
+    timestamp order. Batches may arrive out of order within a reorder window
+    behind the most recent logical timestamp received: the computation's
+    maxDelayMs, capped to one resolution once the resolution is known (the
+    server only emits a logical timestamp once its maxDelayMs has passed, so
+    its batches arrive close together). Logical timestamps that fall behind
+    that window are closed, releasing whatever data was received for them,
+    flagged as incomplete if batches are missing. The number of batches to
+    expect per logical timestamp is detected from the first logical
+    timestamp to be closed, as the largest number of batches received for
+    any of them so far, regardless of the order in which they arrived.
+
+    Complete logical timestamps are released as soon as their last batch is
+    received. An incomplete one however is only closed by data newer than
+    the reorder window: with a maxDelayMs of at least one resolution, data
+    two resolutions newer, which adds up to two resolutions of latency. With a
+    release_timeout (in seconds), the data received for a logical timestamp
+    is also released, flagged as incomplete, if the remaining batches are not
+    received within release_timeout of the first one, which bounds that
+    latency on the wall clock. Batches received for a logical timestamp
+    whose data has already been released are yielded on their own, flagged
+    as corrections.
+
+    Computations are normally consumed through stream(). Consumers driving
+    them otherwise, like ComputationSelector, release the data batches held
+    back with release_due(), no later than release_deadline.
+    """
 
     STATE_UNKNOWN = 0
     STATE_STREAM_STARTED = 1
@@ -13,7 +51,7 @@ class Computation(object):
     STATE_COMPLETED = 4
     STATE_ABORTED = 5
 
-    def __init__(self, exec_fn):
+    def __init__(self, exec_fn, metadata_size=None, release_timeout=None):
         self._id = None
         self._exec_fn = exec_fn
 
@@ -22,13 +60,18 @@ class Computation(object):
         self._resolution = None
         self._num_input_timeseries = 0
 
-        self._metadata = {}
+        self._metadata = metadata.MetadataStore(metadata_size)
         self._last_logical_ts = None
+        self._dropped_batches = 0
+        self._stats = stats.StreamStats()
 
         self._expected_batches = 0
         self._batch_count_detected = False
-        self._current_batch_message = None
-        self._current_batch_count = 0
+        # Logical timestamp -> [message, batch count, time first received].
+        self._pending_batches = {}
+        self._max_logical_ts = None
+        self._max_delay_ms = None
+        self._release_timeout = release_timeout
 
         self._find_matched_no_timeseries = False
 
@@ -45,6 +88,10 @@ class Computation(object):
     def _execute(self):
         return self._exec_fn(self._last_logical_ts)
 
+    def _reexecute(self):
+        self._dropped_batches += getattr(self._stream, 'dropped', 0)
+        self._stream = self._execute()
+
     @property
     def id(self):
         return self._id
@@ -65,6 +112,24 @@ class Computation(object):
     def last_logical_ts(self):
         return self._last_logical_ts
 
+    @property
+    def dropped_batches(self):
+        """Number of data batches dropped from this computation's output
+        because they were not consumed fast enough."""
+        return (self._dropped_batches +
+                getattr(self._stream, 'dropped', 0))
+
+    @property
+    def stats(self):
+        """The stats.StreamStats of the computation's output stream."""
+        return self._stats
+
+    @property
+    def backlog(self):
+        """Number of received messages waiting to be consumed from this
+        computation's output."""
+        return getattr(self._stream, 'backlog', 0)
+
     @property
     def find_matched_no_timeseries(self):
         return self._find_matched_no_timeseries
@@ -100,7 +165,7 @@ class Computation(object):
             self._stream = None
 
     def get_known_tsids(self):
-        return sorted(self._metadata.keys())
+        return sorted(self._metadata.tsids())
 
     def get_metadata(self, tsid):
         """Return the full metadata object for the given timeseries (by its
@@ -119,90 +184,163 @@ class Computation(object):
         iterator = iter(self._stream)
         while self._state < Computation.STATE_COMPLETED:
             try:
-                message = next(iterator)
+                message = self._next_message(iterator)
             except StopIteration:
                 if self._state < Computation.STATE_COMPLETED:
-                    self._stream = self._execute()
+                    self._reexecute()
                     iterator = iter(self._stream)
                     continue
                 break
 
-            if isinstance(message, messages.StreamStartMessage):
-                self._state = Computation.STATE_STREAM_STARTED
-                continue
-
-            if isinstance(message, messages.JobStartMessage):
-                self._state = Computation.STATE_COMPUTATION_STARTED
-                self._id = message.handle
-                yield message
-                continue
-
-            if isinstance(message, messages.JobProgressMessage):
-                yield message
-                continue
-
-            if isinstance(message, messages.ChannelAbortMessage):
-                self._state = Computation.STATE_ABORTED
-                raise errors.ComputationAborted(message.abort_info)
-
-            if isinstance(message, messages.EndOfChannelMessage):
-                self._state = Computation.STATE_COMPLETED
-                continue
-
-            # Intercept metadata messages to accumulate received metadata...
-            if isinstance(message, messages.MetadataMessage):
-                self._metadata[message.tsid] = message.properties
-                yield message
-                continue
-
-            # ...as well as expired-tsid messages to clean it up.
-            if isinstance(message, messages.ExpiredTsIdMessage):
-                if message.tsid in self._metadata:
-                    del self._metadata[message.tsid]
-                yield message
-                continue
-
-            if isinstance(message, messages.InfoMessage):
-                self._process_info_message(message.message)
+            for output in self._handle_message(message):
+                yield output
+            for output in self.release_due():
+                yield output
+
+        for output in self.release_due(ended=True):
+            yield output
+
+    def _handle_message(self, message):
+        """Handle a message received from the computation's channel, and
+        return the list of messages to yield back to the consumer as a
+        result."""
+        if isinstance(message, messages.StreamStartMessage):
+            self._state = Computation.STATE_STREAM_STARTED
+            return []
+
+        if isinstance(message, messages.JobStartMessage):
+            self._state = Computation.STATE_COMPUTATION_STARTED
+            self._id = message.handle
+            return [message]
+
+        if isinstance(message, messages.JobProgressMessage):
+            return [message]
+
+        if isinstance(message, messages.ChannelAbortMessage):
+            self._state = Computation.STATE_ABORTED
+            raise errors.ComputationAborted(message.abort_info)
+
+        if isinstance(message, messages.EndOfChannelMessage):
+            self._state = Computation.STATE_COMPLETED
+            return []
+
+        # Intercept metadata messages to accumulate received metadata...
+        if isinstance(message, messages.MetadataMessage):
+            self._metadata.put(message.tsid, message.properties)
+            return [message]
+
+        # ...as well as expired-tsid messages to clean it up.
+        if isinstance(message, messages.ExpiredTsIdMessage):
+            self._metadata.remove(message.tsid)
+            return [message]
+
+        if isinstance(message, messages.InfoMessage):
+            self._process_info_message(message.message)
+            self._batch_count_detected = True
+            return [message] + self._release_ready()
+
+        if isinstance(message, messages.DataMessage):
+            self._state = Computation.STATE_DATA_RECEIVED
+            self._stats.record(message)
+            return self._handle_data_message(message)
+
+        if isinstance(message, messages.EventMessage):
+            return [message]
+
+        if isinstance(message, messages.ErrorMessage):
+            raise errors.ComputationFailed(message.errors)
+
+        return []
+
+    def _handle_data_message(self, message):
+        """Add the given data message to the reorder buffer, and return the
+        data batches that can be released as a result."""
+        ts = message.logical_timestamp_ms
+        if self._last_logical_ts is not None and ts <= self._last_logical_ts:
+            # Data for this logical timestamp was already released.
+            message.correction = True
+            return [message]
+
+        pending = self._pending_batches.get(ts)
+        if pending:
+            columns = message.columns
+            pending[0].add_data(message.data if columns is None else columns)
+            pending[1] += 1
+        else:
+            pending = [message, 1, time.time()]
+            self._pending_batches[ts] = pending
+        if not self._batch_count_detected:
+            self._expected_batches = max(self._expected_batches, pending[1])
+
+        if message.max_delay_ms is not None:
+            self._max_delay_ms = message.max_delay_ms
+        if self._max_logical_ts is None or ts > self._max_logical_ts:
+            self._max_logical_ts = ts
+        return self._release_ready()
+
+    @property
+    def _watermark(self):
+        """The logical timestamp below which no more data is expected."""
+        if self._max_logical_ts is None:
+            return None
+        window = self._max_delay_ms or 0
+        if self._resolution:
+            window = min(window, self._resolution)
+        return self._max_logical_ts - window
+
+    def _release_ready(self, until=None):
+        """Release, in logical timestamp order, the pending data batches that
+        are complete or closed by the watermark, as well as all those up to
+        the given logical timestamp."""
+        output = []
+        watermark = self._watermark
+        while self._pending_batches:
+            ts = min(self._pending_batches)
+            closed = ts < watermark or (until is not None and ts <= until)
+            if closed:
                 self._batch_count_detected = True
-                yield message
-                if self._current_batch_message:
-                    yield self._get_batch_to_yield()
-                continue
-
-            # Accumulate data messages and release them when we have received
-            # all batches for the same logical timestamp.
-            if isinstance(message, messages.DataMessage):
-                self._state = Computation.STATE_DATA_RECEIVED
-
-                if not self._batch_count_detected:
-                    self._expected_batches += 1
-
-                if not self._current_batch_message:
-                    self._current_batch_message = message
-                    self._current_batch_count = 1
-                elif (message.logical_timestamp_ms ==
-                        self._current_batch_message.logical_timestamp_ms):
-                    self._current_batch_message.add_data(message.data)
-                    self._current_batch_count += 1
-                else:
-                    self._batch_count_detected = True
-
-                if (self._batch_count_detected and
-                        self._current_batch_count == self._expected_batches):
-                    yield self._get_batch_to_yield()
-                continue
-
-            if isinstance(message, messages.EventMessage):
-                yield message
-                continue
-
-            if isinstance(message, messages.ErrorMessage):
-                raise errors.ComputationFailed(message.errors)
-
-        # Yield last batch, even if potentially incomplete.
-        if self._current_batch_message:
-            yield self._get_batch_to_yield()
+            elif not (self._batch_count_detected and
+                      self._pending_batches[ts][1] >= self._expected_batches):
+                break
+            output.append(self._pop_batch(ts))
+        return output
+
+    @property
+    def release_deadline(self):
+        """The time at which the earliest pending data batch is due for
+        release, if there is a release timeout."""
+        if self._release_timeout is None or not self._pending_batches:
+            return None
+        return (min(p[2] for p in self._pending_batches.values()) +
+                self._release_timeout)
+
+    def _next_message(self, iterator):
+        """Return the next message from the computation's channel, waiting
+        no later than the release deadline of the pending data batches if
+        the channel supports it (returning None then)."""
+        deadline = self.release_deadline
+        if deadline is None or not hasattr(self._stream, 'poll'):
+            return next(iterator)
+        try:
+            return self._stream.poll(max(0, deadline - time.time()))
+        except NotImplementedError:
+            return next(iterator)
+
+    def release_due(self, ended=False):
+        """Return the pending data batches whose release deadline has passed,
+        along with those before them. Once the computation's output has
+        ended, pass ended=True to get all the remaining ones, even if
+        potentially incomplete."""
+        if ended:
+            if self._pending_batches:
+                return self._release_ready(max(self._pending_batches))
+            return []
+        deadline = self.release_deadline
+        if deadline is None or time.time() < deadline:
+            return []
+        due = time.time() - self._release_timeout
+        return self._release_ready(max(
+            ts for ts, p in self._pending_batches.items() if p[2] <= due))
 
     def _process_info_message(self, message):
         """Process an information message received from the computation."""
@@ -223,9 +361,110 @@ class Computation(object):
             self._group_by_missing_property = True
             self._group_by_missing_properties = contents['propertyNames']
 
-    def _get_batch_to_yield(self):
-        to_yield = self._current_batch_message
-        self._current_batch_message = None
-        self._current_batch_count = 0
-        self._last_logical_ts = to_yield.logical_timestamp_ms
-        return to_yield
+    def _pop_batch(self, ts):
+        message, count, _ = self._pending_batches.pop(ts)
+        message.incomplete = (self._batch_count_detected and
+                              count < self._expected_batches)
+        self._last_logical_ts = ts
+        return message
+
+
+class ComputationSelector(object):
+    """Multiplexes the output of many computations into a single stream.
+
+    Instead of blocking one thread per computation on Computation.stream(),
+    the selector is notified by the computations' channels as messages become
+    available, and processes them on the consuming thread. Iterating over the
+    selector yields (computation, message) pairs, with messages as they would
+    be yielded by each computation's stream(), until all the computations have
+    completed. Computations that are added to a selector must not also be
+    streamed from directly.
+
+    Only channels that support listeners, like the WebSocket transport's, can
+    be selected over.
+    """
+
+    def __init__(self, computations=None):
+        self._ready = queue.Queue()
+        self._computations = {}
+        for c in computations or []:
+            self.add(c)
+
+    def __len__(self):
+        return len(self._computations)
+
+    def __iter__(self):
+        while self._computations:
+            for selected in self.select():
+                yield selected
+
+    @property
+    def computations(self):
+        """The computations that have not completed yet."""
+        return list(self._computations.values())
+
+    def add(self, computation):
+        """Add a computation to this selector."""
+        self._computations[computation._stream] = computation
+        computation._stream.set_listener(self._ready.put)
+
+    def select(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for output from the
+        computations, and return the (computation, message) pairs that are
+        ready.
+
+        If a computation fails or is aborted, it is removed from the selector
+        and the corresponding exception raised; the other computations can
+        still be selected over.
+
+        Data batches of computations with a release timeout are released when
+        due, even if no new output was received."""
+        selected = []
+        deadlines = [c.release_deadline
+                     for c in self._computations.values()
+                     if c.release_deadline is not None]
+        wait = timeout
+        if deadlines:
+            wait = max(0, min(deadlines) - time.time())
+            if timeout is not None:
+                wait = min(wait, timeout)
+        try:
+            channel = self._ready.get(timeout=wait)
+        except queue.Empty:
+            return self._release()
+        while True:
+            selected.extend(self._step(channel))
+            try:
+                channel = self._ready.get_nowait()
+            except queue.Empty:
+                return selected + self._release()
+
+    def _release(self):
+        return [(c, m) for c in list(self._computations.values())
+                for m in c.release_due()]
+
+    def _step(self, channel):
+        computation = self._computations.get(channel)
+        if computation is None:
+            return []
+
+        try:
+            message = channel.poll()
+        except StopIteration:
+            del self._computations[channel]
+            if computation.state < Computation.STATE_COMPLETED:
+                computation._reexecute()
+                self.add(computation)
+                return []
+            return [(computation, m)
+                    for m in computation.release_due(ended=True)]
+        except Exception:
+            del self._computations[channel]
+            raise
+
+        try:
+            return [(computation, m)
+                    for m in computation._handle_message(message)]
+        except Exception:
+            del self._computations[channel]
+            raise
@@ -67,3 +67,19 @@ class ComputationFailed(Exception):
 
     def __str__(self):
         return 'Computation failed ({0})'.format(self._errors)
+
+
+class TooManyStreams(Exception):
+    """Exception thrown when a computation stream can't be opened because all
+    the streaming connections the client allows are in use."""
+
+    def __init__(self, max_streams):
+        self._max_streams = max_streams
+
+    @property
+    def max_streams(self):
+        return self._max_streams
+
+    def __str__(self):
+        return 'All {0} streaming connections are in use'.format(
+            self._max_streams)
@@ -0,0 +1,123 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import heapq
+import logging
+import random
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class KeepaliveScheduler(object):
+    """Keeps background SignalFlow computations alive.
+
+    A single thread, driven by a heap of due times, sends the keepalive
+    requests for all the scheduled computation handles through the given
+    transport. Keepalives that are due at the same time are sent together in
+    one pass. Each handle's keepalives are spread over time with some jitter
+    so they don't all fall due at once.
+
+    Handles whose last keepalive failed are reported by failed, with the
+    corresponding exception; they remain scheduled and are removed from
+    failed once a keepalive succeeds again.
+    """
+
+    _THREAD_NAME = 'SignalFlowKeepaliveThread'
+
+    DEFAULT_INTERVAL = 60
+
+    def __init__(self, transport, interval=DEFAULT_INTERVAL, jitter=0.1):
+        self._transport = transport
+        self._interval = interval
+        self._jitter = jitter
+
+        self._heap = []
+        self._due = {}
+        self._failed = {}
+        self._cv = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    @property
+    def handles(self):
+        """The computation handles being kept alive."""
+        with self._cv:
+            return sorted(self._due.keys())
+
+    @property
+    def failed(self):
+        """A dictionary of the computation handles whose last keepalive
+        failed, to the corresponding exception."""
+        with self._cv:
+            return dict(self._failed)
+
+    def add(self, handle):
+        """Start keeping alive the computation with the given handle. Its
+        first keepalive is sent at a random time within the interval."""
+        with self._cv:
+            if self._stopped:
+                raise RuntimeError('Keepalive scheduler is closed!')
+            self._schedule(handle,
+                           time.time() + random.random() * self._interval)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name=self._THREAD_NAME)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cv.notify()
+
+    def remove(self, handle):
+        """Stop keeping alive the computation with the given handle."""
+        with self._cv:
+            # The heap entry is left behind, and ignored when it's due.
+            self._due.pop(handle, None)
+            self._failed.pop(handle, None)
+
+    def close(self):
+        """Stop the scheduler's thread. No more keepalives are sent."""
+        with self._cv:
+            self._stopped = True
+            self._cv.notify()
+        if self._thread:
+            self._thread.join()
+
+    def _schedule(self, handle, due):
+        self._due[handle] = due
+        heapq.heappush(self._heap, (due, handle))
+
+    def _next_interval(self):
+        return self._interval * random.uniform(1 - self._jitter, 1)
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._stopped:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cv.wait(self._heap[0][0] - now
+                                  if self._heap else None)
+                if self._stopped:
+                    return
+
+                handles = []
+                while self._heap and self._heap[0][0] <= now:
+                    due, handle = heapq.heappop(self._heap)
+                    if self._due.get(handle) != due:
+                        continue
+                    handles.append(handle)
+                    self._schedule(handle, now + self._next_interval())
+
+            _logger.debug('Sending %d keepalive(s).', len(handles))
+            for handle in handles:
+                try:
+                    self._transport.keepalive(handle)
+                except Exception as e:
+                    _logger.warning('Keepalive of %s failed: %s', handle, e)
+                    with self._cv:
+                        if handle in self._due:
+                            self._failed[handle] = e
+                else:
+                    with self._cv:
+                        self._failed.pop(handle, None)
@@ -1,30 +1,28 @@
 # Copyright (C) 2016 SignalFx, Inc. All rights reserved.
 
+import collections
 import logging
 
+from . import columnar
+
 _logger = logging.getLogger(__name__)
 
 
 class StreamMessage(object):
     """Base class for stream messages received from a SignalFlow
-    computation."""
+    computation.
+
+    Messages are decoded through a lookup table of decoders by message type
+    (see _STREAM_MESSAGE_DECODERS at the end of this module), and store their
+    fields in __slots__ rather than in a per-instance dictionary."""
+
+    __slots__ = ()
 
     @staticmethod
     def decode(mtype, payload):
-        if mtype == 'control-message':
-            return ControlMessage.decode(payload)
-        if mtype == 'message':
-            return InfoMessage.decode(payload)
-        if mtype == 'event':
-            return EventMessage.decode(payload)
-        if mtype == 'metadata':
-            return MetadataMessage.decode(payload)
-        if mtype == 'expired-tsid':
-            return ExpiredTsIdMessage.decode(payload)
-        if mtype == 'data':
-            return DataMessage.decode(payload)
-        if mtype == 'error':
-            return ErrorMessage.decode(payload)
+        decoder = _STREAM_MESSAGE_DECODERS.get(mtype)
+        if decoder:
+            return decoder(payload)
         _logger.warn('Unsupported event type; ignoring %s: %s!',
                      mtype, payload)
         return None
@@ -33,6 +31,8 @@ class StreamMessage(object):
 class ControlMessage(StreamMessage):
     """Base class for control messages."""
 
+    __slots__ = ('_timestamp_ms',)
+
     def __init__(self, timestamp_ms):
         self._timestamp_ms = timestamp_ms
 
@@ -43,16 +43,9 @@ class ControlMessage(StreamMessage):
 
     @staticmethod
     def decode(payload):
-        if payload['event'] == 'STREAM_START':
-            return StreamStartMessage.decode(payload)
-        if payload['event'] == 'JOB_START':
-            return JobStartMessage.decode(payload)
-        if payload['event'] == 'JOB_PROGRESS':
-            return JobProgressMessage.decode(payload)
-        if payload['event'] == 'CHANNEL_ABORT':
-            return ChannelAbortMessage.decode(payload)
-        if payload['event'] == 'END_OF_CHANNEL':
-            return EndOfChannelMessage.decode(payload)
+        decoder = _CONTROL_MESSAGE_DECODERS.get(payload['event'])
+        if decoder:
+            return decoder(payload)
         _logger.warn('Unsupported control message %s; ignoring!',
                      payload['event'])
         return None
@@ -61,6 +54,8 @@ class ControlMessage(StreamMessage):
 class StreamStartMessage(ControlMessage):
     """Message received when the stream begins."""
 
+    __slots__ = ()
+
     def __init__(self, timestamp_ms):
         super(StreamStartMessage, self).__init__(timestamp_ms)
 
@@ -72,6 +67,8 @@ class StreamStartMessage(ControlMessage):
 class JobStartMessage(ControlMessage):
     """Message received when the SignalFlow computation has started."""
 
+    __slots__ = ('_handle',)
+
     def __init__(self, timestamp_ms, handle):
         super(JobStartMessage, self).__init__(timestamp_ms)
         self._handle = handle
@@ -91,6 +88,8 @@ class JobProgressMessage(ControlMessage):
     present. The message will be received multiple times with increasing
     progress values from 0 to 100, indicating the progress percentage."""
 
+    __slots__ = ('_progress',)
+
     def __init__(self, timestamp_ms, progress):
         super(JobProgressMessage, self).__init__(timestamp_ms)
         self._progress = progress
@@ -110,6 +109,8 @@ class ChannelAbortMessage(ControlMessage):
     time, either because of an error or from a manual stop. No further messages
     will be received from a computation after this one."""
 
+    __slots__ = ('_abort_info',)
+
     def __init__(self, timestamp_ms, abort_info):
         super(ChannelAbortMessage, self).__init__(timestamp_ms)
         self._abort_info = abort_info
@@ -129,6 +130,8 @@ class EndOfChannelMessage(ControlMessage):
     """Message received when the computation completes normally. No further
     messages will be received from a computation after this one."""
 
+    __slots__ = ()
+
     def __init__(self, timestamp_ms):
         super(EndOfChannelMessage, self).__init__(timestamp_ms)
 
@@ -141,6 +144,8 @@ class InfoMessage(StreamMessage):
     """Message containing information about the SignalFlow computation's
     behavior or decisions."""
 
+    __slots__ = ('_logical_timestamp_ms', '_message')
+
     def __init__(self, logical_timestamp_ms, message):
         self._logical_timestamp_ms = logical_timestamp_ms
         self._message = message
@@ -166,6 +171,8 @@ class EventMessage(StreamMessage):
     """Message received when the computation has generated an event or alert
     from a detect block."""
 
+    __slots__ = ('_tsid', '_timestamp_ms', '_metadata', '_properties')
+
     def __init__(self, tsid, timestamp_ms, metadata, properties):
         self._tsid = tsid
         self._timestamp_ms = timestamp_ms
@@ -208,6 +215,8 @@ class MetadataMessage(StreamMessage):
     timeseries. Metadata messages are always emitted by the computation prior
     to any data or events for the corresponding timeseries."""
 
+    __slots__ = ('_tsid', '_properties')
+
     def __init__(self, tsid, properties):
         self._tsid = tsid
         self._properties = properties
@@ -232,6 +241,8 @@ class ExpiredTsIdMessage(StreamMessage):
     computation and that we may do some cleanup of whatever internal state we
     have tied to that output timeseries."""
 
+    __slots__ = ('_tsid',)
+
     def __init__(self, tsid):
         self._tsid = tsid
 
@@ -246,13 +257,40 @@ class ExpiredTsIdMessage(StreamMessage):
         return ExpiredTsIdMessage(payload['tsId'])
 
 
+class BatchTiming(collections.namedtuple('BatchTiming', [
+        'received_ms', 'decode_ms', 'dequeued_ms', 'clock_skew_ms'])):
+    """Timing of the reception of a data batch by the client, in
+    milliseconds: received_ms is the local time at which the batch was read
+    off the connection, decode_ms the time it took to decode it, dequeued_ms
+    the local time at which it was handed over to the consumer, and
+    clock_skew_ms the difference between the local clock and the server's as
+    of the last keepalive (which includes the network delay)."""
+
+    __slots__ = ()
+
+
 class DataMessage(StreamMessage):
     """Message containing a batch of datapoints generated for a particular
-    iteration."""
+    iteration.
+
+    The datapoints may be given as a columnar.DataColumns, in which case they
+    are only converted to a dictionary when the data is accessed; they
+    remain available as columns from the columns property until then."""
 
-    def __init__(self, logical_timestamp_ms, data):
+    __slots__ = ('_logical_timestamp_ms', '_data', '_max_delay_ms', '_timing',
+                 '_incomplete', '_correction')
+
+    def __init__(self, logical_timestamp_ms, data, max_delay_ms=None,
+                 timing=None):
         self._logical_timestamp_ms = logical_timestamp_ms
-        self._data = dict((datum['tsId'], datum['value']) for datum in data)
+        if isinstance(data, columnar.DataColumns):
+            self._data = data
+        else:
+            self._data = {datum['tsId']: datum['value'] for datum in data}
+        self._max_delay_ms = max_delay_ms
+        self._timing = timing
+        self._incomplete = False
+        self._correction = False
 
     @property
     def logical_timestamp_ms(self):
@@ -262,20 +300,78 @@ class DataMessage(StreamMessage):
     @property
     def data(self):
         """The data, as a dictionary of timeseries ID to datapoint value."""
+        if isinstance(self._data, columnar.DataColumns):
+            self._data = self._data.to_dict()
         return self._data
 
+    @property
+    def columns(self):
+        """The data as a columnar.DataColumns, if it was received as such and
+        hasn't been accessed as a dictionary yet; None otherwise."""
+        if isinstance(self._data, columnar.DataColumns):
+            return self._data
+        return None
+
+    @property
+    def max_delay_ms(self):
+        """The maximum delay the computation waited for data for this
+        logical timestamp, if known (millisecond precision)."""
+        return self._max_delay_ms
+
+    @property
+    def timing(self):
+        """The BatchTiming of this batch's reception by the client, if the
+        transport recorded it."""
+        return self._timing
+
+    @property
+    def incomplete(self):
+        """Whether this data was released before all the batches for its
+        logical timestamp were received. The missing data may come later, in
+        correction messages."""
+        return self._incomplete
+
+    @incomplete.setter
+    def incomplete(self, incomplete):
+        self._incomplete = incomplete
+
+    @property
+    def correction(self):
+        """Whether this data was received after data for the same logical
+        timestamp was already released, and completes it."""
+        return self._correction
+
+    @correction.setter
+    def correction(self, correction):
+        self._correction = correction
+
     def add_data(self, data):
-        self._data.update(data)
+        """Add the given datapoints, a dictionary or columns, to this
+        batch. Columns added to columns are kept as columns."""
+        if isinstance(data, columnar.DataColumns):
+            if isinstance(self._data, columnar.DataColumns):
+                self._data = self._data.concat(data)
+                return
+            data = data.to_dict()
+        self.data.update(data)
 
     @staticmethod
     def decode(payload):
-        return DataMessage(payload['logicalTimestampMs'], payload['data'])
+        timing = None
+        if 'receivedMs' in payload:
+            timing = BatchTiming(payload['receivedMs'], payload['decodeMs'],
+                                 payload.get('dequeuedMs'),
+                                 payload.get('clockSkewMs'))
+        return DataMessage(payload['logicalTimestampMs'], payload['data'],
+                           payload.get('maxDelayMs'), timing)
 
 
 class ErrorMessage(StreamMessage):
     """Message received when the computation encounters errors during its
     initialization."""
 
+    __slots__ = ('_errors',)
+
     def __init__(self, errors):
         self._errors = errors
 
@@ -288,3 +384,22 @@ class ErrorMessage(StreamMessage):
     @staticmethod
     def decode(payload):
         return ErrorMessage(payload['errors'])
+
+
+_STREAM_MESSAGE_DECODERS = {
+    'control-message': ControlMessage.decode,
+    'message': InfoMessage.decode,
+    'event': EventMessage.decode,
+    'metadata': MetadataMessage.decode,
+    'expired-tsid': ExpiredTsIdMessage.decode,
+    'data': DataMessage.decode,
+    'error': ErrorMessage.decode,
+}
+
+_CONTROL_MESSAGE_DECODERS = {
+    'STREAM_START': StreamStartMessage.decode,
+    'JOB_START': JobStartMessage.decode,
+    'JOB_PROGRESS': JobProgressMessage.decode,
+    'CHANNEL_ABORT': ChannelAbortMessage.decode,
+    'END_OF_CHANNEL': EndOfChannelMessage.decode,
+}
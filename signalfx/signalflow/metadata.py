@@ -0,0 +1,127 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import collections
+import six
+
+
+class MetadataStore(object):
+    """Compact store of the metadata of a computation's output timeseries.
+
+    The metadata properties of timeseries from the same computation tend to
+    repeat the same property names and many of the same values. Instead of
+    keeping one properties dictionary per timeseries, the store keeps a shared
+    tuple of property names for each distinct set of names, and a tuple of
+    property values per timeseries. String and list values (like sf_key)
+    are shared between timeseries. Shared names and values are reference
+    counted, and dropped when the last timeseries using them is removed or
+    evicted. (String values are not interned, as interned strings may never
+    be freed.)
+
+    The store can optionally be capped to a maximum number of timeseries, in
+    which case the least recently used timeseries are evicted first.
+
+    Properties dictionaries are rebuilt on each lookup; the list values in
+    them are shared and must not be modified.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict() if max_size else {}
+        # Shared names tuples, list values and string values, each with the
+        # number of entries referencing it: key -> [shared object, count].
+        # Unreferenced ones are dropped, so that these tables don't outgrow
+        # the entries.
+        self._names = {}
+        self._lists = {}
+        self._strings = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, tsid):
+        return tsid in self._entries
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def tsids(self):
+        return list(self._entries.keys())
+
+    def get(self, tsid):
+        """Return the metadata properties of the given timeseries, or None if
+        they are not known."""
+        entry = self._entries.get(tsid)
+        if entry is None:
+            return None
+        if self._max_size:
+            self._touch(tsid, entry)
+        names, values = entry
+        return dict(zip(names, values))
+
+    def put(self, tsid, properties):
+        """Store the metadata properties of the given timeseries, evicting the
+        least recently used timeseries if the store is full."""
+        names = tuple(properties.keys())
+        names = _acquire(self._names, names, names)
+        values = tuple(self._share(v) for v in properties.values())
+        self.remove(tsid)
+        if self._max_size:
+            while len(self._entries) >= self._max_size:
+                self._release(self._entries.popitem(last=False)[1])
+        self._entries[tsid] = (names, values)
+
+    def remove(self, tsid):
+        entry = self._entries.pop(tsid, None)
+        if entry is not None:
+            self._release(entry)
+
+    def _touch(self, tsid, entry):
+        if six.PY2:
+            del self._entries[tsid]
+            self._entries[tsid] = entry
+        else:
+            self._entries.move_to_end(tsid)
+
+    def _share(self, value):
+        if isinstance(value, six.string_types):
+            return _acquire(self._strings, value, value)
+        if isinstance(value, list):
+            try:
+                return _acquire(self._lists, tuple(value), value)
+            except TypeError:
+                return value
+        return value
+
+    def _release(self, entry):
+        """Release the shared objects referenced by the given entry."""
+        names, values = entry
+        _release(self._names, names)
+        for value in values:
+            if isinstance(value, six.string_types):
+                _release(self._strings, value)
+            elif isinstance(value, list):
+                try:
+                    _release(self._lists, tuple(value))
+                except TypeError:
+                    pass
+
+
+def _acquire(table, key, value):
+    """Return the shared object for the given key, sharing the given value
+    if there is none yet, and count one more reference to it."""
+    shared = table.get(key)
+    if shared is None:
+        shared = table[key] = [value, 0]
+    shared[1] += 1
+    return shared[0]
+
+
+def _release(table, key):
+    """Count one less reference to the shared object for the given key,
+    dropping it once it is no longer referenced."""
+    shared = table.get(key)
+    if shared is not None:
+        shared[1] -= 1
+        if not shared[1]:
+            del table[key]
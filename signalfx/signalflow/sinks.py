@@ -0,0 +1,222 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import csv
+import io
+import json
+import logging
+import six
+from six.moves import queue
+import threading
+
+from . import messages
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+_logger = logging.getLogger(__name__)
+
+
+class _Sink(object):
+    """Base class for sinks writing the output of a SignalFlow computation to
+    a file, incrementally as it is produced.
+
+    Data is written as one (timestamp, tsid, value) row per datapoint, in
+    chunks of chunk_size rows. Timeseries metadata is written, as it is
+    received, to a JSON lines sidecar file next to the data file (the path of
+    the data file with a .metadata.jsonl suffix).
+
+    Writes happen on a background thread, fed through a queue of at most
+    queue_size chunks; this keeps memory usage bounded, regardless of the
+    size of the output, while the consumer of the computation is kept free
+    of disk I/O unless the writer falls behind by more than queue_size
+    chunks.
+    """
+
+    _THREAD_NAME = 'SignalFlowSinkWriter'
+
+    def __init__(self, path, chunk_size=10000, queue_size=16):
+        self._path = path
+        self._chunk_size = chunk_size
+        self._rows = []
+        self._metadata = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run,
+                                        name=self._THREAD_NAME)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def metadata_path(self):
+        return self._path + '.metadata.jsonl'
+
+    def write(self, message):
+        """Write the given stream message out. Messages other than data and
+        metadata messages are ignored."""
+        if self._error:
+            raise self._error
+        if isinstance(message, messages.DataMessage):
+            ts = message.logical_timestamp_ms
+            self._rows.extend((ts, tsid, value)
+                              for tsid, value in message.data.items())
+            if len(self._rows) >= self._chunk_size:
+                self.flush()
+        elif isinstance(message, messages.MetadataMessage):
+            self._metadata.append((message.tsid, message.properties))
+
+    def consume(self, computation):
+        """Write the output of the given computation out, yielding each
+        message of its stream as it is written."""
+        for message in computation.stream():
+            self.write(message)
+            yield message
+
+    def export(self, computation):
+        """Write the entire output of the given computation out, and close
+        the sink."""
+        try:
+            for _ in self.consume(computation):
+                pass
+        finally:
+            self.close()
+
+    def flush(self):
+        """Hand the buffered rows and metadata over to the writer thread."""
+        if self._rows or self._metadata:
+            self._queue.put((self._rows, self._metadata))
+            self._rows, self._metadata = [], []
+
+    def close(self):
+        """Flush and close the sink, waiting for all writes to complete."""
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        if self._error:
+            raise self._error
+
+    def _run(self):
+        metadata_file = None
+        try:
+            metadata_file = io.open(self.metadata_path, 'w', encoding='utf-8')
+            self._open()
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    break
+                rows, metadata = chunk
+                for tsid, properties in metadata:
+                    metadata_file.write(six.text_type(json.dumps(
+                        {'tsId': tsid, 'properties': properties})))
+                    metadata_file.write(u'\n')
+                if rows:
+                    self._write_rows(rows)
+        except Exception as e:
+            _logger.exception('Error writing to %s!', self._path)
+            self._error = e
+            # Keep draining the queue so the producer never blocks.
+            while self._queue.get() is not None:
+                pass
+        finally:
+            try:
+                self._close()
+            except Exception as e:
+                _logger.exception('Error closing %s!', self._path)
+                self._error = self._error or e
+            if metadata_file:
+                metadata_file.close()
+
+    def _open(self):
+        raise NotImplementedError('Subclasses should implement this!')
+
+    def _write_rows(self, rows):
+        raise NotImplementedError('Subclasses should implement this!')
+
+    def _close(self):
+        raise NotImplementedError('Subclasses should implement this!')
+
+
+class CSVSink(_Sink):
+    """Sink writing computation data to a CSV file with a timestamp, tsid and
+    value column."""
+
+    def _open(self):
+        if six.PY2:
+            self._file = open(self._path, 'wb')
+        else:
+            self._file = io.open(self._path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(['timestamp', 'tsid', 'value'])
+
+    def _write_rows(self, rows):
+        self._writer.writerows(rows)
+
+    def _close(self):
+        if getattr(self, '_file', None):
+            self._file.close()
+
+
+class JSONLinesSink(_Sink):
+    """Sink writing computation data to a JSON lines file, with one
+    {"timestamp", "tsid", "value"} object per datapoint."""
+
+    def _open(self):
+        self._file = io.open(self._path, 'w', encoding='utf-8')
+
+    def _write_rows(self, rows):
+        self._file.write(u''.join(
+            six.text_type(json.dumps(
+                {'timestamp': ts, 'tsid': tsid, 'value': value})) + u'\n'
+            for ts, tsid, value in rows))
+
+    def _close(self):
+        if getattr(self, '_file', None):
+            self._file.close()
+
+
+class ParquetSink(_Sink):
+    """Sink writing computation data to a Parquet file, one row group per
+    chunk. Values are stored as doubles. Requires pyarrow."""
+
+    def __init__(self, path, chunk_size=100000, queue_size=16):
+        if not pyarrow:
+            raise RuntimeError('pyarrow is required for Parquet export!')
+        self._schema = pyarrow.schema([
+            ('timestamp', pyarrow.int64()),
+            ('tsid', pyarrow.string()),
+            ('value', pyarrow.float64()),
+        ])
+        super(ParquetSink, self).__init__(path, chunk_size, queue_size)
+
+    def _open(self):
+        self._writer = pyarrow.parquet.ParquetWriter(self._path, self._schema)
+
+    def _write_rows(self, rows):
+        timestamps, tsids, values = zip(*rows)
+        self._writer.write_table(pyarrow.Table.from_arrays([
+            pyarrow.array(timestamps, type=pyarrow.int64()),
+            pyarrow.array(tsids, type=pyarrow.string()),
+            pyarrow.array([None if v is None else float(v) for v in values],
+                          type=pyarrow.float64()),
+        ], schema=self._schema))
+
+    def _close(self):
+        if getattr(self, '_writer', None):
+            self._writer.close()
@@ -3,12 +3,24 @@
 
 import certifi
 import json
-import sseclient
 import urllib3
 
-from . import channel, errors, messages, transport
+from . import _json, channel, errors, messages, transport
 from .. import constants, version
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Event payloads are decoded straight from the bytes received, with orjson
+# when it is installed.
+_loads = orjson.loads if orjson else _json.loads
+
+# Number of idle streaming connections kept for reuse when the number of
+# streams isn't capped.
+_STREAM_CONNECTIONS = 10
+
 
 class SSETransport(transport._SignalFlowTransport):
     """Server-Sent Events transport.
@@ -17,17 +29,28 @@ class SSETransport(transport._SignalFlowTransport):
     and reads Server-Sent Events streams back from SignalFx. One connection per
     SignalFlow computation is required when using this transport.
 
-    This is a good transport for single, ad-hoc computations. For most use
-    cases though, the WebSocket-based transport is more efficient and has lower
-    latency.
+    This is a good transport for single, ad-hoc computations, or where
+    WebSocket connections are blocked. For most use cases though, the
+    WebSocket-based transport is more efficient and has lower latency.
+
+    Streaming requests (execute, preflight and attach) each hold a connection
+    from a pool of streaming connections until their channel is closed or
+    ends. With max_streams set, at most that many are open at once, and new
+    streams wait (up to the timeout) for one to be released before failing
+    with errors.TooManyStreams. Otherwise, streams are not capped, and up to
+    10 connections are kept for reuse once their streams are done. Control
+    requests (start, keepalive and stop) use a separate pool of
+    control_connections keep-alive connections, so they never wait behind
+    long-lived streams.
     """
 
     _SIGNALFLOW_ENDPOINT = 'v2/signalflow'
 
     def __init__(self, token, endpoint=constants.DEFAULT_STREAM_ENDPOINT,
                  timeout=constants.DEFAULT_TIMEOUT, compress=True,
-                 proxy_url=None):
+                 proxy_url=None, max_streams=None, control_connections=2):
         super(SSETransport, self).__init__(token, endpoint, timeout)
+        self._max_streams = max_streams
         pool_args = {
             'url': self._endpoint,
             'headers': {
@@ -45,38 +68,63 @@ class SSETransport(transport._SignalFlowTransport):
                 'ca_certs': certifi.where()    # Path to the Certifi bundle.
             })
 
+        # With max_streams, the streaming pool blocks instead of opening
+        # connections beyond its size.
+        self._streams = self._make_pool(
+            pool_args, proxy_url, maxsize=max_streams or _STREAM_CONNECTIONS,
+            block=max_streams is not None)
+        self._control = self._make_pool(
+            pool_args, proxy_url, maxsize=control_connections)
+
+    @staticmethod
+    def _make_pool(pool_args, proxy_url, **kwargs):
+        pool_args = dict(pool_args, **kwargs)
         if proxy_url:
             proxy_manager = urllib3.poolmanager.proxy_from_url(proxy_url)
             endpoint = pool_args.pop('url')
-            self._http = proxy_manager.connection_from_url(
+            return proxy_manager.connection_from_url(
                     endpoint, pool_kwargs=pool_args)
-        else:
-            self._http = urllib3.connectionpool.connection_from_url(
-                    **pool_args)
+        return urllib3.connectionpool.connection_from_url(**pool_args)
 
     def __str__(self):
         return 'sse+{0}'.format(self._endpoint)
 
     def close(self):
-        self._http.close()
+        self._streams.close()
+        self._control.close()
 
     def _post(self, url, fields=None, body=None):
-        r = self._http.request_encode_url('POST', url,
-                                          fields=fields, body=body,
-                                          preload_content=False)
+        """Open a streaming request, returning its response."""
+        try:
+            r = self._streams.request_encode_url(
+                'POST', url, fields=fields, body=body,
+                preload_content=False, pool_timeout=self._timeout)
+        except urllib3.exceptions.EmptyPoolError:
+            raise errors.TooManyStreams(self._max_streams)
         if r.status != 200:
             try:
-                if r.headers['Content-Type'] == 'application/json':
-                    rbody = json.loads(r.read())
-                    raise errors.SignalFlowException(
-                            r.status,
-                            rbody.get('message'),
-                            rbody.get('errorType'))
-                raise errors.SignalFlowException(r.status)
+                self._raise_for_status(r, r.read())
             finally:
-                r.close()
-
-        return sseclient.SSEClient(r)
+                r.release_conn()
+        return r
+
+    def _control_post(self, url, fields=None, body=None):
+        """Make a control request, reading its response in full so that its
+        connection can be reused."""
+        r = self._control.request_encode_url('POST', url,
+                                             fields=fields, body=body)
+        if r.status not in (200, 204):
+            self._raise_for_status(r, r.data)
+
+    @staticmethod
+    def _raise_for_status(r, body):
+        if r.headers.get('Content-Type') == 'application/json':
+            rbody = json.loads(body)
+            raise errors.SignalFlowException(
+                    r.status,
+                    rbody.get('message'),
+                    rbody.get('errorType'))
+        raise errors.SignalFlowException(r.status)
 
     def execute(self, program, params):
         url = '{endpoint}/{path}/execute'.format(
@@ -96,7 +144,7 @@ class SSETransport(transport._SignalFlowTransport):
         url = '{endpoint}/{path}/start'.format(
             endpoint=self._endpoint,
             path=SSETransport._SIGNALFLOW_ENDPOINT)
-        self._post(url, fields=params, body=program)
+        self._control_post(url, fields=params, body=program)
 
     def attach(self, handle, params):
         url = '{endpoint}/{path}/{handle}/attach'.format(
@@ -110,28 +158,88 @@ class SSETransport(transport._SignalFlowTransport):
             endpoint=self._endpoint,
             path=SSETransport._SIGNALFLOW_ENDPOINT,
             handle=handle)
-        self._port(url)
+        self._control_post(url)
 
     def stop(self, handle, params):
         url = '{endpoint}/{path}/{handle}/stop'.format(
             endpoint=self._endpoint,
             path=SSETransport._SIGNALFLOW_ENDPOINT,
             handle=handle)
-        self._port(url, fields=params)
+        self._control_post(url, fields=params)
+
+
+def _read_events(response, chunk_size=65536):
+    """Read the Server-Sent Events of the given response, as (event, data)
+    tuples with the data left as bytes.
+
+    Line endings are normalized chunk by chunk, and only the data received
+    since the last event boundary is searched for the next one."""
+    buf = bytearray()
+    cr = b''
+    for chunk in response.stream(chunk_size):
+        chunk = cr + chunk
+        cr = b''
+        if b'\r' in chunk:
+            if chunk.endswith(b'\r'):
+                # Could be the first half of a CRLF.
+                chunk, cr = chunk[:-1], b'\r'
+            chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        # The boundary can straddle the previous data and this chunk.
+        start = max(len(buf) - 1, 0)
+        buf += chunk
+        end = buf.find(b'\n\n', start)
+        if end < 0:
+            continue
+        offset = 0
+        while end >= 0:
+            event = _parse_event(bytes(buf[offset:end]))
+            if event:
+                yield event
+            offset = end + 2
+            end = buf.find(b'\n\n', offset)
+        del buf[:offset]
+    buf += cr.replace(b'\r', b'\n')
+    for block in bytes(buf).split(b'\n\n'):
+        event = _parse_event(block)
+        if event:
+            yield event
+
+
+def _parse_event(block):
+    event, data = 'message', []
+    for line in block.split(b'\n'):
+        if not line or line.startswith(b':'):
+            continue
+        field, _, value = line.partition(b':')
+        if value.startswith(b' '):
+            value = value[1:]
+        if field == b'data':
+            data.append(value)
+        elif field == b'event':
+            event = value.decode('utf-8')
+    if not data:
+        return None
+    return event, b'\n'.join(data)
 
 
 class SSEComputationChannel(channel._Channel):
     """Computation channel fed from a Server-Sent Events stream."""
 
-    def __init__(self, stream):
+    def __init__(self, response):
         super(SSEComputationChannel, self).__init__()
-        self._stream = stream
-        self._events = stream.events()
+        self._response = response
+        self._events = _read_events(response)
 
     def _next(self):
-        event = next(self._events)
-        payload = json.loads(event.data)
-        return messages.StreamMessage.decode(event.event, payload)
+        try:
+            event, data = next(self._events)
+        except StopIteration:
+            self._response.release_conn()
+            raise
+        return messages.StreamMessage.decode(event, _loads(data))
 
     def close(self):
-        self._stream.close()
+        # The stream is interrupted, so its connection can't be reused, but
+        # its slot in the pool is given back.
+        self._response.close()
+        self._response.release_conn()
@@ -0,0 +1,130 @@
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+
+class Measure(object):
+    """Running statistics (last, min, max and mean) of a measurement."""
+
+    __slots__ = ('_last', '_min', '_max', '_total', '_count')
+
+    def __init__(self):
+        self._last = None
+        self._min = None
+        self._max = None
+        self._total = 0
+        self._count = 0
+
+    def __repr__(self):
+        return 'Measure(last={0}, min={1}, max={2}, mean={3})'.format(
+            self._last, self._min, self._max, self.mean)
+
+    @property
+    def last(self):
+        return self._last
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def max(self):
+        return self._max
+
+    @property
+    def mean(self):
+        return float(self._total) / self._count if self._count else None
+
+    @property
+    def count(self):
+        return self._count
+
+    def add(self, value):
+        if value is None:
+            return
+        self._last = value
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+        self._total += value
+        self._count += 1
+
+    def to_dict(self):
+        return {'last': self._last, 'min': self._min, 'max': self._max,
+                'mean': self.mean}
+
+
+class StreamStats(object):
+    """Lag statistics of the output stream of a computation, measured from
+    the timing the transport records for each data batch it receives (see
+    messages.BatchTiming). All measures are in milliseconds:
+
+      - lag: from the batch's logical timestamp to its reception by the
+        client, on the local clock; this includes the computation's max
+        delay, the server's processing and the network delay, and any clock
+        skew;
+      - clock_skew: difference between the local clock and the server's, as
+        seen from the server's keepalive messages (including the network
+        delay), to correct the lag with;
+      - decode_time: time it took to decode each batch;
+      - queue_residency: time each batch spent waiting, once decoded, to be
+        handed over to the consumer; this grows when the consumer is slower
+        than the computation's output;
+      - max_delay: the max delay the computation waited for data for each
+        batch, as reported by the server.
+
+    Listeners, added with add_listener(), are called with the stats and the
+    data message after each data batch is recorded.
+    """
+
+    def __init__(self):
+        self._batches = 0
+        self._last_logical_ts = None
+        self.lag = Measure()
+        self.clock_skew = Measure()
+        self.decode_time = Measure()
+        self.queue_residency = Measure()
+        self.max_delay = Measure()
+        self._listeners = []
+
+    @property
+    def batches(self):
+        """The number of timed data batches recorded."""
+        return self._batches
+
+    @property
+    def last_logical_ts(self):
+        return self._last_logical_ts
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def record(self, message):
+        """Record the timing of the given data message, if it has any."""
+        timing = message.timing
+        if not timing:
+            return
+        self._batches += 1
+        self._last_logical_ts = message.logical_timestamp_ms
+        self.lag.add(timing.received_ms - message.logical_timestamp_ms)
+        self.clock_skew.add(timing.clock_skew_ms)
+        self.decode_time.add(timing.decode_ms)
+        if timing.dequeued_ms is not None:
+            self.queue_residency.add(timing.dequeued_ms - timing.received_ms -
+                                     timing.decode_ms)
+        self.max_delay.add(message.max_delay_ms)
+        for listener in self._listeners:
+            listener(self, message)
+
+    def to_dict(self):
+        return {
+            'batches': self._batches,
+            'lastLogicalTimestampMs': self._last_logical_ts,
+            'lag': self.lag.to_dict(),
+            'clockSkew': self.clock_skew.to_dict(),
+            'decodeTime': self.decode_time.to_dict(),
+            'queueResidency': self.queue_residency.to_dict(),
+            'maxDelay': self.max_delay.to_dict(),
+        }
@@ -2,22 +2,185 @@
 # Copyright (C) 2020 Splunk, Inc. All rights reserved.
 
 import base64
+import collections
 import json
 import logging
-from six.moves import queue
+import multiprocessing
+import random
+import re
 import struct
+import six
+from six.moves import queue
 import threading
-import ws4py
-from ws4py.client.threadedclient import WebSocketClient
+import time
 import zlib
 
-from . import channel, errors, messages, transport
+from . import backends, channel, columnar, errors, messages, transport
+from ._json import loads as _json_loads
 from .. import constants, version
 
 _logger = logging.getLogger(__name__)
 
+_BINARY_HEADER = struct.Struct('!BBBx16s')
+_BINARY_DATA_V1_HEADER = struct.Struct('!q')
+_BINARY_DATA_V2_HEADER = struct.Struct('!qq')
+_DATAPOINT = struct.Struct('!B8s8s')
+_DOUBLE = struct.Struct('!d')
+_LONG = struct.Struct('!q')
+_GZIP_ISIZE = struct.Struct('<I')
+
+
+# Channel of a JSON message, found without parsing it.
+_TEXT_CHANNEL = re.compile(u'"channel"\\s*:\\s*"([^"\\\\]*)"')
+_BYTES_CHANNEL = re.compile(b'"channel"\\s*:\\s*"([^"\\\\]*)"')
+
+# How often, in seconds, a collector waiting for a result from its decode
+# process checks that the process is still running.
+_DECODE_PROCESS_POLL_INTERVAL = 1
+
+
+def _text_channel(data):
+    """Return the channel of the given JSON message, or None if it doesn't
+    have one or it can't be told for sure without parsing the message."""
+    if isinstance(data, six.text_type):
+        matches = _TEXT_CHANNEL.findall(data)
+    else:
+        matches = _BYTES_CHANNEL.findall(data)
+    # More than one match means a nested "channel" property.
+    if len(matches) != 1:
+        return None
+    channel = matches[0]
+    if not isinstance(channel, six.text_type):
+        channel = channel.decode('utf-8')
+    return channel
+
+
+def _payload(data, offset):
+    """Return the contents of data from the given offset, without copying
+    them where possible."""
+    if six.PY2:
+        return buffer(data, offset)  # noqa: F821
+    return memoryview(data)[offset:]
+
+
+def _gunzip(data):
+    """Decompress the given gzip data in one pass, into an output buffer
+    presized from the uncompressed size recorded in the gzip trailer."""
+    isize, = _GZIP_ISIZE.unpack_from(data, len(data) - 4)
+    # 'zlib.MAX_WBITS | 16' flags value is required to correctly uncompress
+    # data compressed by Java's GZIP compression.
+    return zlib.decompress(data, zlib.MAX_WBITS | 16, max(isize, 1))
+
+
+def _decode_binary_message(data, columns=False):
+    """Decode the given binary message, with the datapoints of data batches
+    as a list of dictionaries, or as columnar.DataColumns."""
+    # Binary messages use a custom encoding format. First, unpack the
+    # leading version byte to determine how to unpack the rest.
+    version, = struct.unpack('!B', data[0:1])
+    if version > 3:
+        _logger.warn('Unsupported binary message version %s!', version)
+        return None
+
+    version, mtype, flags, channel = _BINARY_HEADER.unpack_from(data)
+
+    channel = channel.rstrip(b'\x00').decode('utf-8')
+    is_compressed = flags & (1 << 0)
+    is_json = flags & (1 << 1)
+
+    if is_compressed:
+        try:
+            data = _gunzip(_payload(data, 20))
+        except (zlib.error, struct.error):
+            _logger.warn('Error decompressing message contents!')
+            return None
+        offset = 0
+    else:
+        offset = 20
+
+    if is_json:
+        return _json_loads(data[offset:] if offset else data)
+
+    if mtype == 5:
+        # Decode data batch message
+        if version == 1:
+            timestamp, = _BINARY_DATA_V1_HEADER.unpack_from(data, offset)
+            max_delay = None
+            offset += 8
+        elif version == 2 or version == 3:
+            timestamp, max_delay = _BINARY_DATA_V2_HEADER.unpack_from(
+                data, offset)
+            offset += 16
+
+        # Parse out datapoints
+        if columns:
+            datapoints = columnar.DataColumns.from_datapoints(
+                data, offset + 4, (len(data) - offset - 4) // 17)
+        else:
+            datapoints = _decode_datapoints(data, offset)
+        return {
+            'channel': channel,
+            'type': 'data',
+            'logicalTimestampMs': timestamp,
+            'maxDelayMs': max_delay,
+            'data': datapoints
+        }
+    else:
+        _logger.warn('Unsupported binary message type %s!', mtype)
+        return None
+
+
+def _decode_datapoints(data, offset=0):
+    # Ignore count at data[offset:offset+4], we just go by chunks of 17.
+    datapoints = []
+    b64encode = base64.urlsafe_b64encode
+    for i in range(offset + 4, len(data) - 16, 17):
+        vtype, tsid, value = _DATAPOINT.unpack_from(data, i)
+        # 8-byte IDs encode to 11 characters, plus one '=' of padding.
+        tsId = b64encode(tsid)[:11].decode('utf-8')
+        if vtype == 0:
+            value = None
+        else:
+            value, = (_DOUBLE if vtype == 2 else _LONG).unpack(value)
+        datapoints.append({'tsId': tsId, 'value': value})
+    return datapoints
+
+
+def _tsids(data):
+    """Return the timeseries IDs of the given decoded datapoints."""
+    if isinstance(data, columnar.DataColumns):
+        return data.tsids()
+    return [d['tsId'] for d in data]
+
+
+def _decode_process(frames, results):
+    """Main loop of the decode processes: decode each message received, and
+    send back exactly one result for it, with the datapoints of binary data
+    batches in shared memory."""
+    while True:
+        frame = frames.get()
+        if frame is None:
+            return
+        data, is_binary = frame
+        try:
+            if not is_binary:
+                results.put(('json', _json_loads(data)))
+                continue
+            decoded = _decode_binary_message(data, columns=True)
+            if not decoded:
+                results.put(('none',))
+            elif decoded.get('type') == 'data':
+                results.put(('data', decoded['channel'],
+                             decoded['logicalTimestampMs'],
+                             decoded['maxDelayMs'],
+                             decoded['data'].to_shared_memory()))
+            else:
+                results.put(('json', decoded))
+        except Exception as e:
+            results.put(('error', repr(e)))
+
 
-class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
+class WebSocketTransport(transport._SignalFlowTransport):
     """WebSocket based transport.
 
     Uses the SignalFlow WebSocket connection endpoint to interact with
@@ -25,13 +188,52 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
     through a single, pre-opened WebSocket connection. It also utilizes a more
     efficient binary encoding for data so it requires less bandwidth and has
     overall less latency.
+
+    Each computation channel buffers the messages received for it until they
+    are consumed. By default this buffer is unbounded; a channel_capacity can
+    be set to bound it, with an overflow_policy deciding what happens when a
+    slow consumer lets it fill up (see WebSocketComputationChannel).
+
+    When the connection is lost unexpectedly, the transport reconnects with
+    exponential backoff, re-authenticates once and resubscribes all the live
+    channels in a single pass, resuming executed computations from the last
+    logical timestamp received and suppressing data that was already received.
+    Channels are only ended, as they are with reconnect=False, after
+    reconnect_attempts failed attempts.
+
+    By default, messages are decoded on the WebSocket's reading thread. With
+    decode_workers set, decoding and routing of the messages is done by that
+    many worker threads instead, and the reading thread only reads frames and
+    looks up their channel, without parsing JSON messages. All the messages of
+    a given channel are handled by the same worker, preserving their order.
+
+    With decode_processes set, frames are instead handed over undecoded to
+    that many worker processes, which decode the datapoints of binary data
+    batches into columns (see columnar.DataColumns) and send them back
+    through shared memory. As with decode_workers, the messages of a given
+    channel all go through the same worker, and are delivered in order. This
+    process still copies each column out of shared memory, and converts the
+    datapoints to a dictionary when the data of a message is accessed: only
+    consumers reading DataMessage.columns avoid per-datapoint work here, so
+    measure whether this helps for a given workload. Should a worker process
+    die, the messages it had yet to decode are lost (and logged), and the
+    following ones are decoded in this process. This mode requires Python
+    3.8+ and, as worker processes are spawned, that the main module of the
+    program be safely importable.
+
+    The WebSocket framing and I/O are handled by a pluggable backend, given
+    by name or class (see the backends module): ws4py (the default),
+    websocket-client or, on Python 3, websockets.
     """
 
     _SIGNALFLOW_WEBSOCKET_ENDPOINT = 'v2/signalflow/connect'
 
     def __init__(self, token, endpoint=constants.DEFAULT_STREAM_ENDPOINT,
                  timeout=constants.DEFAULT_TIMEOUT, compress=True,
-                 proxy_url=None):
+                 proxy_url=None, channel_capacity=None,
+                 overflow_policy=None, reconnect=True, reconnect_attempts=5,
+                 reconnect_delay=0.5, reconnect_max_delay=30,
+                 decode_workers=0, backend=None, decode_processes=0):
         if proxy_url:
             raise NotImplementedError('Websocket transport cannot be proxied!')
 
@@ -43,23 +245,68 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
                                                 timeout)
 
         self._compress = compress
+        self._backend = backends.get_backend(backend)
+        self._ws = None
+        self._channel_capacity = channel_capacity
+        self._overflow_policy = (overflow_policy or
+                                 WebSocketComputationChannel.OVERFLOW_BLOCK)
+        self._reconnect = reconnect
+        self._reconnect_attempts = reconnect_attempts
+        self._reconnect_delay = reconnect_delay
+        self._reconnect_max_delay = reconnect_max_delay
         self._server_time = None
+        self._clock_skew = None
+        self._bytes_received = 0
         self._connected = False
+        self._reconnecting = False
+        self._closing = False
+        self._closed = False
         self._error = None
 
         self._connection_cv = threading.Condition()
         self._channels = {}
 
+        self._decode_queues = []
+        for i in range(decode_workers):
+            q = queue.Queue()
+            t = threading.Thread(target=self._decode_worker, args=(q,),
+                                 name='SignalFlowDecodeWorker-{0}'.format(i))
+            t.daemon = True
+            t.start()
+            self._decode_queues.append(q)
+
+        self._decoders = []
+        if decode_processes:
+            self._start_decode_processes(decode_processes)
+
     def __str__(self):
         return self._endpoint
 
+    @property
+    def bytes_received(self):
+        """Total size of the messages received by this transport."""
+        return self._bytes_received
+
+    @property
+    def channels(self):
+        """Number of computation channels open on this transport."""
+        return len(self._channels)
+
     def close(self, code=1001, reason=None):
-        if not self._connected:
-            return
-        WebSocketClient.close(self, code, reason)
+        with self._connection_cv:
+            # Stops any reconnection in progress.
+            self._closed = True
+            self._connection_cv.notify_all()
+            connected = self._connected
+            if connected:
+                self._closing = True
+        if connected:
+            self._ws.close(code, reason)
+        self._stop_decode_workers()
+        self._stop_decode_processes()
 
     def execute(self, program, params):
-        channel = WebSocketComputationChannel(self.detach)
+        channel = self._new_channel()
 
         request = {
             'type': 'execute',
@@ -69,12 +316,11 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
         }
         request.update(params)
 
-        self._channels[channel.name] = channel
-        self._send(request)
+        self._subscribe(channel, request)
         return channel
 
     def preflight(self, program, params):
-        channel = WebSocketComputationChannel(self.detach)
+        channel = self._new_channel()
 
         request = {
             'type': 'preflight',
@@ -84,8 +330,7 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
         }
         request.update(params)
 
-        self._channels[channel.name] = channel
-        self._send(request)
+        self._subscribe(channel, request)
         return channel
 
     def start(self, program, params):
@@ -94,7 +339,7 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
         self._send(json.dumps(request))
 
     def attach(self, handle, params):
-        channel = WebSocketComputationChannel(self.detach)
+        channel = self._new_channel()
 
         request = {
             'type': 'attach',
@@ -104,9 +349,19 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
         }
         request.update(params)
 
+        self._subscribe(channel, request)
+        return channel
+
+    def _new_channel(self):
+        return WebSocketComputationChannel(self.detach,
+                                           self._channel_capacity,
+                                           self._overflow_policy,
+                                           resumable=self._reconnect)
+
+    def _subscribe(self, channel, request):
+        channel.request = request
         self._channels[channel.name] = channel
         self._send(request)
-        return channel
 
     def detach(self, channel):
         if channel.name not in self._channels:
@@ -132,95 +387,287 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
 
     def _send(self, request):
         with self._connection_cv:
-            if not self._connected:
-                # Clear any previous error state before attempting to
-                # reconnect.
-                self._error = None
-                WebSocketClient.__init__(self, self._endpoint,
-                                         heartbeat_freq=None)
-                self.connect()
-            while not self._connected and not self._error:
+            while self._reconnecting:
                 self._connection_cv.wait()
+            self._closed = False
             if not self._connected:
-                raise self._error
+                self._connect()
         self.send(json.dumps(request))
 
+    def send(self, data):
+        self._ws.send(data)
+
+    def _connect(self):
+        """Open and authenticate the WebSocket connection. Must be called
+        with the connection condition held."""
+        # Clear any previous error state before attempting to reconnect.
+        self._error = None
+        self._closing = False
+        self._ws = self._backend(self._endpoint, self)
+        self._ws.connect()
+        while not self._connected and not self._error:
+            self._connection_cv.wait()
+        if not self._connected:
+            raise self._error
+
+    def _reconnect_and_resubscribe(self):
+        """Reconnect the WebSocket with exponential backoff after it was
+        lost, then resubscribe all live channels in a single pass. No other
+        requests can be sent until we're done."""
+        delay = self._reconnect_delay
+        for attempt in range(self._reconnect_attempts):
+            try:
+                with self._connection_cv:
+                    if self._closed:
+                        break
+                    self._connect()
+                for c in list(self._channels.values()):
+                    self.send(json.dumps(c.resume_request()))
+            except Exception as e:
+                _logger.info('Reconnection attempt %d to %s failed: %s',
+                             attempt + 1, self, e)
+                with self._connection_cv:
+                    # Woken up early if the transport is closed.
+                    self._connection_cv.wait(
+                        delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self._reconnect_max_delay)
+                continue
+
+            _logger.info('Reconnected to %s; resubscribed %d channel(s).',
+                         self, len(self._channels))
+            with self._connection_cv:
+                self._reconnecting = False
+                closed = self._closed
+                self._connection_cv.notify_all()
+            if closed:
+                # Closed while reconnecting; close the new connection too.
+                self.close()
+            return
+
+        if self._closed:
+            _logger.info('%s closed; stopped reconnecting.', self)
+        else:
+            _logger.warning('Giving up reconnecting to %s.', self)
+        for c in list(self._channels.values()):
+            c.offer(WebSocketComputationChannel.END_SENTINEL)
+        self._channels.clear()
+        with self._connection_cv:
+            self._reconnecting = False
+            self._connection_cv.notify_all()
+
     def opened(self):
         """Handler called when the WebSocket connection is opened. The first
         thing to do then is to authenticate ourselves."""
         request = {
             'type': 'authenticate',
             'token': self._token,
-            'userAgent': '{} ws4py/{}'.format(version.user_agent,
-                                              ws4py.__version__),
+            'userAgent': '{} {}/{}'.format(version.user_agent,
+                                           self._backend.name,
+                                           self._ws.version),
         }
         self.send(json.dumps(request))
 
+    @property
+    def clock_skew(self):
+        """The difference, in milliseconds, between the local clock and the
+        server's as of the last keepalive message received, including the
+        network delay; None until the first keepalive is received."""
+        return self._clock_skew
+
     def received_message(self, message):
+        """Handle the given ws4py message."""
+        self.received_data(message.data, message.is_binary)
+
+    def received_data(self, data, is_binary):
+        """Handler called with the contents of each message received."""
+        received = time.time()
+        self._bytes_received += len(data)
+        if self._decoders or self._decode_queues:
+            self._dispatch_message(data, is_binary, received)
+            return
+
         decoded = None
-        if message.is_binary:
-            decoded = self.decode_binary_message(bytes(message.data))
+        if is_binary:
+            decoded = self.decode_binary_message(bytes(data))
         else:
-            decoded = json.loads(message.data.decode('utf-8'))
+            decoded = _json_loads(data)
 
         if decoded:
+            self._stamp(decoded, received)
             self._process_message(decoded)
 
-    def decode_binary_message(self, data):
-        # Binary messages use a custom encoding format. First, unpack the
-        # leading version byte to determine how to unpack the rest.
-        version, = struct.unpack('!B', data[0:1])
-        if version > 3:
-            _logger.warn('Unsupported binary message version %s!',
-                         version)
-            return None
+    def _stamp(self, message, received, decoding=None):
+        """Record the reception and decoding times of data messages. Decoding
+        is assumed to have started on reception unless told otherwise."""
+        if message.get('type') == 'data':
+            message['receivedMs'] = received * 1000
+            message['decodeMs'] = (time.time() - (decoding or received)) * 1000
+            message['clockSkewMs'] = self._clock_skew
 
-        header, data = data[:20], data[20:]
-        version, mtype, flags, channel = struct.unpack('!BBBx16s', header)
+    def _dispatch_message(self, data, is_binary, received):
+        """Hand the given message over to the decode worker (or process)
+        responsible for its channel. Messages are handed over undecoded,
+        unless the channel of a JSON message can't be found without parsing
+        it."""
+        if not isinstance(data, six.text_type):
+            data = bytes(data)
+        if is_binary:
+            channel = self._decode_binary_channel(data)
+        else:
+            channel = _text_channel(data)
+            if channel is None:
+                data = _json_loads(data)
+                channel = data.get('channel')
+                if not channel:
+                    self._process_message(data)
+                    return
+        if channel not in self._channels:
+            return
 
-        channel = ''.join(filter(lambda c: ord(c), channel.decode('utf-8')))
-        is_compressed = flags & (1 << 0)
-        is_json = flags & (1 << 1)
+        decoders = self._decoders
+        if decoders:
+            frames, pending, process = decoders[hash(channel) % len(decoders)]
+            if isinstance(data, dict):
+                # Goes through the same ordered queue as the channel's other
+                # messages, without a round trip to the process.
+                pending.put(('json', data, received))
+            elif process.is_alive():
+                frames.put((data, is_binary))
+                pending.put(('frame', received))
+            else:
+                # Left to the collector to decode if the process died.
+                pending.put(('raw', data, is_binary, received))
+            return
+        queues = self._decode_queues
+        queues[hash(channel) % len(queues)].put((data, is_binary, received))
 
-        if is_compressed:
+    def _decode_worker(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            data, is_binary, received = item
+            decoding = time.time()
             try:
-                # 'zlib.MAX_WBITS | 16' flags value is required to correctly
-                # uncompress data compressed by Java's GZIP compression.
-                data = zlib.decompress(data, zlib.MAX_WBITS | 16)
-            except zlib.error:
-                _logger.warn('Error decompressing message contents!')
-                return None
+                if isinstance(data, dict):
+                    decoded = data
+                elif is_binary:
+                    decoded = self.decode_binary_message(data)
+                else:
+                    decoded = _json_loads(data)
+                if decoded:
+                    self._stamp(decoded, received, decoding)
+                    self._process_message(decoded)
+            except Exception:
+                _logger.exception('Error decoding message!')
+
+    def _stop_decode_workers(self):
+        queues, self._decode_queues = self._decode_queues, []
+        for q in queues:
+            q.put(None)
+
+    def _start_decode_processes(self, count):
+        if not columnar.shared_memory:
+            raise RuntimeError('Decoding in worker processes requires '
+                               'Python 3.8+!')
+        context = multiprocessing.get_context('spawn')
+        for i in range(count):
+            frames, results = context.Queue(), context.Queue()
+            process = context.Process(
+                target=_decode_process, args=(frames, results),
+                name='SignalFlowDecodeProcess-{0}'.format(i))
+            process.daemon = True
+            process.start()
 
-        if is_json:
-            return json.loads(data.decode('utf-8'))
-
-        if mtype == 5:
-            # Decode data batch message
-            if version == 1:
-                timestamp, = struct.unpack('!q', data[0:8])
-                max_delay = None
-                data = data[8:]
-            elif version == 2 or version == 3:
-                timestamp, max_delay = struct.unpack('!qq', data[0:16])
-                data = data[16:]
-
-            # Parse out datapoints
-            datapoints = self._decode_datapoints(data)
+            # Messages waiting for their turn to be processed, in order of
+            # reception; binary messages are placeholders for the process'
+            # next result.
+            pending = queue.Queue()
+            t = threading.Thread(
+                target=self._collect_decoded,
+                args=(pending, results, process),
+                name='SignalFlowDecodeCollector-{0}'.format(i))
+            t.daemon = True
+            t.start()
+            self._decoders.append((frames, pending, process))
+
+    def _stop_decode_processes(self):
+        decoders, self._decoders = self._decoders, []
+        for frames, pending, process in decoders:
+            frames.put(None)
+            pending.put(None)
+
+    def _collect_decoded(self, pending, results, process):
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            kind, received = item[0], item[-1]
+            try:
+                if kind == 'json':
+                    decoded = item[1]
+                elif kind == 'raw':
+                    data, is_binary = item[1:3]
+                    decoded = (self.decode_binary_message(data) if is_binary
+                               else _json_loads(data))
+                else:
+                    decoded = self._read_decoded(
+                        self._next_result(results, process))
+                if decoded:
+                    self._stamp(decoded, received)
+                    self._process_message(decoded)
+            except Exception:
+                _logger.exception('Error decoding message!')
+
+    @staticmethod
+    def _next_result(results, process):
+        """Wait for the next result of the given decode process, or return
+        None if the process died before sending it."""
+        while True:
+            try:
+                return results.get(timeout=_DECODE_PROCESS_POLL_INTERVAL)
+            except queue.Empty:
+                if not process.is_alive():
+                    _logger.error('%s exited unexpectedly (exit code %s), '
+                                  'a message was lost!',
+                                  process.name, process.exitcode)
+                    return None
+
+    @staticmethod
+    def _read_decoded(result):
+        """Turn a result from a decode process back into a message."""
+        if result is None:
+            return None
+        kind = result[0]
+        if kind == 'data':
+            _, channel, timestamp, max_delay, name = result
             return {
                 'channel': channel,
                 'type': 'data',
                 'logicalTimestampMs': timestamp,
                 'maxDelayMs': max_delay,
-                'data': datapoints
+                'data': columnar.DataColumns.from_shared_memory(name)
             }
-        else:
-            _logger.warn('Unsupported binary message type %s!', mtype)
-            return None
+        if kind == 'json':
+            return result[1]
+        if kind == 'error':
+            _logger.error('Error decoding message: %s', result[1])
+        return None
+
+    @staticmethod
+    def _decode_binary_channel(data):
+        channel, = struct.unpack_from('!16s', data, 4)
+        return channel.rstrip(b'\x00').decode('utf-8')
+
+    def decode_binary_message(self, data):
+        return _decode_binary_message(data)
 
     def _process_message(self, message):
         # Intercept KEEP_ALIVE messages
         if message.get('event') == 'KEEP_ALIVE':
             self._server_time = message.get('timestampMs', self._server_time)
+            if self._server_time:
+                self._clock_skew = time.time() * 1000 - self._server_time
             return
 
         # Authenticated messages inform us that our authentication has been
@@ -228,7 +675,7 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
         if message.get('type') == 'authenticated':
             with self._connection_cv:
                 self._connected = True
-                self._connection_cv.notify()
+                self._connection_cv.notify_all()
             _logger.debug('WebSocket connection authenticated as %s (in %s)',
                           message.get('userId'), message.get('orgId'))
             return
@@ -248,25 +695,6 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
                 WebSocketComputationChannel.END_SENTINEL)
             del self._channels[channel]
 
-    def _decode_datapoints(self, data):
-        def chunks(parts, n):
-            """Yield successive n-sized chunks from parts."""
-            for i in range(0, len(parts), n):
-                yield parts[i:i+n]
-
-        # Ignore count at data[0:4], we just go by chunks of 17.
-        datapoints = []
-        for chunk in chunks(data[4:], 17):
-            vtype, = struct.unpack('!B', chunk[0:1])
-            tsId = (base64.urlsafe_b64encode(chunk[1:9])
-                    .decode('utf-8')
-                    .replace('=', ''))
-            value = None
-            if vtype != 0:
-                value, = struct.unpack('!d' if vtype == 2 else '!q', chunk[9:])
-            datapoints.append({'tsId': tsId, 'value': value})
-        return datapoints
-
     def unhandled_error(self, error):
         """Handler called on unhandled errors (socket errors, OS errors, etc).
         We don't need to do anything here as the socket will be closed, causing
@@ -278,46 +706,334 @@ class WebSocketTransport(transport._SignalFlowTransport, WebSocketClient):
     def closed(self, code, reason=None):
         """Handler called when the WebSocket is closed. Status code 1000
         denotes a normal close; all others are errors."""
+        with self._connection_cv:
+            was_connected = self._connected
+            self._connected = False
+            if code != 1000:
+                self._error = errors.SignalFlowException(code, reason)
+            if self._reconnecting:
+                # A reconnection attempt failed; the reconnecting thread
+                # takes care of what happens next.
+                self._error = (self._error or
+                               errors.SignalFlowException(code, reason))
+                self._connection_cv.notify_all()
+                return
+            resubscribe = (code != 1000 and self._reconnect and
+                           was_connected and not self._closing and
+                           len(self._channels) > 0)
+            if resubscribe:
+                self._reconnecting = True
+            self._connection_cv.notify_all()
+
         if code != 1000:
-            self._error = errors.SignalFlowException(code, reason)
             _logger.info('Lost WebSocket connection with %s (%s: %s).',
                          self, code, reason)
-            for c in self._channels.values():
+
+        if resubscribe:
+            t = threading.Thread(target=self._reconnect_and_resubscribe,
+                                 name='SignalFlowWebSocketReconnect')
+            t.daemon = True
+            t.start()
+            return
+
+        if code != 1000:
+            for c in list(self._channels.values()):
                 c.offer(WebSocketComputationChannel.END_SENTINEL)
         self._channels.clear()
-        with self._connection_cv:
-            self._connected = False
-            self._connection_cv.notify()
+
+
+class PooledWebSocketTransport(transport._SignalFlowTransport):
+    """WebSocket based transport spreading computation channels over a pool
+    of WebSocket connections.
+
+    Each connection is a WebSocketTransport of its own, with its own reading
+    thread, authentication and reconnection; connections are opened when the
+    first channel is assigned to them. New channels are assigned to the least
+    loaded connection: the one that received the least data per second over
+    the last sample_period seconds, then the one with the fewest channels.
+    Other requests are sent over the least loaded connection as well.
+
+    Extra keyword arguments are passed through to each WebSocketTransport.
+    """
+
+    def __init__(self, token, endpoint=constants.DEFAULT_STREAM_ENDPOINT,
+                 timeout=constants.DEFAULT_TIMEOUT, compress=True,
+                 proxy_url=None, connections=4, sample_period=1.0,
+                 **kwargs):
+        transport._SignalFlowTransport.__init__(self, token, endpoint,
+                                                timeout)
+        self._transports = [
+            WebSocketTransport(token, endpoint, timeout, compress, proxy_url,
+                               **kwargs)
+            for _ in range(connections)]
+        self._sample_period = sample_period
+        self._samples = [(0, time.time())] * connections
+        self._rates = [0.0] * connections
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return '{0} (x{1})'.format(self._transports[0], len(self._transports))
+
+    @property
+    def transports(self):
+        """The WebSocketTransport of each connection of the pool."""
+        return list(self._transports)
+
+    def _least_loaded(self):
+        with self._lock:
+            now = time.time()
+            for i, t in enumerate(self._transports):
+                received, sampled = self._samples[i]
+                if now - sampled >= self._sample_period:
+                    self._rates[i] = ((t.bytes_received - received) /
+                                      max(now - sampled, 1e-3))
+                    self._samples[i] = (t.bytes_received, now)
+            i = min(range(len(self._transports)),
+                    key=lambda i: (self._rates[i],
+                                   self._transports[i].channels))
+            return self._transports[i]
+
+    def execute(self, program, params):
+        return self._least_loaded().execute(program, params)
+
+    def preflight(self, program, params):
+        return self._least_loaded().preflight(program, params)
+
+    def start(self, program, params):
+        self._least_loaded().start(program, params)
+
+    def attach(self, handle, params):
+        return self._least_loaded().attach(handle, params)
+
+    def keepalive(self, handle):
+        self._least_loaded().keepalive(handle)
+
+    def stop(self, handle, params):
+        self._least_loaded().stop(handle, params)
+
+    def close(self, code=1001, reason=None):
+        for t in self._transports:
+            t.close(code, reason)
 
 
 class WebSocketComputationChannel(channel._Channel):
-    """Computation channel fed from a WebSocket channel."""
+    """Computation channel fed from a WebSocket channel.
+
+    Messages are buffered in the channel until they are consumed. If a
+    capacity is set, the overflow policy decides what happens when a message
+    is offered to a full channel:
+
+      - OVERFLOW_BLOCK blocks the WebSocket reader until the consumer catches
+        up; this applies backpressure to all the channels of the connection;
+      - OVERFLOW_DROP_OLDEST drops the oldest buffered data batch;
+      - OVERFLOW_COALESCE drops all the buffered data batches of logical
+        timestamps older than the one of the incoming batch, so the consumer
+        skips ahead to the latest output; if there are none, it falls back to
+        dropping the oldest buffered data batch.
+
+    Control, metadata and other non-data messages are never dropped, and are
+    accepted even if that puts the channel over capacity.
+
+    Resumable channels keep track of the last logical timestamp they received
+    data for, and of the timeseries received at that timestamp, so they can be
+    resubscribed after a reconnection without yielding duplicate data.
+    """
 
     END_SENTINEL = object()
 
-    def __init__(self, detach_func):
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP_OLDEST = 'drop-oldest'
+    OVERFLOW_COALESCE = 'coalesce'
+
+    def __init__(self, detach_func, capacity=None,
+                 overflow_policy=OVERFLOW_BLOCK, resumable=False):
         super(WebSocketComputationChannel, self).__init__()
+        if overflow_policy not in [
+                WebSocketComputationChannel.OVERFLOW_BLOCK,
+                WebSocketComputationChannel.OVERFLOW_DROP_OLDEST,
+                WebSocketComputationChannel.OVERFLOW_COALESCE]:
+            raise ValueError('Unknown overflow policy {0}!'
+                             .format(overflow_policy))
         self._detach_func = detach_func
-        self._q = queue.Queue()
+        self._capacity = capacity
+        self._overflow_policy = overflow_policy
+        self._q = collections.deque()
+        # Data batches in the queue, oldest first, and the IDs of the ones
+        # dropped to make room that are still in the queue; dropped batches
+        # are skipped when they reach its head.
+        self._data = collections.deque()
+        self._evicted = set()
+        self._cv = threading.Condition()
+        self._ended = False
+        self._dropped = 0
+        self._listener = None
+
+        self.request = None
+        self._resumable = resumable
+        self._last_ts = None
+        # The data received for the last logical timestamp, as received: its
+        # IDs are only extracted when resuming.
+        self._last_ts_data = []
+        self._resume_ts = None
+        self._resume_tsids = None
+
+    @property
+    def dropped(self):
+        with self._cv:
+            return self._dropped
+
+    @property
+    def backlog(self):
+        with self._cv:
+            return self._queued()
+
+    def _queued(self):
+        return len(self._q) - len(self._evicted)
 
     def offer(self, message):
-        self._q.put(message)
+        with self._cv:
+            if self._ended:
+                return
+            if message is WebSocketComputationChannel.END_SENTINEL:
+                self._ended = True
+            elif self._resumable and message.get('type') == 'data':
+                message = self._track(message)
+                if message is None:
+                    return
+            if (self._capacity and
+                    message is not WebSocketComputationChannel.END_SENTINEL):
+                while self._queued() >= self._capacity and not self._ended:
+                    if (self._overflow_policy ==
+                            WebSocketComputationChannel.OVERFLOW_BLOCK):
+                        self._cv.wait()
+                    elif not self._make_room(message):
+                        break
+                if self._ended:
+                    return
+            self._q.append(message)
+            if self._capacity and self._is_data(message):
+                self._data.append(message)
+            self._cv.notify_all()
+            listener = self._listener
+        if listener:
+            listener(self)
 
-    def _next(self):
+    def _track(self, message):
+        """Track the received data for resumption, suppressing data that was
+        already received before the channel was resubscribed."""
+        ts = message['logicalTimestampMs']
+        if self._resume_ts is not None:
+            if ts < self._resume_ts:
+                return None
+            if ts == self._resume_ts:
+                if self._resume_tsids is None:
+                    self._resume_tsids = set()
+                    for data in self._last_ts_data:
+                        self._resume_tsids.update(_tsids(data))
+                data = message['data']
+                if isinstance(data, columnar.DataColumns):
+                    data = data.to_list()
+                data = [d for d in data
+                        if d['tsId'] not in self._resume_tsids]
+                if not data:
+                    return None
+                message['data'] = data
+            else:
+                self._resume_ts = None
+                self._resume_tsids = None
+        if ts != self._last_ts:
+            self._last_ts = ts
+            self._last_ts_data = []
+        self._last_ts_data.append(message['data'])
+        return message
+
+    def resume_request(self):
+        """Return the request to resubscribe this channel with, resuming
+        from the last logical timestamp received if possible."""
+        request = dict(self.request)
+        with self._cv:
+            self._resume_ts = self._last_ts
+            self._resume_tsids = None
+            if self._last_ts and request['type'] in ['execute', 'preflight']:
+                request['start'] = self._last_ts
+        return request
+
+    def _make_room(self, message):
+        """Drop buffered data batches to make room for the given message,
+        according to the overflow policy. Returns False if no data batch could
+        be dropped."""
+        if message.get('type') != 'data' or not self._data:
+            return False
+        # Data batches are queued in timestamp order, so the oldest one is
+        # always dropped, along with all the others superseded by the
+        # incoming batch when coalescing.
+        self._evict()
+        if (self._overflow_policy ==
+                WebSocketComputationChannel.OVERFLOW_COALESCE):
+            ts = message.get('logicalTimestampMs')
+            while (self._data and
+                   self._data[0].get('logicalTimestampMs') < ts):
+                self._evict()
+        return True
+
+    def _evict(self):
+        self._evicted.add(id(self._data.popleft()))
+        self._dropped += 1
+
+    def _pop(self):
+        """Pop the next message from the queue, skipping the dropped data
+        batches."""
         while True:
-            try:
-                event = self._q.get(timeout=0.1)
-                if event == WebSocketComputationChannel.END_SENTINEL:
-                    raise StopIteration()
+            event = self._q.popleft()
+            if self._evicted and id(event) in self._evicted:
+                self._evicted.remove(id(event))
+                continue
+            if self._data and self._data[0] is event:
+                self._data.popleft()
+            return event
 
-                error = event.get('error')
-                if error:
-                    raise errors.SignalFlowException(
-                        error, event.get('message'))
+    @staticmethod
+    def _is_data(message):
+        return (message is not WebSocketComputationChannel.END_SENTINEL and
+                message.get('type') == 'data')
 
-                return messages.StreamMessage.decode(event['type'], event)
-            except queue.Empty:
-                pass
+    def set_listener(self, listener):
+        with self._cv:
+            self._listener = listener
+            backlog = self._queued()
+        for _ in range(backlog):
+            listener(self)
+
+    def _next(self):
+        with self._cv:
+            while not self._queued():
+                self._cv.wait(0.1)
+            event = self._pop()
+            self._cv.notify_all()
+        return self._decode(event)
+
+    def poll(self, timeout=0):
+        with self._cv:
+            if not self._queued() and timeout > 0:
+                self._cv.wait(timeout)
+            if not self._queued():
+                return None
+            event = self._pop()
+            self._cv.notify_all()
+        return self._decode(event)
+
+    def _decode(self, event):
+        if event is WebSocketComputationChannel.END_SENTINEL:
+            raise StopIteration()
+
+        error = event.get('error')
+        if error:
+            raise errors.SignalFlowException(error, event.get('message'))
+
+        if 'receivedMs' in event:
+            event['dequeuedMs'] = time.time() * 1000
+
+        return messages.StreamMessage.decode(event['type'], event)
 
     def close(self):
         self._detach_func(self)
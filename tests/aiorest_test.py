@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2020 Splunk, Inc. All rights reserved.
+
+import json
+import threading
+import unittest
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib import parse
+
+try:
+    import asyncio
+    from signalfx import aiorest
+except (ImportError, SyntaxError):
+    aiorest = None
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the SignalFx REST API, serving 250 detectors and
+    a tag, and recording the requests it receives. Like the real API, it
+    may cap the number of results per page to max_limit."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.tag = {'name': 'foo', 'description': 'bar'}
+        self.max_limit = None
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_port)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self, method):
+        server = self.server
+        url = parse.urlparse(self.path)
+        params = dict(parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or 'null')
+        with server.lock:
+            server.requests.append((method, url.path, params,
+                                    self.headers.get('X-SF-Token')))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+        try:
+            if url.path == '/v2/detector':
+                offset, limit = int(params['offset']), int(params['limit'])
+                limit = min(limit, server.max_limit or limit)
+                self.reply(200, {'count': 250, 'results': [
+                    {'id': i} for i in range(offset,
+                                             min(offset + limit, 250))]})
+            elif url.path == '/v2/tag/foo' and method == 'GET':
+                self.reply(200, server.tag)
+            elif url.path == '/v2/tag/foo' and method == 'PUT':
+                server.tag = dict(body, name='foo')
+                self.reply(200, server.tag)
+            elif url.path == '/v2/tag/foo' and method == 'DELETE':
+                self.reply(204)
+            else:
+                self.reply(404, {'message': 'Not found'})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def reply(self, status, payload=None):
+        body = json.dumps(payload).encode('utf-8') if payload else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+
+def collect(iterator):
+    """Consume the given asynchronous iterator into a list."""
+    async_iterator = iterator.__aiter__()
+    results = []
+    while True:
+        try:
+            results.append(run(async_iterator.__anext__()))
+        except StopAsyncIteration:  # noqa: F821
+            return results
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+@unittest.skipUnless(aiorest and aiorest.aiohttp, 'requires aiohttp')
+class AsyncRESTTest(unittest.TestCase):
+
+    def setUp(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.server = StandInServer()
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.client = aiorest.AsyncSignalFxRestClient(
+            'authkey', self.server.endpoint, max_concurrency=2)
+
+    def tearDown(self):
+        run(self.client.close())
+        asyncio.get_event_loop().close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_update_delete(self):
+        self.assertEqual(run(self.client.get_tag('foo')),
+                         {'name': 'foo', 'description': 'bar'})
+        updated = run(self.client.update_tag('foo', description='baz'))
+        self.assertEqual(updated['description'], 'baz')
+        self.assertEqual(run(self.client.get_tag('foo'))['description'],
+                         'baz')
+        self.assertIsNone(run(self.client.delete_tag('foo')))
+        self.assertEqual(
+            [(m, p, t) for m, p, _, t in self.server.requests],
+            [('GET', '/v2/tag/foo', 'authkey'),
+             ('PUT', '/v2/tag/foo', 'authkey'),
+             ('GET', '/v2/tag/foo', 'authkey'),
+             ('DELETE', '/v2/tag/foo', 'authkey')])
+
+        with self.assertRaises(aiorest.aiohttp.ClientResponseError) as cm:
+            run(self.client.get_detector('missing'))
+        self.assertEqual(cm.exception.status, 404)
+
+    def test_pagination(self):
+        detectors = collect(self.client.iter_detectors(batch_size=20,
+                                                       concurrency=4))
+        self.assertEqual([d['id'] for d in detectors], list(range(250)))
+        self.assertLessEqual(self.server.max_in_flight, 2)
+
+        detectors = run(self.client.get_detectors(
+            tags=['a', 'b'], batch_size=100, limit=150))
+        self.assertEqual(len(detectors), 150)
+        self.assertEqual(self.server.requests[-1][2],
+                         {'offset': '100', 'limit': '50', 'tags': 'b'})
+
+    def test_capped_page_size(self):
+        self.server.max_limit = 50
+        detectors = collect(self.client.iter_detectors(batch_size=100))
+        self.assertEqual([d['id'] for d in detectors], list(range(250)))
+        self.assertEqual(
+            len(run(self.client.get_detectors(batch_size=100, offset=30,
+                                              limit=120))), 120)
+        # No page is requested past the end.
+        self.assertTrue(all(int(p['offset']) < 250
+                            for _, _, p, _ in self.server.requests))
+
+
+if __name__ == '__main__':
+    unittest.main()
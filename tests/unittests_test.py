@@ -5,10 +5,28 @@
 
 from httmock import all_requests, HTTMock
 import json
+import logging
 import unittest
+from six.moves import BaseHTTPServer, socketserver
 from six.moves.urllib import parse
+import signalfx.bulk
+import signalfx.cache
+import signalfx.index
 import signalfx.signalflow.ws
+from signalfx.signalflow import accumulator, backends, backfill, cache, \
+    columnar, computation, errors, keepalive, messages, metadata, sinks, sse
+import collections
+import csv
+import gc
+import os
+import shutil
 import struct
+import tempfile
+import threading
+from ws4py.messaging import BinaryMessage, TextMessage
+import time
+import weakref
+import zlib
 
 responses_map = {
     'GET_DETECTOR': {
@@ -149,6 +167,309 @@ class RESTTest(unittest.TestCase):
                 self.assertEqual(dl['id'], 'abc123')
 
 
+class RESTPaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.max_limit = None
+
+    def paginated(self):
+        @all_requests
+        def respond(url, request):
+            params = dict(parse.parse_qsl(url.query))
+            offset, limit = int(params['offset']), int(params['limit'])
+            self.requests.append((url.path, offset))
+            if self.max_limit:
+                limit = min(limit, self.max_limit)
+            if url.path == '/v2/incident':
+                return json.dumps([{'id': i} for i in range(
+                    offset, min(offset + limit, 230))])
+            return json.dumps({
+                'count': 250,
+                'results': [{'id': i} for i in range(
+                    offset, min(offset + limit, 250))],
+            })
+        return HTTMock(respond)
+
+    def test_capped_page_size(self):
+        self.max_limit = 40
+        with self.paginated():
+            with signalfx.SignalFx().rest('authkey') as sfx:
+                self.assertEqual([d['id'] for d in sfx.get_detectors()],
+                                 list(range(250)))
+                self.assertEqual(
+                    [d['id'] for d in sfx.get_dashboards(batch_size=30)],
+                    list(range(250)))
+                incidents = sfx.iter_incidents(batch_size=20)
+                self.assertEqual([i['id'] for i in incidents],
+                                 list(range(230)))
+        self.assertEqual(
+            [offset for path, offset in self.requests
+             if path == '/v2/incident'], list(range(0, 240, 20)))
+
+    def test_no_requests_left_running(self):
+        with self.paginated():
+            with signalfx.SignalFx().rest('authkey') as sfx:
+                detectors = sfx.iter_detectors(batch_size=10, concurrency=4)
+                self.assertEqual(next(detectors), {'id': 0})
+                detectors.close()
+                sent = len(self.requests)
+            time.sleep(0.05)
+        self.assertLessEqual(sent, 5)
+        self.assertEqual(len(self.requests), sent)
+
+    def test_iterators(self):
+        with self.paginated():
+            with signalfx.SignalFx().rest('authkey') as sfx:
+                detectors = sfx.iter_detectors(batch_size=20)
+                self.assertEqual(next(detectors), {'id': 0})
+                self.assertEqual([d['id'] for d in detectors],
+                                 list(range(1, 250)))
+                self.assertEqual(
+                    [d['id'] for d in sfx.get_dashboards(batch_size=30)],
+                    list(range(250)))
+                self.assertEqual(
+                    [m['id'] for m in sfx.iter_metrics(
+                        'sf_metric:*', batch_size=30, offset=15, limit=50,
+                        concurrency=1)],
+                    list(range(15, 65)))
+                self.assertEqual(
+                    [i['id'] for i in sfx.iter_incidents(batch_size=20)],
+                    list(range(230)))
+
+
+class RESTCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.tag = {'name': 'foo', 'description': 'bar'}
+
+    def responder(self):
+        @all_requests
+        def respond(url, request):
+            self.requests.append((request.method,
+                                  request.headers.get('If-None-Match')))
+            if request.method == 'PUT':
+                self.tag = json.loads(request.body)
+                self.tag['name'] = 'foo'
+            elif request.headers.get('If-None-Match') == '"v1"':
+                return {'status_code': 304}
+            return {'status_code': 200, 'content': json.dumps(self.tag),
+                    'headers': {'ETag': '"v1"'}}
+        return HTTMock(respond)
+
+    def test_ttl_and_revalidation(self):
+        cache = signalfx.cache.MetadataCache(ttl=60)
+        with self.responder():
+            with signalfx.SignalFx().rest('authkey', cache=cache) as sfx:
+                self.assertEqual(sfx.get_tag('foo'), self.tag)
+                self.assertEqual(sfx.get_tag('foo'), self.tag)
+                self.assertEqual(len(self.requests), 1)
+
+                cache._ttl = 0
+                cache.refresh(sfx._cache_key(
+                    sfx._u(sfx._TAG_ENDPOINT_SUFFIX, 'foo')))
+                self.assertEqual(sfx.get_tag('foo')['description'], 'bar')
+                self.assertEqual(self.requests[-1], ('GET', '"v1"'))
+
+                cache._ttl = 60
+                sfx.update_tag('foo', description='baz')
+                self.assertEqual(sfx.get_tag('foo')['description'], 'baz')
+                self.assertEqual([m for m, _ in self.requests],
+                                 ['GET', 'GET', 'PUT'])
+
+                sfx.get_chart('abc')
+                sfx.get_chart('abc')
+                self.assertEqual(len(self.requests), 5)
+
+    def test_disk_backend(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for _ in range(2):
+            cache = signalfx.cache.MetadataCache(
+                backend=signalfx.cache.DiskCacheBackend(directory))
+            with self.responder():
+                with signalfx.SignalFx().rest('authkey', cache=cache) as sfx:
+                    self.assertEqual(sfx.get_tag('foo'), self.tag)
+        self.assertEqual(len(self.requests), 1)
+
+        # Another organization's token doesn't share the cached entries.
+        with self.responder():
+            with signalfx.SignalFx().rest('otherkey', cache=cache) as sfx:
+                self.assertEqual(sfx.get_tag('foo'), self.tag)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_coalescing(self):
+        started = threading.Event()
+
+        @all_requests
+        def respond(url, request):
+            self.requests.append(request.method)
+            started.set()
+            time.sleep(0.2)
+            return json.dumps({'key': 'host', 'value': 'foo'})
+
+        cache = signalfx.cache.MetadataCache()
+        results = []
+        with HTTMock(respond):
+            with signalfx.SignalFx().rest('authkey', cache=cache) as sfx:
+                def lookup():
+                    results.append(sfx.get_dimension('host', 'foo'))
+                threads = [threading.Thread(target=lookup)]
+                threads[0].start()
+                started.wait()
+                threads += [threading.Thread(target=lookup)
+                            for _ in range(5)]
+                for t in threads[1:]:
+                    t.start()
+                for t in threads:
+                    t.join()
+        self.assertEqual(self.requests, ['GET'])
+        self.assertEqual(results, [{'key': 'host', 'value': 'foo'}] * 6)
+
+    def test_coalescing_until_cached(self):
+        storing = threading.Event()
+
+        class SlowCache(signalfx.cache.MetadataCache):
+            def put(self, *args, **kwargs):
+                storing.set()
+                time.sleep(0.1)
+                signalfx.cache.MetadataCache.put(self, *args, **kwargs)
+
+        @all_requests
+        def respond(url, request):
+            self.requests.append(request.method)
+            return json.dumps({'key': 'host', 'value': 'foo'})
+
+        with HTTMock(respond):
+            with signalfx.SignalFx().rest('authkey',
+                                          cache=SlowCache()) as sfx:
+                t = threading.Thread(
+                    target=lambda: sfx.get_dimension('host', 'foo'))
+                t.start()
+                storing.wait()
+                self.assertEqual(sfx.get_dimension('host', 'foo'),
+                                 {'key': 'host', 'value': 'foo'})
+                t.join()
+        self.assertEqual(self.requests, ['GET'])
+
+    def test_lru(self):
+        cache = signalfx.cache.MetadataCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')),
+                         (1, None, 3))
+
+
+class BulkUpdaterTest(unittest.TestCase):
+
+    def test_update_dimensions(self):
+        dimensions = {
+            '/v2/dimension/host/a': {'description': 'same',
+                                     'customProperties': {'dc': 'x'},
+                                     'tags': ['t1', 't2']},
+            '/v2/dimension/host/b': {'description': 'old'},
+        }
+        calls = []
+        throttled = []
+
+        @all_requests
+        def respond(url, request):
+            calls.append((request.method, url.path))
+            if url.path.endswith('/bad'):
+                return {'status_code': 400}
+            if request.method == 'GET':
+                if url.path not in dimensions:
+                    return {'status_code': 404}
+                return json.dumps(dimensions[url.path])
+            if not throttled:
+                throttled.append(url.path)
+                return {'status_code': 429, 'headers': {'Retry-After': '0'}}
+            dimensions[url.path] = json.loads(request.body)
+            return request.body
+
+        progress = []
+        with HTTMock(respond):
+            with signalfx.SignalFx().rest('authkey') as sfx:
+                with signalfx.bulk.BulkUpdater(
+                        sfx, workers=2, progress=progress.append,
+                        progress_every=0) as bulk:
+                    result = bulk.update_dimensions([
+                        ('host', 'a', 'same', {'dc': 'x'}, ['t2', 't1']),
+                        ('host', 'b', 'new', {'dc': 'y'}),
+                        ('host', 'c', 'new', None, ['t3']),
+                        ('host', 'bad', 'new'),
+                    ])
+
+        self.assertEqual((result.updated, result.unchanged), (2, 1))
+        self.assertEqual([item for item, _ in result.failed],
+                         [('host', 'bad', 'new')])
+        self.assertEqual(len(progress), 4)
+        self.assertEqual(dimensions['/v2/dimension/host/b']['description'],
+                         'new')
+        self.assertEqual(dimensions['/v2/dimension/host/c']['tags'], ['t3'])
+        self.assertNotIn(('PUT', '/v2/dimension/host/a'), calls)
+        self.assertEqual(calls.count(('PUT', throttled[0])), 2)
+
+
+class MetadataIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = []
+        self.dimensions = [
+            {'key': 'host', 'value': 'web-1', 'lastUpdated': 10,
+             'customProperties': {'role': 'web'}, 'tags': ['prod']},
+            {'key': 'host', 'value': 'db-1', 'lastUpdated': 20,
+             'customProperties': {'role': 'db'}, 'tags': ['prod']},
+            {'key': 'host', 'value': 'web-2', 'lastUpdated': 30,
+             'customProperties': {}, 'tags': []},
+        ]
+
+    def responder(self):
+        @all_requests
+        def respond(url, request):
+            params = dict(parse.parse_qsl(url.query))
+            self.queries.append(params['query'])
+            since = 0
+            if 'lastUpdated:>=' in params['query']:
+                since = int(params['query'].rsplit('>=', 1)[1])
+            results = sorted([d for d in self.dimensions
+                              if d['lastUpdated'] >= since],
+                             key=lambda d: d['lastUpdated'])
+            offset, limit = int(params['offset']), int(params['limit'])
+            return json.dumps({'count': len(results),
+                               'results': results[offset:offset + limit]})
+        return HTTMock(respond)
+
+    def test_sync_and_search(self):
+        with signalfx.index.MetadataIndex() as index:
+            with self.responder():
+                with signalfx.SignalFx().rest('authkey') as sfx:
+                    self.assertEqual(index.sync(sfx, 'dimensions'), 3)
+                    self.dimensions[0]['tags'] = []
+                    self.dimensions[0]['lastUpdated'] = 40
+                    self.assertEqual(index.sync(sfx, 'dimensions'), 2)
+            self.assertEqual(self.queries,
+                             ['*', '(*) AND lastUpdated:>=30'])
+            self.assertEqual(len(index), 3)
+
+            def search(query):
+                return [d['value'] for d in index.search_dimensions(query)]
+            self.assertEqual(search('*'), ['db-1', 'web-1', 'web-2'])
+            self.assertEqual(search('host:web*'), ['web-1', 'web-2'])
+            self.assertEqual(search('tags:prod'), ['db-1'])
+            self.assertEqual(search('role:* AND NOT role:db'), ['web-1'])
+            self.assertEqual(search('value:"db-1" OR (key:host role:web)'),
+                             ['db-1', 'web-1'])
+            self.assertEqual(search('_exists_:role'), ['db-1', 'web-1'])
+            self.assertEqual(index.search_dimensions('*', limit=1),
+                             [self.dimensions[1]])
+            for query in ('(host:a', 'host:a OR', 'host'):
+                self.assertRaises(ValueError, search, query)
+
+
 class WebSocketTransportTest(unittest.TestCase):
 
     def test_decode_binary_format_v1(self):
@@ -199,6 +520,1162 @@ class WebSocketTransportTest(unittest.TestCase):
             }]
         })
 
+    def test_decode_compressed(self):
+        def gzip(data):
+            c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            return c.compress(data) + c.flush()
+
+        ws = signalfx.signalflow.ws.WebSocketTransport('token')
+        payload = {'type': 'metadata', 'channel': 'foo', 'tsId': 'bar',
+                   'properties': {'sf_metric': 'baz'}}
+        decoded = ws.decode_binary_message(
+            struct.pack('!BBBx16s', 3, 6, 3, b'foo') +
+            gzip(json.dumps(payload).encode('utf-8')))
+        self.assertEqual(decoded, payload)
+
+        decoded = ws.decode_binary_message(
+            struct.pack('!BBBx16s', 3, 5, 1, b'foo') +
+            gzip(struct.pack('!qqiBqd', 1234, 4321, 1, 2, 11, 3.14)))
+        self.assertEqual(decoded['data'],
+                         [{'tsId': u'AAAAAAAAAAs', 'value': 3.14}])
+
+        self.assertIsNone(ws.decode_binary_message(
+            struct.pack('!BBBx16s', 3, 6, 3, b'foo') + b'garbage'))
+
+    def test_decode_workers(self):
+        parsed = []
+        json_loads = signalfx.signalflow.ws._json_loads
+
+        def loads(data):
+            parsed.append(threading.current_thread().name)
+            return json_loads(data)
+        self.addCleanup(setattr, signalfx.signalflow.ws, '_json_loads',
+                        json_loads)
+        signalfx.signalflow.ws._json_loads = loads
+
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', decode_workers=2)
+        channels = [ws._new_channel() for _ in range(4)]
+        for c in channels:
+            ws._channels[c.name] = c
+        for ts in range(10):
+            for c in channels:
+                ws.received_message(BinaryMessage(struct.pack(
+                    '!BBxx16sqiBqq', 1, 5, c.name.encode('utf-8'), ts,
+                    1, 1, 10, ts)))
+        ws.received_message(TextMessage(json.dumps({
+            'type': 'control-message', 'channel': channels[0].name,
+            'event': 'END_OF_CHANNEL', 'timestampMs': 0})))
+        for c in channels:
+            self.assertEqual([next(c).logical_timestamp_ms
+                              for _ in range(10)], list(range(10)))
+        self.assertIsInstance(next(channels[0]),
+                              messages.EndOfChannelMessage)
+        self.assertRaises(StopIteration, next, channels[0])
+        # JSON messages are parsed by the workers too.
+        self.assertEqual(len(parsed), 1)
+        self.assertTrue(parsed[0].startswith('SignalFlowDecodeWorker'))
+        ws.close()
+
+    def test_close_decode_workers(self):
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', decode_workers=4)
+        ref = weakref.ref(ws)
+        ws.close()
+        del ws
+        # The workers exit, and no longer hold on to the transport.
+        deadline = time.time() + 2
+        while ref() is not None and time.time() < deadline:
+            gc.collect()
+            time.sleep(0.01)
+        self.assertIsNone(ref())
+
+    def test_text_channel(self):
+        text_channel = signalfx.signalflow.ws._text_channel
+        self.assertEqual(text_channel(b'{"type": "data", "channel": "R0"}'),
+                         'R0')
+        self.assertEqual(text_channel(u'{"channel":"R1"}'), 'R1')
+        self.assertIsNone(text_channel(b'{"type": "authenticated"}'))
+        self.assertIsNone(text_channel(
+            b'{"channel": "R0", "properties": {"channel": "x"}}'))
+
+    def test_decode_columns(self):
+        data = struct.pack(
+                '!BBxx16sqqiBqqBqdBqqBqq',
+                3, 5, b'foo', 1234, 4321,
+                4, 1, 10, 42, 2, 11, 3.14, 0, 12, 0, 3, 13, -42)
+        decoded = signalfx.signalflow.ws._decode_binary_message(
+            data, columns=True)
+        columns = decoded['data']
+        self.assertEqual(len(columns), 4)
+        self.assertEqual(columns.to_list(), [
+            {'tsId': u'AAAAAAAAAAo', 'value': 42},
+            {'tsId': u'AAAAAAAAAAs', 'value': 3.14},
+            {'tsId': u'AAAAAAAAAAw', 'value': None},
+            {'tsId': u'AAAAAAAAAA0', 'value': -42}])
+
+        message = messages.DataMessage(1234, columns)
+        self.assertIs(message.columns, columns)
+        message.add_data(columns)
+        self.assertEqual(len(message.columns), 8)
+        self.assertEqual(message.data['AAAAAAAAAAs'], 3.14)
+        self.assertIsNone(message.columns)
+        message.add_data(columns)
+        self.assertEqual(len(message.data), 4)
+
+        if columnar.shared_memory:
+            name = columns.to_shared_memory()
+            self.assertEqual(
+                columnar.DataColumns.from_shared_memory(name).to_dict(),
+                columns.to_dict())
+
+    @unittest.skipUnless(columnar.shared_memory, 'requires Python 3.8+')
+    def test_decode_processes(self):
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', decode_processes=2)
+        try:
+            channels = [ws._new_channel() for _ in range(3)]
+            for c in channels:
+                ws._channels[c.name] = c
+            for ts in range(5):
+                for c in channels:
+                    ws.received_message(BinaryMessage(struct.pack(
+                        '!BBxx16sqiBqq', 1, 5, c.name.encode('utf-8'), ts,
+                        1, 1, 10, ts)))
+            ws.received_message(TextMessage(json.dumps({
+                'type': 'control-message', 'channel': channels[0].name,
+                'event': 'END_OF_CHANNEL', 'timestampMs': 0})))
+            for c in channels:
+                batches = [next(c) for _ in range(5)]
+                self.assertEqual([m.logical_timestamp_ms for m in batches],
+                                 list(range(5)))
+                self.assertEqual(batches[3].data, {'AAAAAAAAAAo': 3})
+            self.assertIsInstance(next(channels[0]),
+                                  messages.EndOfChannelMessage)
+        finally:
+            ws._stop_decode_processes()
+
+    @unittest.skipUnless(columnar.shared_memory, 'requires Python 3.8+')
+    def test_decode_process_died(self):
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', decode_processes=1)
+        self.addCleanup(ws.close)
+        interval = signalfx.signalflow.ws._DECODE_PROCESS_POLL_INTERVAL
+        self.addCleanup(setattr, signalfx.signalflow.ws,
+                        '_DECODE_PROCESS_POLL_INTERVAL', interval)
+        signalfx.signalflow.ws._DECODE_PROCESS_POLL_INTERVAL = 0.05
+
+        channel = ws._new_channel()
+        ws._channels[channel.name] = channel
+        frames, pending, process = ws._decoders[0]
+        process.terminate()
+        process.join()
+
+        def batch(ts):
+            return struct.pack('!BBxx16sqiBqq', 1, 5,
+                               channel.name.encode('utf-8'), ts, 1, 1, 10, ts)
+
+        # A frame handed over just before the process died is lost, without
+        # holding up the following ones, which are decoded here.
+        frames.put((batch(1), True))
+        pending.put(('frame', time.time()))
+        ws.received_message(BinaryMessage(batch(2)))
+        message = channel.poll(timeout=2)
+        self.assertEqual(message.logical_timestamp_ms, 2)
+        self.assertEqual(message.data, {'AAAAAAAAAAo': 2})
+
+    @unittest.skipUnless(columnar.shared_memory, 'requires Python 3.8+')
+    def test_close_disconnected(self):
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', decode_processes=1)
+        process = ws._decoders[0][2]
+        ws.close()
+        process.join(5)
+        self.assertFalse(process.is_alive())
+
+    def test_stream_stats(self):
+        ws = signalfx.signalflow.ws.WebSocketTransport('token')
+        channel = ws._new_channel()
+        ws._channels[channel.name] = channel
+        now = int(time.time() * 1000)
+        ws.received_message(TextMessage(json.dumps({
+            'type': 'control-message', 'event': 'KEEP_ALIVE',
+            'timestampMs': now - 5000})))
+        ws.received_message(BinaryMessage(struct.pack(
+            '!BBxx16sqqiBqq', 2, 5, channel.name.encode('utf-8'),
+            now - 60000, 2000, 1, 1, 10, 42)))
+        ws.received_message(TextMessage(json.dumps({
+            'type': 'control-message', 'channel': channel.name,
+            'event': 'END_OF_CHANNEL', 'timestampMs': now})))
+
+        c = computation.Computation(lambda since: channel)
+        output = list(c.stream())
+        self.assertEqual(output[0].max_delay_ms, 2000)
+        stats = c.stats
+        self.assertEqual(stats.batches, 1)
+        self.assertEqual(stats.last_logical_ts, now - 60000)
+        self.assertEqual(stats.max_delay.last, 2000)
+        self.assertGreaterEqual(stats.lag.last, 60000)
+        self.assertLess(stats.lag.last, 70000)
+        self.assertGreaterEqual(stats.clock_skew.last, 5000)
+        self.assertGreaterEqual(stats.decode_time.last, 0)
+        self.assertGreaterEqual(stats.queue_residency.last, 0)
+        self.assertEqual(stats.to_dict()['batches'], 1)
+
+
+def data_event(ts, tsid='AAAAAAAAAAo', value=1):
+    return {'type': 'data', 'channel': 'foo', 'logicalTimestampMs': ts,
+            'data': [{'tsId': tsid, 'value': value}]}
+
+
+class StreamMessageTest(unittest.TestCase):
+
+    def test_decode(self):
+        msg = messages.StreamMessage.decode('control-message', {
+            'event': 'JOB_START', 'timestampMs': 1, 'handle': 'foo'})
+        self.assertIsInstance(msg, messages.JobStartMessage)
+        self.assertEqual((msg.timestamp_ms, msg.handle), (1, 'foo'))
+        self.assertFalse(hasattr(msg, '__dict__'))
+
+        msg = messages.StreamMessage.decode('data', data_event(1000))
+        self.assertIsInstance(msg, messages.DataMessage)
+        self.assertEqual(msg.data, {'AAAAAAAAAAo': 1})
+        self.assertFalse(hasattr(msg, '__dict__'))
+
+        self.assertIsNone(messages.StreamMessage.decode('foo', {}))
+        self.assertIsNone(messages.StreamMessage.decode(
+            'control-message', {'event': 'FOO', 'timestampMs': 1}))
+
+
+class SSETransportTest(unittest.TestCase):
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            path = parse.urlparse(self.path).path
+            self.server.requests.append(path)
+            if not path.endswith('/execute'):
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = (b'event: control-message\r\n'
+                    b'data: {"event": "STREAM_START",\r\n'
+                    b'data:  "timestampMs": 1}\r\n\r\n'
+                    b': comment\n\n'
+                    b'event: control-message\n'
+                    b'data: {"event": "END_OF_CHANNEL", "timestampMs": 2}\n\n')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            # Split events across chunks, including in the middle of a CRLF.
+            for chunk in (body[:20], body[20:54], body[54:]):
+                self.wfile.write('{0:x}\r\n'.format(len(chunk)).encode())
+                self.wfile.write(chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            pass
+
+    def setUp(self):
+        self.server = self.Server(('127.0.0.1', 0), self.Handler)
+        self.server.requests = []
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.transport = sse.SSETransport(
+            'token', 'http://127.0.0.1:{0}'.format(self.server.server_port),
+            timeout=0.5, max_streams=1)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_events(self):
+        c = self.transport.execute('data("foo").publish()', {})
+        output = list(c)
+        self.assertIsInstance(output[0], messages.StreamStartMessage)
+        self.assertEqual(output[0].timestamp_ms, 1)
+        self.assertIsInstance(output[1], messages.EndOfChannelMessage)
+        self.assertEqual(len(output), 2)
+
+    def test_pools(self):
+        c = self.transport.execute('data("foo").publish()', {})
+        self.assertRaises(errors.TooManyStreams,
+                          self.transport.execute, 'data("bar").publish()', {})
+        # Control requests don't wait for a streaming connection.
+        self.transport.keepalive('handle')
+        self.transport.stop('handle', {})
+        c.close()
+        list(self.transport.execute('data("bar").publish()', {}))
+        list(self.transport.execute('data("baz").publish()', {}))
+        self.assertEqual(self.server.requests, [
+            '/v2/signalflow/execute', '/v2/signalflow/handle/keepalive',
+            '/v2/signalflow/handle/stop', '/v2/signalflow/execute',
+            '/v2/signalflow/execute'])
+
+    def test_uncapped_streams(self):
+        transport = sse.SSETransport(
+            'token', 'http://127.0.0.1:{0}'.format(self.server.server_port))
+        self.addCleanup(transport.close)
+        warnings = []
+        handler = logging.Handler(logging.WARNING)
+        handler.emit = warnings.append
+        logger = logging.getLogger('urllib3.connectionpool')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        # Concurrent streams give their connections back to the pool
+        # without any being discarded.
+        channels = [transport.execute('data("foo").publish()', {})
+                    for _ in range(3)]
+        for c in channels:
+            self.assertEqual(len(list(c)), 2)
+        self.assertEqual(warnings, [])
+
+    def test_read_events(self):
+        body = (b'data: a\r\n\r\nevent: foo\rdata: b\r\rdata: c\n'
+                b'data: d\n\n' + b'data: ' + b'x' * 1000 + b'\n\ndata: e')
+
+        class Response(object):
+            def stream(self, chunk_size):
+                for i in range(0, len(body), 3):
+                    yield body[i:i + 3]
+
+        self.assertEqual(list(sse._read_events(Response())), [
+            ('message', b'a'), ('foo', b'b'), ('message', b'c\nd'),
+            ('message', b'x' * 1000), ('message', b'e')])
+
+
+class MetadataStoreTest(unittest.TestCase):
+
+    def test_store(self):
+        store = metadata.MetadataStore()
+        store.put('a', {'sf_key': ['host'], 'host': 'foo'})
+        store.put('b', {'sf_key': ['host'], 'host': 'bar'})
+        self.assertEqual(store.get('a'), {'sf_key': ['host'], 'host': 'foo'})
+        self.assertIsNone(store.get('c'))
+        self.assertIs(store._entries['a'][0], store._entries['b'][0])
+        self.assertIs(store.get('a')['sf_key'], store.get('b')['sf_key'])
+        store.remove('a')
+        self.assertEqual(store.tsids(), ['b'])
+
+    def test_max_size(self):
+        store = metadata.MetadataStore(max_size=2)
+        store.put('a', {'host': 'a'})
+        store.put('b', {'host': 'b'})
+        store.get('a')
+        store.put('c', {'host': 'c'})
+        self.assertEqual(sorted(store.tsids()), ['a', 'c'])
+        self.assertEqual(len(store), 2)
+
+    def test_churn(self):
+        store = metadata.MetadataStore(max_size=10)
+        for i in range(1000):
+            store.put(str(i), {'sf_key': ['host', str(i)],
+                               'host{0}'.format(i % 50): u'{0}'.format('foo'),
+                               'id': 'id{0}'.format(i)})
+            if i % 3 == 1:
+                store.remove(str(i))
+        self.assertEqual(len(store), 10)
+        self.assertLessEqual(len(store._lists), 10)
+        self.assertLessEqual(len(store._names), 10)
+        # Strings are shared through a table instead of being interned, and
+        # high-cardinality ones are released along with their entries.
+        self.assertEqual(len(store._strings), 11)
+        a, b = (store._entries[tsid][1] for tsid in store.tsids()[:2])
+        self.assertIs(a[1], b[1])
+        for tsid in store.tsids():
+            store.remove(tsid)
+        self.assertEqual((store._names, store._lists, store._strings),
+                         ({}, {}, {}))
+
+    def test_computation_metadata(self):
+        c = make_computation([
+            messages.MetadataMessage('a', {'host': 'foo'}),
+            messages.MetadataMessage('b', {'host': 'bar'}),
+            messages.ExpiredTsIdMessage('a'),
+        ])
+        for _ in c.stream():
+            pass
+        self.assertEqual(c.get_known_tsids(), ['b'])
+        self.assertEqual(c.get_metadata('b'), {'host': 'bar'})
+        self.assertIsNone(c.get_metadata('a'))
+
+
+class WebSocketReconnectTest(unittest.TestCase):
+
+    def test_resubscribe_on_connection_lost(self):
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', reconnect_delay=0.01)
+        sent = []
+
+        def connect():
+            ws._connected = True
+        ws._connect = connect
+        ws.send = sent.append
+        ws._send({'type': 'keepalive', 'handle': 'foo'})
+        channels = [ws.execute('data(\'foo\').publish()', {})
+                    for _ in range(3)]
+        channels[0].offer(data_event(1000))
+        del sent[:]
+
+        ws.closed(1006, 'Lost')
+        ws._send({'type': 'keepalive', 'handle': 'foo'})
+        requests = [json.loads(r) for r in sent]
+        self.assertEqual(len(requests), 4)
+        self.assertEqual(
+            set(r['channel'] for r in requests[:3]),
+            set(c.name for c in channels))
+        self.assertEqual(
+            [r.get('start') for r in requests[:3]
+             if r['channel'] == channels[0].name], [1000])
+        self.assertEqual(requests[3]['type'], 'keepalive')
+        self.assertTrue(all(c.backlog == 0 for c in channels[1:]))
+
+    def test_close_stops_reconnection(self):
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', reconnect_delay=0.5)
+        attempts = []
+
+        def connect():
+            if not attempts:
+                ws._connected = True
+            attempts.append(time.time())
+            if len(attempts) > 1:
+                raise errors.SignalFlowException(1006, 'Refused')
+        ws._connect = connect
+        ws.send = lambda data: None
+        channel = ws.execute('data(\'foo\').publish()', {})
+
+        ws.closed(1006, 'Lost')
+        time.sleep(0.05)
+        ws.close()
+        with ws._connection_cv:
+            while ws._reconnecting:
+                ws._connection_cv.wait(1)
+        self.assertEqual(len(attempts), 2)
+        self.assertRaises(StopIteration, next, channel)
+
+
+class WebSocketBackendTest(unittest.TestCase):
+
+    class FakeBackend(object):
+        name = 'fake'
+        version = '1.0'
+
+        def __init__(self, url, handler):
+            self.url = url
+            self.handler = handler
+            self.sent = []
+
+        def connect(self):
+            self.handler.opened()
+
+        def send(self, data):
+            request = json.loads(data)
+            self.sent.append(request)
+            if request['type'] == 'authenticate':
+                self.handler.received_data(json.dumps({
+                    'type': 'authenticated'}).encode('utf-8'), False)
+
+        def close(self, code, reason=None):
+            self.handler.closed(code, reason)
+
+    def test_backend(self):
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', 'https://stream.example.com', backend=self.FakeBackend)
+        channel = ws.execute('data(\'foo\').publish()', {})
+        backend = ws._ws
+        self.assertEqual(backend.url,
+                         'wss://stream.example.com/v2/signalflow/connect')
+        self.assertEqual([r['type'] for r in backend.sent],
+                         ['authenticate', 'execute'])
+        self.assertTrue(backend.sent[0]['userAgent'].endswith(' fake/1.0'))
+
+        backend.handler.received_data(struct.pack(
+            '!BBxx16sqiBqq', 1, 5, channel.name.encode('utf-8'), 1000,
+            1, 1, 10, 42), True)
+        self.assertEqual(next(channel).data, {'AAAAAAAAAAo': 42})
+        ws.close()
+        self.assertRaises(StopIteration, next, channel)
+
+    @unittest.skipUnless(backends.WebSocketsBackend, 'requires Python 3.7+')
+    def test_websockets_backpressure(self):
+        import asyncio
+        from signalfx.signalflow import _websockets
+
+        class FakeConnection(object):
+            """Stand-in for a websockets client connection, answering
+            requests on the event loop without async syntax."""
+
+            def __init__(self):
+                self.sent = []
+                self.incoming = collections.deque()
+                self.waiter = None
+                self.close_code = self.close_reason = None
+
+            @staticmethod
+            def done(result=None):
+                future = asyncio.get_event_loop().create_future()
+                future.set_result(result)
+                return future
+
+            def push(self, message):
+                self.incoming.append(message)
+                if self.waiter:
+                    waiter, self.waiter = self.waiter, None
+                    self.deliver(waiter)
+
+            def deliver(self, future):
+                message = self.incoming.popleft()
+                if message is None:
+                    future.set_exception(StopAsyncIteration())  # noqa: F821
+                else:
+                    future.set_result(message)
+
+            def send(self, data):
+                request = json.loads(data)
+                self.sent.append(request['type'])
+                if request['type'] == 'authenticate':
+                    self.push(json.dumps({'type': 'authenticated'}))
+                elif request['type'] == 'execute':
+                    for ts in range(3):
+                        self.push(struct.pack(
+                            '!BBxx16sqiBqq', 1, 5,
+                            request['channel'].encode('utf-8'), ts,
+                            1, 1, 10, ts))
+                return self.done()
+
+            def close(self, code=1000, reason=''):
+                self.close_code, self.close_reason = code, reason
+                self.push(None)
+                return self.done()
+
+            def __aiter__(self):
+                return self
+
+            def __anext__(self):
+                future = asyncio.get_event_loop().create_future()
+                if self.incoming:
+                    self.deliver(future)
+                else:
+                    self.waiter = future
+                return future
+
+        connection = FakeConnection()
+
+        class FakeWebSockets(object):
+            __version__ = 'fake'
+
+            class ConnectionClosed(Exception):
+                pass
+
+            @staticmethod
+            def connect(url, **kwargs):
+                return connection.done(connection)
+
+        self.addCleanup(setattr, _websockets, 'websockets',
+                        _websockets.websockets)
+        _websockets.websockets = FakeWebSockets
+
+        ws = signalfx.signalflow.ws.WebSocketTransport(
+            'token', backend='websockets', channel_capacity=1)
+        channel = ws.execute('data(\'foo\').publish()', {})
+        while not connection.incoming or channel.backlog < 1:
+            time.sleep(0.01)
+        # The event loop is now blocked offering the second batch to the
+        # full channel; detaching from it must not wait on the loop.
+        t = threading.Thread(target=channel.close)
+        t.daemon = True
+        t.start()
+        t.join(2)
+        self.assertFalse(t.is_alive())
+        ws.close()
+        ws._ws._thread.join(2)
+        self.assertEqual(connection.sent,
+                         ['authenticate', 'execute', 'detach'])
+        self.assertEqual(connection.close_code, 1001)
+
+    def test_get_backend(self):
+        self.assertIs(backends.get_backend(None), backends.Ws4pyBackend)
+        self.assertIs(backends.get_backend('ws4py'), backends.Ws4pyBackend)
+        self.assertIs(backends.get_backend(self.FakeBackend),
+                      self.FakeBackend)
+        self.assertRaises(ValueError, backends.get_backend, 'foo')
+        self.assertIn('ws4py', backends.available_backends())
+
+
+class PooledWebSocketTransportTest(unittest.TestCase):
+
+    def test_assignment(self):
+        pool = signalfx.signalflow.ws.PooledWebSocketTransport(
+            'token', connections=2, sample_period=0,
+            backend=WebSocketBackendTest.FakeBackend)
+        transports = pool.transports
+        channels = [pool.execute('foo', {}) for _ in range(3)]
+        self.assertEqual([t.channels for t in transports], [2, 1])
+        self.assertIn(channels[0].name, transports[0]._channels)
+        self.assertIn(channels[1].name, transports[1]._channels)
+
+        # The first connection now receives data, the next channel goes to
+        # the other one.
+        transports[0].received_data(json.dumps(
+            data_event(1000)).encode('utf-8'), False)
+        channel = pool.attach('handle', {})
+        self.assertIn(channel.name, transports[1]._channels)
+
+        pool.close()
+        self.assertEqual([t.channels for t in transports], [0, 0])
+
+
+class WebSocketComputationChannelTest(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        WSCC = signalfx.signalflow.ws.WebSocketComputationChannel
+        channel = WSCC(lambda c: None, 2, WSCC.OVERFLOW_DROP_OLDEST)
+        channel.offer({'type': 'metadata', 'tsId': 'AAAAAAAAAAo',
+                       'properties': {}})
+        channel.offer(data_event(1000))
+        channel.offer(data_event(2000))
+        channel.offer(data_event(3000))
+        self.assertEqual(channel.dropped, 2)
+        self.assertEqual(channel.backlog, 2)
+        self.assertIsInstance(next(channel), messages.MetadataMessage)
+        self.assertEqual(next(channel).logical_timestamp_ms, 3000)
+
+    def test_coalesce(self):
+        WSCC = signalfx.signalflow.ws.WebSocketComputationChannel
+        channel = WSCC(lambda c: None, 3, WSCC.OVERFLOW_COALESCE)
+        channel.offer(data_event(1000, 'AAAAAAAAAAo'))
+        channel.offer(data_event(1000, 'AAAAAAAAAAs'))
+        channel.offer(data_event(2000, 'AAAAAAAAAAo'))
+        channel.offer(data_event(2000, 'AAAAAAAAAAs'))
+        self.assertEqual(channel.dropped, 2)
+        self.assertEqual(channel.backlog, 2)
+        self.assertEqual([next(channel).logical_timestamp_ms
+                          for _ in range(2)], [2000, 2000])
+
+        # Equal batches queued around a metadata message are dropped by
+        # position, and dropped batches are skipped when polling.
+        channel.offer(data_event(3000))
+        channel.offer({'type': 'metadata', 'tsId': 'AAAAAAAAAAo',
+                       'properties': {}})
+        channel.offer(data_event(3000))
+        channel.offer(data_event(4000))
+        self.assertEqual(channel.dropped, 4)
+        self.assertIsInstance(channel.poll(), messages.MetadataMessage)
+        self.assertEqual(channel.poll().logical_timestamp_ms, 4000)
+        self.assertIsNone(channel.poll())
+
+    def test_block(self):
+        WSCC = signalfx.signalflow.ws.WebSocketComputationChannel
+        channel = WSCC(lambda c: None, 1, WSCC.OVERFLOW_BLOCK)
+        channel.offer(data_event(1000))
+        t = threading.Thread(target=channel.offer, args=(data_event(2000),))
+        t.start()
+        t.join(0.2)
+        self.assertTrue(t.is_alive())
+        self.assertEqual(next(channel).logical_timestamp_ms, 1000)
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(next(channel).logical_timestamp_ms, 2000)
+        self.assertEqual(channel.dropped, 0)
+
+    def test_resume(self):
+        WSCC = signalfx.signalflow.ws.WebSocketComputationChannel
+        channel = WSCC(lambda c: None, resumable=True)
+        channel.request = {'type': 'execute', 'channel': channel.name,
+                           'program': 'foo', 'start': 0}
+        channel.offer(data_event(1000, 'AAAAAAAAAAo'))
+        channel.offer(data_event(2000, 'AAAAAAAAAAo'))
+        request = channel.resume_request()
+        self.assertEqual(request['start'], 2000)
+        self.assertEqual(channel.request['start'], 0)
+
+        # Replayed data is suppressed, new data goes through.
+        channel.offer(data_event(1000, 'AAAAAAAAAAo'))
+        channel.offer(data_event(2000, 'AAAAAAAAAAo'))
+        channel.offer(data_event(2000, 'AAAAAAAAAAs'))
+        channel.offer(data_event(3000, 'AAAAAAAAAAo'))
+        received = [(m.logical_timestamp_ms, list(m.data.keys()))
+                    for m in [next(channel) for _ in range(4)]]
+        self.assertEqual(received, [
+            (1000, ['AAAAAAAAAAo']),
+            (2000, ['AAAAAAAAAAo']),
+            (2000, ['AAAAAAAAAAs']),
+            (3000, ['AAAAAAAAAAo']),
+        ])
+        self.assertEqual(channel.backlog, 0)
+
+
+def make_computation(stream_messages):
+    """Build a Computation whose output stream replays the given
+    messages, followed by an end of channel message."""
+    msgs = list(stream_messages) + [messages.EndOfChannelMessage(0)]
+    # Like the real server, send resolution information after the first data
+    # batch, which lets the computation detect the number of batches.
+    for i, msg in enumerate(msgs):
+        if isinstance(msg, messages.DataMessage):
+            msgs.insert(i + 1, messages.InfoMessage(msg.logical_timestamp_ms, {
+                'messageCode': 'JOB_RUNNING_RESOLUTION',
+                'contents': {'resolutionMs': 1000},
+            }))
+            break
+    return computation.Computation(lambda since: iter(msgs))
+
+
+class PartialReleaseTest(unittest.TestCase):
+
+    def test_incomplete_and_corrections(self):
+        msgs = [
+            messages.DataMessage(1000, [{'tsId': 'a', 'value': 1}]),
+            messages.DataMessage(1000, [{'tsId': 'b', 'value': 1}]),
+            messages.DataMessage(2000, [{'tsId': 'a', 'value': 2}]),
+            messages.DataMessage(3000, [{'tsId': 'a', 'value': 3}]),
+            messages.DataMessage(2000, [{'tsId': 'b', 'value': 2}]),
+            messages.DataMessage(3000, [{'tsId': 'b', 'value': 3}]),
+            messages.EndOfChannelMessage(0),
+        ]
+        c = computation.Computation(lambda since: iter(msgs))
+        output = [(m.logical_timestamp_ms, sorted(m.data), m.incomplete,
+                   m.correction) for m in c.stream()
+                  if isinstance(m, messages.DataMessage)]
+        self.assertEqual(output, [
+            (1000, ['a', 'b'], False, False),
+            (2000, ['a'], True, False),
+            (2000, ['b'], False, True),
+            (3000, ['a', 'b'], False, False),
+        ])
+
+    def test_reorder(self):
+        def batch(ts, tsid):
+            return messages.DataMessage(ts, [{'tsId': tsid, 'value': ts}],
+                                        max_delay_ms=2000)
+        msgs = [
+            batch(2000, 'a'), batch(1000, 'a'), batch(1000, 'b'),
+            batch(3000, 'a'), batch(2000, 'b'), batch(4000, 'b'),
+            batch(3000, 'b'), batch(5000, 'a'), batch(6000, 'a'),
+            batch(7000, 'a'), batch(4000, 'a'), batch(6000, 'b'),
+            messages.EndOfChannelMessage(0),
+        ]
+        c = computation.Computation(lambda since: iter(msgs))
+        output = [(m.logical_timestamp_ms, sorted(m.data), m.incomplete,
+                   m.correction) for m in c.stream()
+                  if isinstance(m, messages.DataMessage)]
+        self.assertEqual(output, [
+            (1000, ['a', 'b'], False, False),
+            (2000, ['a', 'b'], False, False),
+            (3000, ['a', 'b'], False, False),
+            (4000, ['b'], True, False),
+            (4000, ['a'], False, True),
+            (5000, ['a'], True, False),
+            (6000, ['a', 'b'], False, False),
+            (7000, ['a'], True, False),
+        ])
+
+    def test_reorder_window(self):
+        def batch(ts, tsid):
+            return messages.DataMessage(ts, [{'tsId': tsid, 'value': ts}],
+                                        max_delay_ms=60000)
+        msgs = [
+            batch(1000, 'a'), batch(1000, 'b'),
+            messages.InfoMessage(1000, {
+                'messageCode': 'JOB_RUNNING_RESOLUTION',
+                'contents': {'resolutionMs': 1000}}),
+            batch(2000, 'a'), batch(3000, 'a'), batch(4000, 'a'),
+            messages.EventMessage('e', 4000, {}, {}),
+            batch(3000, 'b'), batch(4000, 'b'),
+            messages.EndOfChannelMessage(0),
+        ]
+        c = computation.Computation(lambda since: iter(msgs))
+        output = [(m.logical_timestamp_ms, sorted(m.data), m.incomplete)
+                  if isinstance(m, messages.DataMessage) else 'event'
+                  for m in c.stream()
+                  if not isinstance(m, messages.InfoMessage)]
+        # The window is capped to one resolution, rather than the minute of
+        # maxDelayMs: the incomplete timestamp is closed by data two
+        # resolutions newer.
+        self.assertEqual(output, [
+            (1000, ['a', 'b'], False),
+            (2000, ['a'], True),
+            'event',
+            (3000, ['a', 'b'], False),
+            (4000, ['a', 'b'], False),
+        ])
+
+    def test_release_timeout(self):
+        WSCC = signalfx.signalflow.ws.WebSocketComputationChannel
+        channel = WSCC(lambda c: None)
+        for tsid in ['a', 'b']:
+            channel.offer(data_event(1000, tsid))
+        channel.offer({'type': 'message', 'channel': 'foo',
+                       'logicalTimestampMs': 1000,
+                       'message': {'messageCode': 'JOB_RUNNING_RESOLUTION',
+                                   'contents': {'resolutionMs': 1000}}})
+        channel.offer(data_event(2000, 'a'))
+
+        c = computation.Computation(lambda since: channel,
+                                    release_timeout=0.05)
+        stream = c.stream()
+        self.assertIsInstance(next(stream), messages.InfoMessage)
+        self.assertEqual(sorted(next(stream).data), ['a', 'b'])
+        start = time.time()
+        partial = next(stream)
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        self.assertEqual((partial.logical_timestamp_ms, list(partial.data),
+                          partial.incomplete), (2000, ['a'], True))
+
+        channel.offer(data_event(2000, 'b'))
+        channel.offer(WSCC.END_SENTINEL)
+        correction = next(stream)
+        self.assertEqual((list(correction.data), correction.correction),
+                         (['b'], True))
+
+
+class AccumulatorTest(unittest.TestCase):
+
+    def test_accumulate(self):
+        c = make_computation([
+            messages.MetadataMessage('a', {'host': 'foo'}),
+            messages.DataMessage(1000, [{'tsId': 'a', 'value': 1}]),
+            messages.DataMessage(2000, [{'tsId': 'a', 'value': 2},
+                                        {'tsId': 'b', 'value': 3}]),
+        ])
+        acc = accumulator.TimeSeriesAccumulator(c).accumulate()
+        self.assertEqual(acc.timestamps, [1000, 2000])
+        self.assertEqual(acc.get_known_tsids(), ['a', 'b'])
+        self.assertEqual(acc.get_series('a'), [(1000, 1), (2000, 2)])
+        self.assertEqual(acc.get_series('a', since=1000), [(2000, 2)])
+        self.assertEqual(acc.get_metadata(['a']), {'a': {'host': 'foo'}})
+
+    def test_window(self):
+        c = make_computation([
+            messages.DataMessage(ts, [{'tsId': 'a', 'value': ts},
+                                      {'tsId': 'b', 'value': -ts}])
+            for ts in range(1000, 11000, 1000)
+        ] + [messages.ExpiredTsIdMessage('b')])
+        acc = accumulator.TimeSeriesAccumulator(c, window=3).accumulate()
+        self.assertEqual(acc.timestamps, [8000, 9000, 10000])
+        self.assertEqual(acc.get_known_tsids(), ['a'])
+        self.assertEqual(acc.get_series('a'),
+                         [(8000, 8000), (9000, 9000), (10000, 10000)])
+
+    def test_corrections(self):
+        def batch(ts, tsid):
+            return messages.DataMessage(ts, [{'tsId': tsid, 'value': ts}])
+        # 2000 and 3000 are released incomplete, and completed by
+        # corrections once 4000 has been released.
+        msgs = [batch(1000, 'a'), batch(1000, 'b'), batch(2000, 'a'),
+                batch(3000, 'a'), batch(4000, 'a'), batch(4000, 'b'),
+                batch(2000, 'b'), batch(3000, 'b'),
+                messages.EndOfChannelMessage(0)]
+        c = computation.Computation(lambda since: iter(msgs))
+        acc = accumulator.TimeSeriesAccumulator(c, window=3)
+        corrections = [m.logical_timestamp_ms for m in acc.consume()
+                       if getattr(m, 'correction', False)]
+        self.assertEqual(corrections, [2000, 3000])
+        self.assertEqual(acc.timestamps, [2000, 3000, 4000])
+        self.assertEqual(acc.get_series('b'),
+                         [(2000, 2000), (3000, 3000), (4000, 4000)])
+        self.assertEqual(acc.get_series('b', since=2000),
+                         [(3000, 3000), (4000, 4000)])
+
+        # Corrections for timestamps that are no longer retained are
+        # dropped; those for a retained timestamp replace its value.
+        late = batch(1000, 'b')
+        late.correction = True
+        acc.add(late)
+        fix = messages.DataMessage(3000, [{'tsId': 'a', 'value': -1}])
+        fix.correction = True
+        acc.add(fix)
+        self.assertEqual(acc.timestamps, [2000, 3000, 4000])
+        self.assertEqual(acc.get_series('a'),
+                         [(2000, 2000), (3000, -1), (4000, 4000)])
+        self.assertEqual(acc.get_series('b'),
+                         [(2000, 2000), (3000, 3000), (4000, 4000)])
+
+
+class ComputationSelectorTest(unittest.TestCase):
+
+    def control_event(self, event, **kwargs):
+        kwargs.update({'type': 'control-message', 'channel': 'foo',
+                       'event': event, 'timestampMs': 0})
+        return kwargs
+
+    def test_select(self):
+        WSCC = signalfx.signalflow.ws.WebSocketComputationChannel
+        channels = [WSCC(lambda c: None) for _ in range(2)]
+        computations = [computation.Computation(lambda since, ch=ch: ch)
+                        for ch in channels]
+        selector = computation.ComputationSelector(computations)
+        self.assertEqual(len(selector), 2)
+
+        for i, ch in enumerate(channels):
+            ch.offer(self.control_event('JOB_START', handle=str(i)))
+            ch.offer(data_event(1000, value=i))
+            ch.offer({'type': 'message', 'channel': 'foo',
+                      'logicalTimestampMs': 1000,
+                      'message': {'messageCode': 'JOB_RUNNING_RESOLUTION',
+                                  'contents': {'resolutionMs': 1000}}})
+        channels[1].offer(self.control_event('END_OF_CHANNEL'))
+        channels[1].offer(WSCC.END_SENTINEL)
+
+        def feed():
+            channels[0].offer(data_event(2000, value=2))
+            channels[0].offer(self.control_event('END_OF_CHANNEL'))
+            channels[0].offer(WSCC.END_SENTINEL)
+        threading.Timer(0.1, feed).start()
+
+        received = [(c.id, type(m).__name__,
+                     getattr(m, 'logical_timestamp_ms', None))
+                    for c, m in selector
+                    if not isinstance(m, messages.InfoMessage)]
+        self.assertEqual(len(selector), 0)
+        self.assertEqual(
+            [r for r in received if r[0] == '0'],
+            [('0', 'JobStartMessage', None),
+             ('0', 'DataMessage', 1000),
+             ('0', 'DataMessage', 2000)])
+        self.assertEqual(
+            [r for r in received if r[0] == '1'],
+            [('1', 'JobStartMessage', None),
+             ('1', 'DataMessage', 1000)])
+
+
+class KeepaliveSchedulerTest(unittest.TestCase):
+
+    class FakeTransport(object):
+        def __init__(self):
+            self.keepalives = []
+
+        def keepalive(self, handle):
+            if handle == 'bad':
+                raise Exception('Failed')
+            self.keepalives.append(handle)
+
+    def test_keepalive(self):
+        transport = self.FakeTransport()
+        scheduler = keepalive.KeepaliveScheduler(transport, interval=0.05)
+        try:
+            for handle in ['a', 'b', 'bad']:
+                scheduler.add(handle)
+            time.sleep(0.2)
+            scheduler.remove('b')
+            count = transport.keepalives.count('b')
+            time.sleep(0.2)
+        finally:
+            scheduler.close()
+        self.assertEqual(scheduler.handles, ['a', 'bad'])
+        self.assertGreaterEqual(transport.keepalives.count('a'), 4)
+        self.assertGreaterEqual(count, 2)
+        self.assertEqual(transport.keepalives.count('b'), count)
+        self.assertEqual(list(scheduler.failed.keys()), ['bad'])
+
+
+class BackfillTest(unittest.TestCase):
+
+    class FakeClient(object):
+        """Executes computations that output one datapoint per second of
+        their [start, stop] range; the first one only after a delay."""
+
+        def __init__(self, end=True):
+            self.executed = []
+            self.closed = []
+            self.end = end
+
+        def execute(self, program, start, stop, resolution):
+            WSCC = signalfx.signalflow.ws.WebSocketComputationChannel
+            channel = WSCC(self.closed.append)
+            events = [{'type': 'metadata', 'channel': 'foo', 'tsId': 'a',
+                       'properties': {'host': 'foo'}}]
+            for ts in range(start, stop + resolution, resolution):
+                events.append(data_event(ts, 'a', ts))
+                if ts == start:
+                    events.append({
+                        'type': 'message', 'channel': 'foo',
+                        'logicalTimestampMs': ts,
+                        'message': {'messageCode': 'JOB_RUNNING_RESOLUTION',
+                                    'contents': {'resolutionMs': 1000}}})
+            if self.end:
+                events.append({'type': 'control-message', 'channel': 'foo',
+                               'event': 'END_OF_CHANNEL', 'timestampMs': 0})
+                events.append(WSCC.END_SENTINEL)
+
+            def feed():
+                for event in events:
+                    channel.offer(event)
+            if self.executed:
+                feed()
+            else:
+                threading.Timer(0.1, feed).start()
+            self.executed.append((start, stop))
+            return computation.Computation(lambda since: channel)
+
+    def test_backfill(self):
+        client = self.FakeClient()
+        b = backfill.Backfill(client, 'foo', 0, 10000, 1000, parallelism=2,
+                              shard_size=2500)
+        self.assertEqual(b.shards, [(0, 3000), (3000, 6000), (6000, 9000),
+                                    (9000, 10000)])
+        output = list(b)
+        self.assertEqual(len(client.executed), 4)
+        self.assertEqual(
+            [m.tsid for m in output
+             if isinstance(m, messages.MetadataMessage)], ['a'])
+        self.assertEqual(
+            [m.logical_timestamp_ms for m in output
+             if isinstance(m, messages.DataMessage)],
+            list(range(0, 10000, 1000)))
+        self.assertEqual(client.closed, [])
+
+    def test_abandoned(self):
+        client = self.FakeClient(end=False)
+        output = iter(backfill.Backfill(client, 'foo', 0, 10000, 1000,
+                                        parallelism=2, shard_size=2500))
+        self.assertIsInstance(next(output), messages.MetadataMessage)
+        output.close()
+        self.assertEqual(len(client.executed), 2)
+        self.assertEqual(len(client.closed), 2)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    class FakeTransport(object):
+        def __init__(self, *args):
+            self.executed = []
+
+        def execute(self, program, params):
+            self.executed.append(params)
+            ts = params['start']
+            msgs = [
+                messages.JobStartMessage(0, 'abc'),
+                messages.MetadataMessage('a', {'host': 'foo'}),
+                messages.DataMessage(ts, [{'tsId': 'a', 'value': 1.5}]),
+                messages.InfoMessage(ts, {
+                    'messageCode': 'JOB_RUNNING_RESOLUTION',
+                    'contents': {'resolutionMs': 1000}}),
+                messages.DataMessage(ts + 1000, [
+                    {'tsId': 'a', 'value': 2}, {'tsId': 'b', 'value': None}]),
+                messages.EndOfChannelMessage(0),
+            ]
+            return iter(msgs)
+
+        def close(self):
+            pass
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def output(self, c):
+        return [(type(m).__name__, getattr(m, 'logical_timestamp_ms', None),
+                 getattr(m, 'data', None)) for m in c.stream()]
+
+    def test_replay(self):
+        rc = cache.ResultCache(self.directory)
+        client = signalfx.signalflow.SignalFlowClient(
+            'token', transport=self.FakeTransport, cache=rc)
+        first = self.output(client.execute('data("foo").publish()',
+                                           start=1000, stop=3000))
+        second = self.output(client.execute(' data("foo").publish()  \n',
+                                            start=1000, stop=3000))
+        self.assertEqual(len(client._transport.executed), 1)
+        self.assertEqual(first, second)
+        self.assertIn(('DataMessage', 2000, {'a': 2, 'b': None}), second)
+
+        # Replaying through a selector streams the records from the file.
+        selector = computation.ComputationSelector([client.execute(
+            'data("foo").publish()', start=1000, stop=3000)])
+        self.assertEqual(
+            [(type(m).__name__, getattr(m, 'logical_timestamp_ms', None),
+              getattr(m, 'data', None)) for _, m in selector], second)
+        self.assertEqual(len(client._transport.executed), 1)
+
+        client.execute('data("foo").publish()', start=1000,
+                       stop=int(time.time() * 1000)).stream()
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_abandoned_recording(self):
+        rc = cache.ResultCache(self.directory)
+        recording = rc.record('foo', self.FakeTransport().execute(
+            'foo', {'start': 1000}))
+        next(recording)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        del recording
+        gc.collect()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_eviction(self):
+        rc = cache.ResultCache(self.directory, max_size=1)
+        client = signalfx.signalflow.SignalFlowClient(
+            'token', transport=self.FakeTransport, cache=rc)
+        for start in [1000, 2000]:
+            list(client.execute('foo', start=start, stop=5000).stream())
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class SinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self, sink_class):
+        c = make_computation([
+            messages.MetadataMessage('a', {'host': 'foo'}),
+            messages.DataMessage(1000, [{'tsId': 'a', 'value': 1}]),
+            messages.DataMessage(2000, [{'tsId': 'a', 'value': 2.5}]),
+            messages.MetadataMessage('b', {'host': 'bar'}),
+            messages.DataMessage(3000, [{'tsId': 'b', 'value': 3}]),
+        ])
+        sink_class(self.path, chunk_size=1, queue_size=1).export(c)
+        with open(self.path + '.metadata.jsonl') as f:
+            self.assertEqual([json.loads(line) for line in f], [
+                {'tsId': 'a', 'properties': {'host': 'foo'}},
+                {'tsId': 'b', 'properties': {'host': 'bar'}},
+            ])
+
+    def test_csv(self):
+        self.export(sinks.CSVSink)
+        with open(self.path) as f:
+            self.assertEqual(list(csv.reader(f)), [
+                ['timestamp', 'tsid', 'value'],
+                ['1000', 'a', '1'], ['2000', 'a', '2.5'], ['3000', 'b', '3'],
+            ])
+
+    def test_jsonl(self):
+        self.export(sinks.JSONLinesSink)
+        with open(self.path) as f:
+            self.assertEqual([json.loads(line) for line in f], [
+                {'timestamp': 1000, 'tsid': 'a', 'value': 1},
+                {'timestamp': 2000, 'tsid': 'a', 'value': 2.5},
+                {'timestamp': 3000, 'tsid': 'b', 'value': 3},
+            ])
+
+    def test_open_error(self):
+        sink = sinks.CSVSink(os.path.join(self.directory, 'missing', 'out'),
+                             chunk_size=1, queue_size=1)
+        with self.assertRaises(EnvironmentError):
+            for ts in range(10):
+                sink.write(messages.DataMessage(
+                    ts, [{'tsId': 'a', 'value': ts}]))
+        self.assertRaises(EnvironmentError, sink.close)
+
 
 if __name__ == '__main__':
     unittest.main()